@@ -0,0 +1,210 @@
+#    This file is part of OpenVideoChat.
+#
+#    OpenVideoChat is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    OpenVideoChat is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with OpenVideoChat.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod: `OpenVideoChat/OpenVideoChat.activity/bandwidth` --
+        Open Video Chat Bandwidth Estimation
+=======================================================================
+
+Estimates the bitrate the path to the peer can carry from when packets
+arrive.  With transport-wide sequence numbers (TWCC, see
+RtpTransport.add_twcc) the peer feeds back the arrival of every packet
+and rtpsession sums it up in its twcc-stats; without, the RTCP receiver
+reports stand in, with the round trip for the arrival delay.
+"""
+
+
+# External Imports
+import time
+import logging
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+from gi.repository import GLib
+
+
+# Define Logger for Logging
+logger = logging.getLogger('ovc-activity')
+
+
+# Local Imports
+from rate_control import RTT_GROWTH
+
+
+# Estimate limits and starting point in kbit/s
+MIN_BITRATE = 32
+MAX_BITRATE = 2000
+START_BITRATE = 300
+
+# How often (ms) the TWCC stats are read
+TICK_MS = 500
+
+# Growth of the estimate per second: fast until the path first pushes
+# back, then gently, never beyond HEADROOM times what gets through
+PROBE_FACTOR = 1.5
+INCREASE_FACTOR = 1.08
+HEADROOM = 1.5
+
+# Once packets queue, drop to this share of what got through
+OVERUSE_FACTOR = 0.85
+
+# Average growth (seconds) in the gap between packet arrivals over the
+# gap between sends that is treated as queueing
+OVERUSE_DELAY = 0.001
+
+# Loss fractions (0.0 - 1.0): above LOSS_HIGH the estimate is cut in
+# proportion, below LOSS_LOW it may grow
+LOSS_LOW = 0.02
+LOSS_HIGH = 0.10
+DECREASE_FACTOR = 0.5
+
+# Weight of each new measurement of what got through
+RECEIVED_SMOOTHING = 0.3
+
+
+######################
+# BandwidthEstimator
+######################
+class BandwidthEstimator(object):
+    """
+    Running estimate (kbit/s) of the available bitrate on one session.
+
+    The estimate grows while packets arrive as fast as they were sent, and
+    drops just below what actually got through once they start to queue
+    (arrival gaps growing) or to get lost.  Anything that adapts to it, a
+    rate controller or an out bin, subscribes a callback that is called
+    with every new estimate.
+    """
+
+    def __init__(self, transport, session, bitrate=START_BITRATE,
+            min_bitrate=MIN_BITRATE, max_bitrate=MAX_BITRATE):
+        self.transport = transport
+        self.session = session
+        self.min_bitrate = min_bitrate
+        self.max_bitrate = max_bitrate
+        self.estimate = bitrate
+        self.received = None
+        self.twcc = False
+        self._probing = True
+        self._min_rtt = None
+        self._last_update = None
+        self._last_twcc = None
+        self._subscribers = []
+        self._timeout_id = GLib.timeout_add(TICK_MS, self._on_tick)
+
+    def subscribe(self, callback):
+        # Called at once with the current estimate, then on every change
+        self._subscribers.append(callback)
+        callback(self.estimate)
+
+    def unsubscribe(self, callback):
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
+
+    def stop(self):
+        if self._timeout_id is not None:
+            GLib.source_remove(self._timeout_id)
+            self._timeout_id = None
+        self._subscribers = []
+
+    def get_estimate(self):
+        return self.estimate
+
+    def _set_estimate(self, estimate):
+        estimate = int(max(self.min_bitrate, min(self.max_bitrate, estimate)))
+        if estimate == self.estimate:
+            return
+
+        self.estimate = estimate
+        logger.debug("Bandwidth estimate %d kbit/s (%d through)" %
+                (estimate, self.received or 0))
+        for callback in list(self._subscribers):
+            callback(estimate)
+
+    def update(self, received, fraction_lost, queueing):
+        """
+        Feed one measurement in: kbit/s that arrived, the fraction lost
+        (0.0 - 1.0), and whether packets are queueing on the way.
+        """
+        now = time.time()
+        elapsed = 1.0
+        if self._last_update is not None:
+            elapsed = min(now - self._last_update, 1.0)
+        self._last_update = now
+
+        if self.received is None:
+            self.received = received
+        else:
+            self.received += RECEIVED_SMOOTHING * (received - self.received)
+
+        estimate = self.estimate
+        if queueing:
+            self._probing = False
+            estimate = min(estimate, self.received * OVERUSE_FACTOR)
+        elif fraction_lost > LOSS_HIGH:
+            self._probing = False
+            estimate *= 1 - DECREASE_FACTOR * fraction_lost
+        elif fraction_lost < LOSS_LOW:
+            # Growth is per second, measurements come at any pace
+            growth = PROBE_FACTOR if self._probing else INCREASE_FACTOR
+            estimate = max(estimate, min(estimate * growth ** elapsed,
+                    max(self.received, self.min_bitrate) * HEADROOM))
+        self._set_estimate(estimate)
+
+    def _on_tick(self):
+        stats = self.transport.get_twcc_stats(self.session)
+        if stats is None or not stats.has_field("bitrate-recv") or \
+                not stats.get_value("packets-recv"):
+            return True
+
+        # The stats only change when feedback arrives, a stalled peer
+        # must not look like a clear path
+        current = (stats.get_value("packets-sent"),
+                stats.get_value("packets-recv"),
+                stats.get_value("bitrate-recv"))
+        if current == self._last_twcc:
+            return True
+        self._last_twcc = current
+        if not self.twcc:
+            logger.info("Bandwidth estimation from TWCC feedback")
+            self.twcc = True
+
+        delay = stats.get_value("avg-delta-of-delta") / float(Gst.SECOND)
+        self.update(stats.get_value("bitrate-recv") / 1000.0,
+                stats.get_value("packet-loss-pct") / 100.0,
+                delay > OVERUSE_DELAY)
+        return True
+
+    def rtcp_stats(self, stats):
+        """
+        Feed the stats structure of an RTPSource that carries a report
+        block about us; ignored once TWCC feedback is coming in.
+        """
+        if self.twcc or not stats.get_value("have-rb"):
+            return
+
+        clock_rate = stats.get_value("clock-rate")
+        if not clock_rate or clock_rate < 0:
+            clock_rate = 90000
+        fraction_lost = stats.get_value("rb-fractionlost") / 256.0
+        jitter = stats.get_value("rb-jitter") / float(clock_rate)
+        rtt = stats.get_value("rb-round-trip") / 65536.0
+
+        # A round trip growing past the jitter is packets queueing
+        if self._min_rtt is None or rtt < self._min_rtt:
+            self._min_rtt = rtt
+        queueing = rtt - self._min_rtt > max(RTT_GROWTH, jitter)
+
+        sent = self.transport.get_send_bitrate(self.session) / 1000.0
+        self.update(sent * (1 - fraction_lost), fraction_lost, queueing)
@@ -0,0 +1,1069 @@
+#    This file is part of OpenVideoChat.
+#
+#    OpenVideoChat is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    OpenVideoChat is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with OpenVideoChat.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod: `OpenVideoChat/OpenVideoChat.activity/benchmark` --
+        Open Video Chat Pipeline Benchmark
+=======================================================================
+
+Runs the real VideoOutBin and VideoInBin back to back on a synthetic
+source, as fast as they go, and prints the framerate and CPU time.
+
+The CPU budget is whatever the process may run on; pin it with taskset,
+e.g. to compare threading on a dual-core XO:
+
+    taskset -c 0,1 python benchmark.py --codec vp8 --threads 1 2
+
+--multicast sends a live stream to a multicast group on loopback and
+adds receiver processes one by one, checking that the sender's CPU time
+and bitrate stay flat as they join.
+
+    python benchmark.py --multicast --receivers 0 1 2 4
+
+--bandwidth sends a live stream through the impairment proxy capped at
+each of the given kbit/s in turn, BANDWIDTH_STEP_SECONDS each, or as
+--trace says, and checks that the bandwidth estimate, with the encoder
+following it, settles on every rate in a few seconds.
+
+    python benchmark.py --bandwidth 600 150 400
+    python benchmark.py --bandwidth --trace steps.trace --seed 2
+
+--rate-control does the same with the RateController alone retuning
+the encoder from RTCP receiver reports, no bandwidth estimate, and
+checks the encoder bitrate follows each cap, on average, once settled.
+
+    python benchmark.py --rate-control 300 100 250
+
+--protection runs the same seeded impairments (a profile, or --trace)
+against a call with no protection, ULPFEC, RTX and both, and reports
+the frames that never got decoded for each.
+
+    python benchmark.py --protection "loss=0.05,burst=2,delay=30" --seed 1
+
+--roi encodes a skin coloured ball moving over a detailed still
+background at the same bitrate with and without region of interest
+encoding (video_analysis.py, needs NumPy), and compares the PSNR of the
+decoded ball, the "hands".
+
+    python benchmark.py --codec vp8 --roi 150
+
+--latency runs a call over loopback with the capture time stamped into
+every frame (latency.py) and reports percentiles of the glass-to-glass
+latency and of each stage on the way, failing if no stamp comes back
+or the median is over --max-latency ms.  Headless, for CI.
+
+    python benchmark.py --latency 10 --max-latency 400
+
+--impair (a profile, see impairment.py) or --trace runs the video of
+the latency call through the impairment proxy, seeded with --seed.
+
+    python benchmark.py --latency 20 --impair mesh-busy --seed 3
+
+--suite sweeps every available codec over resolutions, framerates,
+threads and encoder speed (bitrates for audio), each configuration in a
+process of its own, and writes fps, CPU time per frame, bitrate and
+peak memory to a JSON file to compare runs over time.
+
+    python benchmark.py --suite results.json
+"""
+
+
+# External Imports
+import os
+import sys
+import time
+import argparse
+import subprocess
+import math
+import json
+import platform
+import resource
+import gi
+gi.require_version('Gst', '1.0')
+gi.require_version('GstVideo', '1.0')
+gi.require_version('GstRtp', '1.0')
+from gi.repository import Gst
+from gi.repository import GstVideo
+from gi.repository import GstRtp
+from gi.repository import GLib
+
+
+# Local Imports
+import gst_codecs
+from gst_codecs import set_element_property
+from gst_bins import VideoOutBin
+from gst_bins import VideoInBin
+from gst_bins import AudioOutBin
+from gst_bins import AudioInBin
+import transport
+from transport import RtpTransport
+from bandwidth import BandwidthEstimator
+import rate_control
+from rate_control import RateController
+from latency import LatencyStats
+from latency import StampReader
+from latency import Timeline
+from latency import stamp_age
+import impairment
+from impairment import ImpairmentProxy
+from impairment import Profile
+import video_analysis
+from video_analysis import numpy
+
+
+# Synthetic source, 'ball' keeps the encoder busy with motion
+SOURCE_CAPS = "video/x-raw,format=I420,width=%d,height=%d,framerate=%d/1"
+FRAMES = 300
+
+# Multicast scenario: receivers to measure with, seconds per measurement,
+# and how much the sender may grow over no receivers and still be flat
+MULTICAST_GROUP = "239.255.42.42"
+MULTICAST_RECEIVERS = [0, 1, 2, 4]
+MULTICAST_SECONDS = 5
+FLAT_MARGIN = 0.2
+
+# Bandwidth scenario: seconds each rate of the trace is held when only
+# rates are given, and how close to the capped rate the estimate must be
+# CONVERGE_SECONDS after each step and stay until the next
+BANDWIDTH_STEP_SECONDS = 15
+CONVERGE_SECONDS = 5
+CONVERGE_MARGIN = 0.25
+
+# Rate control scenario: seconds each cap is held, seconds after a step
+# the encoder must be within RATE_MARGIN of the cap, on average, and the
+# controller's ceiling over the highest cap
+RATE_STEP_SECONDS = 30
+RATE_SETTLE_SECONDS = 15
+RATE_MARGIN = 0.5
+RATE_HEADROOM = 2
+
+# Protection scenario: the impairments, seconds each mode runs, and the
+# modes compared, (name, fec, rtx)
+PROTECTION_PROFILE = "loss=0.05,burst=2,delay=30"
+PROTECTION_SECONDS = 20
+PROTECTION_MODES = [("off", False, False), ("fec", True, False),
+        ("rtx", False, True), ("both", True, True)]
+
+# Region of interest scenario: a skin coloured (ARGB) ball over a zone
+# plate, frames to encode and the bitrate (kbit/s) both runs get
+SKIN_ARGB = 0xffe0ac8c
+ROI_FRAMES = 150
+ROI_BITRATE = 150
+
+# Suite: what is swept for video, the audio bitrates (kbit/s), and the
+# length of each run; audio goes in buffers of about 20 ms
+SUITE_RESOLUTIONS = [(160, 120), (320, 240), (640, 480)]
+SUITE_FRAMERATES = [15, 30]
+SUITE_THREADS = [1, 2]
+SUITE_SPEEDS = ["fast", "quality"]
+SUITE_AUDIO_BITRATES = [16, 24, 32]
+SUITE_AUDIO_BUFFERS = 500
+AUDIO_BUFFER_MS = 20
+
+# Latency scenario: seconds to measure, and the checkpoints each frame
+# is timed at, each stage being the time from the one before
+LATENCY_SECONDS = 10
+CHECKPOINTS = ["capture", "stamped", "encoded", "sent", "arrived",
+        "released", "decoded", "displayed"]
+
+
+def allowed_cpus():
+    # Linux only, reflects taskset
+    try:
+        for line in open("/proc/self/status"):
+            if line.startswith("Cpus_allowed_list:"):
+                return line.split(":")[1].strip()
+    except IOError:
+        pass
+    return "?"
+
+
+def build_video_pipeline(codec, threads=1, width=320, height=240,
+        framerate=15, frames=FRAMES, speed=None):
+    """
+    Return the pipeline and its VideoOutBin; speed is "fast" or
+    "quality", None for the codec's default.
+    """
+    pipeline = Gst.Pipeline()
+
+    video_src = Gst.ElementFactory.make("videotestsrc", None)
+    set_element_property(video_src, "pattern", "ball")
+    video_src.set_property("num-buffers", frames)
+    pipeline.add(video_src)
+
+    video_caps = Gst.ElementFactory.make("capsfilter", None)
+    video_caps.set_property("caps", Gst.caps_from_string(
+            SOURCE_CAPS % (width, height, framerate)))
+    pipeline.add(video_caps)
+
+    video_out = VideoOutBin(codec, threads)
+    if speed is not None:
+        codec.set_speed(video_out.video_enc, speed == "fast")
+    pipeline.add(video_out)
+
+    # Not synchronised to the clock, so it runs flat out
+    video_sink = Gst.ElementFactory.make("fakesink", None)
+    video_sink.set_property("sync", False)
+    video_in = VideoInBin(codec, threads, video_sink)
+    pipeline.add(video_in)
+
+    video_src.link(video_caps)
+    video_caps.link(video_out)
+    video_out.link(video_in)
+    return pipeline, video_out
+
+
+def build_audio_pipeline(codec, bitrate=None, buffers=SUITE_AUDIO_BUFFERS):
+    """
+    Return the pipeline and its AudioOutBin, pink noise through the
+    encoder and decoder as fast as they go.
+    """
+    pipeline = Gst.Pipeline()
+
+    rate = Gst.caps_from_string(codec.raw_caps).get_structure(0) \
+            .get_int("rate")[1]
+    audio_src = Gst.ElementFactory.make("audiotestsrc", None)
+    set_element_property(audio_src, "wave", "pink-noise")
+    audio_src.set_property("samplesperbuffer", rate * AUDIO_BUFFER_MS // 1000)
+    audio_src.set_property("num-buffers", buffers)
+    audio_out = AudioOutBin(codec, audio_src)
+    if bitrate is not None:
+        codec.set_bitrate(audio_out.audio_enc, bitrate)
+    pipeline.add(audio_out)
+
+    audio_sink = Gst.ElementFactory.make("fakesink", None)
+    audio_sink.set_property("sync", False)
+    audio_in = AudioInBin(codec, sink=audio_sink)
+    pipeline.add(audio_in)
+    audio_out.link(audio_in)
+    return pipeline, audio_out
+
+
+def run(pipeline, frames=FRAMES):
+    """
+    Play pipeline to EOS and return (fps, cpu seconds per frame).
+    """
+    cpu_start = os.times()
+    wall_start = time.time()
+
+    pipeline.set_state(Gst.State.PLAYING)
+    message = pipeline.get_bus().timed_pop_filtered(Gst.CLOCK_TIME_NONE,
+            Gst.MessageType.EOS | Gst.MessageType.ERROR)
+    pipeline.set_state(Gst.State.NULL)
+
+    wall = time.time() - wall_start
+    cpu_end = os.times()
+    cpu = (cpu_end[0] - cpu_start[0]) + (cpu_end[1] - cpu_start[1])
+
+    if message.type == Gst.MessageType.ERROR:
+        err, debug = message.parse_error()
+        raise RuntimeError("%s: %s" % (err, debug))
+    return frames / wall, cpu / frames
+
+
+def build_live_sender(codec, stamp=False):
+    pipeline = Gst.Pipeline()
+
+    # Live, so the sender works at the call's pace, not flat out
+    video_src = Gst.ElementFactory.make("videotestsrc", None)
+    set_element_property(video_src, "pattern", "ball")
+    video_src.set_property("is-live", True)
+    pipeline.add(video_src)
+
+    video_caps = Gst.ElementFactory.make("capsfilter", "source_caps")
+    video_caps.set_property("caps", Gst.caps_from_string(
+            SOURCE_CAPS % (320, 240, 15)))
+    pipeline.add(video_caps)
+
+    video_out = VideoOutBin(codec, stamp=stamp)
+    pipeline.add(video_out)
+    video_src.link(video_caps)
+    video_caps.link(video_out)
+    return pipeline, video_out
+
+
+def build_multicast_sender(codec, group):
+    pipeline, video_out = build_live_sender(codec)
+    rtp = RtpTransport(pipeline)
+    rtp.set_multicast(group)
+    rtp.add_send_session(transport.VIDEO_SESSION, video_out, None,
+            transport.VIDEO_RTP_PORT, transport.VIDEO_RTCP_PORT,
+            transport.VIDEO_RTCP_RR_PORT)
+    return pipeline, rtp
+
+
+def receive(codec, group, seconds=0):
+    """
+    One multicast receiver, decoding into a fakesink for seconds (0 for
+    until killed).
+    """
+    pipeline = Gst.Pipeline()
+    video_in = VideoInBin(codec, 1, Gst.ElementFactory.make("fakesink", None))
+    pipeline.add(video_in)
+
+    rtp = RtpTransport(pipeline)
+    rtp.set_multicast(group)
+    rtp.add_recv_session(transport.VIDEO_SESSION, video_in, codec.rtp_caps(),
+            transport.VIDEO_RTP_PORT, transport.VIDEO_RTCP_PORT,
+            transport.VIDEO_RTCP_RR_PORT)
+
+    pipeline.set_state(Gst.State.PLAYING)
+    timeout = seconds * Gst.SECOND if seconds else Gst.CLOCK_TIME_NONE
+    pipeline.get_bus().timed_pop_filtered(timeout, Gst.MessageType.ERROR)
+    pipeline.set_state(Gst.State.NULL)
+
+
+def run_multicast(codec, group, receivers, seconds=MULTICAST_SECONDS):
+    """
+    Return (receivers, sender cpu share, kbit/s sent) for every count of
+    receiver processes.  Only this process, the sender, is timed.
+    """
+    pipeline, rtp = build_multicast_sender(codec, group)
+    sent = [0]
+
+    def on_packet(pad, info):
+        sent[0] += info.get_buffer().get_size()
+        return Gst.PadProbeReturn.OK
+    rtp.rtpbin.get_static_pad("send_rtp_src_%d" % transport.VIDEO_SESSION) \
+            .add_probe(Gst.PadProbeType.BUFFER, on_packet)
+
+    bus = pipeline.get_bus()
+    pipeline.set_state(Gst.State.PLAYING)
+    children = []
+    results = []
+    try:
+        for count in receivers:
+            while len(children) < count:
+                children.append(subprocess.Popen([sys.executable,
+                        os.path.abspath(__file__), "--codec", codec.name,
+                        "--receive", group]))
+
+            # Let them join and the encoder settle, then measure
+            bus.timed_pop_filtered(Gst.SECOND, Gst.MessageType.ERROR)
+            sent[0] = 0
+            cpu_start = os.times()
+            wall_start = time.time()
+            message = bus.timed_pop_filtered(seconds * Gst.SECOND,
+                    Gst.MessageType.ERROR)
+            wall = time.time() - wall_start
+            cpu_end = os.times()
+            if message is not None:
+                err, debug = message.parse_error()
+                raise RuntimeError("%s: %s" % (err, debug))
+
+            cpu = (cpu_end[0] - cpu_start[0]) + (cpu_end[1] - cpu_start[1])
+            results.append((count, cpu / wall, sent[0] * 8 / wall / 1000))
+    finally:
+        pipeline.set_state(Gst.State.NULL)
+        for child in children:
+            child.terminate()
+            child.wait()
+    return results
+
+
+def rate_steps(rates, seconds=BANDWIDTH_STEP_SECONDS):
+    # A trace holding each kbit/s of rates for seconds
+    return [(index * seconds, Profile(kbps=kbps))
+            for index, kbps in enumerate(rates)]
+
+
+def schedule_seconds(schedule):
+    # How long to run a trace: its last step gets as long as the others
+    if len(schedule) < 2:
+        return BANDWIDTH_STEP_SECONDS
+    return int(schedule[-1][0] + schedule[-1][0] / (len(schedule) - 1))
+
+
+def start_proxy(codec, schedule, seed=0):
+    # The video RTP of a loopback call through the impairment proxy
+    proxy = ImpairmentProxy(schedule, seed, ports=[transport.VIDEO_RTP_PORT],
+            clock_rates={transport.VIDEO_RTP_PORT: codec.clock_rate})
+    proxy.start()
+    return proxy
+
+
+def settled_rates(schedule, rates, settle=CONVERGE_SECONDS):
+    """
+    The rates (kbit/s at the end of second 1, 2, ...) at least settle
+    seconds into each capped step of schedule: [(cap, [rates])].
+    """
+    steps = []
+    for index, (start, profile) in enumerate(schedule):
+        if profile.kbps <= 0:
+            continue
+        end = len(rates)
+        if index + 1 < len(schedule):
+            end = min(end, int(schedule[index + 1][0]))
+        steps.append((profile.kbps, [rate for second, rate in
+                enumerate(rates, 1) if start + settle <= second <= end]))
+    return steps
+
+
+def build_proxied_call(codec, proxy, twcc=False, fec=False, rtx=False):
+    """
+    A live loopback video call whose RTP goes through proxy: (sender,
+    its VideoOutBin, its RtpTransport, receiver, its VideoInBin).  fec
+    sends FEC_PERCENTAGE of ULPFEC from the start, rtx retransmits on
+    NACK.
+    """
+    sender, video_out = build_live_sender(codec)
+    send_rtp = RtpTransport(sender)
+    if twcc:
+        send_rtp.add_twcc(video_out.video_pay)
+    if fec or rtx:
+        send_rtp.protect_session(transport.VIDEO_SESSION, codec.payload,
+                fec, rtx)
+    send_rtp.add_send_session(transport.VIDEO_SESSION, video_out,
+            "127.0.0.1", proxy.listen_port(transport.VIDEO_RTP_PORT),
+            transport.VIDEO_RTCP_PORT, transport.VIDEO_RTCP_RR_PORT)
+    if fec:
+        send_rtp.set_fec_percentage(transport.VIDEO_SESSION,
+                transport.FEC_PERCENTAGE)
+
+    receiver = Gst.Pipeline()
+    video_in = VideoInBin(codec, 1, Gst.ElementFactory.make("fakesink", None))
+    receiver.add(video_in)
+    recv_rtp = RtpTransport(receiver)
+    if fec or rtx:
+        recv_rtp.protect_session(transport.VIDEO_SESSION, codec.payload,
+                fec, rtx)
+    recv_rtp.add_recv_session(transport.VIDEO_SESSION, video_in,
+            codec.rtp_caps(), transport.VIDEO_RTP_PORT,
+            transport.VIDEO_RTCP_PORT, transport.VIDEO_RTCP_RR_PORT,
+            "127.0.0.1")
+    return sender, video_out, send_rtp, receiver, video_in
+
+
+def sample_seconds(pipelines, seconds, sample):
+    # Play pipelines for seconds and return sample() at the end of each
+    samples = []
+    loop = GLib.MainLoop()
+
+    def on_second():
+        samples.append(sample())
+        if len(samples) >= seconds:
+            loop.quit()
+            return False
+        return True
+
+    for pipeline in pipelines:
+        pipeline.set_state(Gst.State.PLAYING)
+    GLib.timeout_add_seconds(1, on_second)
+    try:
+        loop.run()
+    finally:
+        for pipeline in pipelines:
+            pipeline.set_state(Gst.State.NULL)
+    return samples
+
+
+def run_bandwidth(codec, schedule, seconds, seed=0):
+    """
+    Return the bandwidth estimate at the end of every second of a call
+    through the impairment proxy running schedule.
+    """
+    proxy = start_proxy(codec, schedule, seed)
+    sender, video_out, send_rtp, receiver, video_in = build_proxied_call(
+            codec, proxy, twcc=True)
+
+    # The encoder follows the estimate directly, as an out bin would
+    estimator = BandwidthEstimator(send_rtp, transport.VIDEO_SESSION)
+    send_rtp.connect_reports(transport.VIDEO_SESSION, estimator.rtcp_stats)
+    estimator.subscribe(lambda bitrate:
+            codec.set_bitrate(video_out.video_enc, bitrate))
+
+    try:
+        estimates = sample_seconds([receiver, sender], seconds,
+                estimator.get_estimate)
+    finally:
+        estimator.stop()
+        proxy.stop()
+    if estimator.twcc:
+        print("estimated from TWCC feedback")
+    return estimates
+
+
+def run_rate_control(codec, schedule, seconds, seed=0):
+    """
+    Return the encoder bitrate the RateController has set at the end of
+    every second of a call through the impairment proxy running
+    schedule, driven by nothing but the RTCP receiver reports.
+    """
+    proxy = start_proxy(codec, schedule, seed)
+    sender, video_out, send_rtp, receiver, video_in = build_proxied_call(
+            codec, proxy)
+
+    # Room above every cap, so the link and not the ceiling holds it
+    ceiling = max(profile.kbps for start, profile in schedule) or \
+            rate_control.MAX_BITRATE
+    controller = RateController(video_out.video_enc, codec,
+            max_bitrate=int(ceiling * RATE_HEADROOM),
+            capsfilter=sender.get_by_name("source_caps"))
+    send_rtp.connect_reports(transport.VIDEO_SESSION, controller.rtcp_stats)
+
+    try:
+        return sample_seconds([receiver, sender], seconds,
+                lambda: codec.get_bitrate(video_out.video_enc))
+    finally:
+        proxy.stop()
+
+
+def run_protection(codec, schedule, seconds, seed=0, fec=False, rtx=False):
+    """
+    Return (frames encoded, frames decoded) in seconds of a call through
+    the impairment proxy running schedule, with FEC and/or RTX.
+    """
+    proxy = start_proxy(codec, schedule, seed)
+    sender, video_out, send_rtp, receiver, video_in = build_proxied_call(
+            codec, proxy, fec=fec, rtx=rtx)
+    frames = {"encoded": 0, "decoded": 0}
+
+    def counter(name):
+        def on_frame(pad, info):
+            if not info.get_buffer().has_flags(Gst.BufferFlags.HEADER):
+                frames[name] += 1
+            return Gst.PadProbeReturn.OK
+        return on_frame
+    video_out.video_enc.get_static_pad("src").add_probe(
+            Gst.PadProbeType.BUFFER, counter("encoded"))
+    video_in.video_decode.get_static_pad("src").add_probe(
+            Gst.PadProbeType.BUFFER, counter("decoded"))
+
+    try:
+        sample_seconds([receiver, sender], seconds, lambda: None)
+    finally:
+        proxy.stop()
+    return frames["encoded"], frames["decoded"]
+
+
+def frame_planes(sample):
+    # Copies of the Y, Cb and Cr planes of an I420 sample
+    info = GstVideo.VideoInfo()
+    info.from_caps(sample.get_caps())
+    buffer = sample.get_buffer()
+    mapped, data = buffer.map(Gst.MapFlags.READ)
+    planes = []
+    for index, (width, height) in enumerate([(info.width, info.height),
+            (info.width // 2, info.height // 2),
+            (info.width // 2, info.height // 2)]):
+        stride = info.stride[index]
+        plane = numpy.frombuffer(data.data, numpy.uint8,
+                count=stride * height, offset=info.offset[index])
+        planes.append(plane.reshape(height, stride)[:, :width].copy())
+    buffer.unmap(data)
+    return buffer.pts, planes
+
+
+def build_roi_pipeline(codec, roi, bitrate, frames=ROI_FRAMES):
+    """
+    Return the pipeline and two dicts it fills, pts -> planes, of the
+    source frames and of the same frames after encode and decode.
+    """
+    pipeline = Gst.Pipeline()
+
+    background = Gst.ElementFactory.make("videotestsrc", None)
+    set_element_property(background, "pattern", "zone-plate")
+    background.set_property("kx2", 20)
+    background.set_property("ky2", 20)
+    background.set_property("num-buffers", frames)
+    pipeline.add(background)
+    background_caps = Gst.ElementFactory.make("capsfilter", None)
+    background_caps.set_property("caps", Gst.caps_from_string(
+            SOURCE_CAPS % (320, 240, 15)))
+    pipeline.add(background_caps)
+
+    hand = Gst.ElementFactory.make("videotestsrc", None)
+    set_element_property(hand, "pattern", "ball")
+    hand.set_property("foreground-color", SKIN_ARGB)
+    hand.set_property("background-color", 0)
+    hand.set_property("num-buffers", frames)
+    pipeline.add(hand)
+    hand_caps = Gst.ElementFactory.make("capsfilter", None)
+    hand_caps.set_property("caps", Gst.caps_from_string(
+            "video/x-raw,format=BGRA,width=320,height=240,framerate=15/1"))
+    pipeline.add(hand_caps)
+
+    mixer = Gst.ElementFactory.make("compositor", None)
+    pipeline.add(mixer)
+    video_convert = Gst.ElementFactory.make("videoconvert", None)
+    pipeline.add(video_convert)
+    video_caps = Gst.ElementFactory.make("capsfilter", None)
+    video_caps.set_property("caps", Gst.caps_from_string(
+            SOURCE_CAPS % (320, 240, 15)))
+    pipeline.add(video_caps)
+    tee = Gst.ElementFactory.make("tee", None)
+    pipeline.add(tee)
+
+    background.link(background_caps)
+    background_caps.link(mixer)
+    hand.link(hand_caps)
+    hand_caps.link(mixer)
+    mixer.link(video_convert)
+    video_convert.link(video_caps)
+    video_caps.link(tee)
+
+    frames = ({}, {})
+
+    def on_sample(sink, collected):
+        pts, planes = frame_planes(sink.emit("pull-sample"))
+        collected[pts] = planes
+        return Gst.FlowReturn.OK
+
+    def make_sink(collected):
+        sink = Gst.ElementFactory.make("appsink", None)
+        sink.set_property("caps", Gst.caps_from_string(
+                "video/x-raw,format=I420"))
+        sink.set_property("sync", False)
+        sink.set_property("emit-signals", True)
+        sink.connect("new-sample", on_sample, collected)
+        return sink
+
+    # Source frames as they are
+    queue = Gst.ElementFactory.make("queue", None)
+    pipeline.add(queue)
+    reference = make_sink(frames[0])
+    pipeline.add(reference)
+    tee.link(queue)
+    queue.link(reference)
+
+    # And through the encoder and back
+    queue = Gst.ElementFactory.make("queue", None)
+    pipeline.add(queue)
+    video_out = VideoOutBin(codec, roi=roi)
+    codec.set_bitrate(video_out.video_enc, bitrate)
+    pipeline.add(video_out)
+    video_in = VideoInBin(codec, 1, make_sink(frames[1]))
+    pipeline.add(video_in)
+    tee.link(queue)
+    queue.link(video_out)
+    video_out.link(video_in)
+    return pipeline, frames[0], frames[1]
+
+
+def hand_psnr(references, decoded):
+    """
+    PSNR (dB) of the luma of the skin coloured pixels, over every frame
+    that came back.
+    """
+    squared = 0.0
+    pixels = 0
+    for pts, (luma, cb, cr) in references.items():
+        if pts not in decoded:
+            continue
+        skin = (cb >= video_analysis.SKIN_CB[0]) & \
+                (cb <= video_analysis.SKIN_CB[1]) & \
+                (cr >= video_analysis.SKIN_CR[0]) & \
+                (cr <= video_analysis.SKIN_CR[1])
+        skin = skin.repeat(2, axis=0).repeat(2, axis=1)
+        error = luma.astype(numpy.int32) - decoded[pts][0]
+        squared += (error[skin] ** 2).sum()
+        pixels += skin.sum()
+    if not pixels:
+        return None
+    if not squared:
+        return float("inf")
+    return 10 * math.log10(255 ** 2 / (squared / pixels))
+
+
+def run_latency(codec, seconds=LATENCY_SECONDS, proxy=None):
+    """
+    Return the LatencyStats of a call over loopback, and the number of
+    frames whose stamp could not be read.  The video goes through proxy,
+    an ImpairmentProxy, if given.
+    """
+    timeline = Timeline(CHECKPOINTS, LatencyStats())
+    send_stamps = {}
+    rtp_stamps = {}
+    recv_stamps = {}
+
+    def rtp_timestamp(buffer):
+        mapped, rtp = GstRtp.RTPBuffer.map(buffer, Gst.MapFlags.READ)
+        if not mapped:
+            return None
+        timestamp = rtp.get_timestamp()
+        rtp.unmap()
+        return timestamp
+
+    def on_stamp(pts, stamp):
+        send_stamps[pts] = stamp
+        timeline.mark(stamp, "capture", time.time() - stamp_age(stamp))
+        timeline.mark(stamp, "stamped")
+
+    def on_encoded(pad, info):
+        stamp = send_stamps.get(info.get_buffer().pts)
+        if stamp is not None:
+            timeline.mark(stamp, "encoded")
+        return Gst.PadProbeReturn.OK
+
+    def on_sent(pad, info):
+        buffer = info.get_buffer()
+        stamp = send_stamps.get(buffer.pts)
+        if stamp is not None:
+            rtp_stamps[rtp_timestamp(buffer)] = stamp
+            timeline.mark(stamp, "sent")
+        return Gst.PadProbeReturn.OK
+
+    def on_arrived(pad, info):
+        stamp = rtp_stamps.get(rtp_timestamp(info.get_buffer()))
+        if stamp is not None:
+            timeline.mark(stamp, "arrived")
+        return Gst.PadProbeReturn.OK
+
+    def on_released(pad, info):
+        buffer = info.get_buffer()
+        stamp = rtp_stamps.get(rtp_timestamp(buffer))
+        if stamp is not None:
+            recv_stamps[buffer.pts] = stamp
+            timeline.mark(stamp, "released")
+        return Gst.PadProbeReturn.OK
+
+    def on_decoded(pad, info):
+        stamp = recv_stamps.get(info.get_buffer().pts)
+        if stamp is not None:
+            timeline.mark(stamp, "decoded")
+        return Gst.PadProbeReturn.OK
+
+    def on_displayed(stamp, displayed):
+        timeline.mark(stamp, "displayed", displayed)
+
+    sender, video_out = build_live_sender(codec, stamp=True)
+    video_out.stamper.on_stamp = on_stamp
+    video_out.video_enc.get_static_pad("src").add_probe(
+            Gst.PadProbeType.BUFFER, on_encoded)
+    rtp_port = transport.VIDEO_RTP_PORT
+    if proxy is not None:
+        rtp_port = proxy.listen_port(rtp_port)
+    send_rtp = RtpTransport(sender)
+    send_rtp.add_send_session(transport.VIDEO_SESSION, video_out,
+            "127.0.0.1", rtp_port, transport.VIDEO_RTCP_PORT,
+            transport.VIDEO_RTCP_RR_PORT)
+    send_rtp.rtpbin.get_static_pad("send_rtp_src_%d" %
+            transport.VIDEO_SESSION).add_probe(Gst.PadProbeType.BUFFER,
+            on_sent)
+
+    # Displayed on the clock, as a real sink would
+    receiver = Gst.Pipeline()
+    video_sink = Gst.ElementFactory.make("fakesink", None)
+    video_sink.set_property("sync", True)
+    video_in = VideoInBin(codec, 1, video_sink)
+    receiver.add(video_in)
+    recv_rtp = RtpTransport(receiver)
+    recv_rtp.add_recv_session(transport.VIDEO_SESSION, video_in,
+            codec.rtp_caps(), transport.VIDEO_RTP_PORT,
+            transport.VIDEO_RTCP_PORT, transport.VIDEO_RTCP_RR_PORT,
+            "127.0.0.1")
+    recv_rtp.rtpbin.get_static_pad("recv_rtp_sink_%d" %
+            transport.VIDEO_SESSION).add_probe(Gst.PadProbeType.BUFFER,
+            on_arrived)
+    video_in.get_static_pad("sink").add_probe(Gst.PadProbeType.BUFFER,
+            on_released)
+    video_in.video_decode.get_static_pad("src").add_probe(
+            Gst.PadProbeType.BUFFER, on_decoded)
+    reader = StampReader(video_sink.get_static_pad("sink"), timeline.stats,
+            on_displayed)
+
+    pipelines = [receiver, sender]
+    for pipeline in pipelines:
+        pipeline.set_state(Gst.State.PLAYING)
+    try:
+        message = sender.get_bus().timed_pop_filtered(seconds * Gst.SECOND,
+                Gst.MessageType.ERROR)
+        if message is not None:
+            err, debug = message.parse_error()
+            raise RuntimeError("%s: %s" % (err, debug))
+    finally:
+        for pipeline in pipelines:
+            pipeline.set_state(Gst.State.NULL)
+    return timeline.stats, reader.unreadable
+
+
+def suite_configs():
+    # Every configuration of every codec this machine has
+    configs = []
+    for name in gst_codecs.available_codecs("video"):
+        for width, height in SUITE_RESOLUTIONS:
+            for framerate in SUITE_FRAMERATES:
+                for threads in SUITE_THREADS:
+                    for speed in SUITE_SPEEDS:
+                        configs.append({"media": "video", "codec": name,
+                                "width": width, "height": height,
+                                "framerate": framerate, "threads": threads,
+                                "speed": speed})
+    for name in gst_codecs.available_codecs("audio"):
+        for bitrate in SUITE_AUDIO_BITRATES:
+            configs.append({"media": "audio", "codec": name,
+                    "bitrate": bitrate})
+    return configs
+
+
+def run_config(config, frames=FRAMES):
+    """
+    Run one suite configuration and return its results: frames per
+    second (buffers for audio), CPU ms per frame, kbit/s of RTP out of
+    the bin over the media time encoded, and the peak memory of the
+    process.
+    """
+    codec = gst_codecs.get_codec(config["codec"])
+    if config["media"] == "video":
+        pipeline, out_bin = build_video_pipeline(codec, config["threads"],
+                config["width"], config["height"], config["framerate"],
+                frames, config["speed"])
+        encoder = out_bin.video_enc
+    else:
+        frames = SUITE_AUDIO_BUFFERS
+        pipeline, out_bin = build_audio_pipeline(codec, config["bitrate"],
+                frames)
+        encoder = out_bin.audio_enc
+
+    # Media time into the encoder, bytes out of the bin
+    encoded = [0]
+    sent = [0]
+
+    def on_raw(pad, info):
+        duration = info.get_buffer().duration
+        if duration != Gst.CLOCK_TIME_NONE:
+            encoded[0] += duration
+        return Gst.PadProbeReturn.OK
+    encoder.get_static_pad("sink").add_probe(Gst.PadProbeType.BUFFER, on_raw)
+
+    def on_packet(pad, info):
+        sent[0] += info.get_buffer().get_size()
+        return Gst.PadProbeReturn.OK
+    out_bin.get_static_pad("src").add_probe(Gst.PadProbeType.BUFFER,
+            on_packet)
+
+    fps, cpu = run(pipeline, frames)
+    kbps = None
+    if encoded[0]:
+        kbps = round(sent[0] * 8.0 * Gst.SECOND / encoded[0] / 1000, 1)
+    return {"fps": round(fps, 2), "cpu_ms_per_frame": round(cpu * 1000, 3),
+            "kbps": kbps,
+            "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def run_suite(path, frames=FRAMES):
+    """
+    Run every configuration in a process of its own, so the peak memory
+    is its own, and write the results to path.  Returns the number of
+    configurations that failed.
+    """
+    results = []
+    failed = 0
+    for config in suite_configs():
+        child = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                "--frames", str(frames), "--suite-run", json.dumps(config)],
+                stdout=subprocess.PIPE)
+        output = child.communicate()[0]
+        result = dict(config)
+        if child.returncode == 0:
+            result.update(json.loads(output.decode("utf-8").splitlines()[-1]))
+        else:
+            result["error"] = child.returncode
+            failed += 1
+        print(json.dumps(result, sort_keys=True))
+        results.append(result)
+
+    report = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "host": platform.node(), "machine": platform.machine(),
+            "cpus": allowed_cpus(), "gstreamer": Gst.version_string(),
+            "frames": frames, "results": results}
+    output = open(path, "w")
+    json.dump(report, output, indent=2, sort_keys=True)
+    output.close()
+    return failed
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--codec", default=gst_codecs.DEFAULT_VIDEO_CODEC)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2])
+    parser.add_argument("--frames", type=int, default=FRAMES)
+    parser.add_argument("--multicast", nargs="?", const=MULTICAST_GROUP,
+            metavar="GROUP")
+    parser.add_argument("--receivers", type=int, nargs="+",
+            default=MULTICAST_RECEIVERS)
+    parser.add_argument("--seconds", type=int, default=MULTICAST_SECONDS)
+    parser.add_argument("--receive", metavar="GROUP", help=argparse.SUPPRESS)
+    parser.add_argument("--bandwidth", type=int, nargs="*", metavar="KBPS")
+    parser.add_argument("--rate-control", type=int, nargs="*",
+            metavar="KBPS")
+    parser.add_argument("--protection", nargs="?", const=PROTECTION_PROFILE,
+            metavar="PROFILE")
+    parser.add_argument("--roi", type=int, nargs="?", const=ROI_BITRATE,
+            metavar="KBPS")
+    parser.add_argument("--latency", type=int, nargs="?",
+            const=LATENCY_SECONDS, metavar="SECONDS")
+    parser.add_argument("--max-latency", type=float, metavar="MS")
+    parser.add_argument("--impair", metavar="PROFILE")
+    parser.add_argument("--trace", metavar="FILE")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--suite", metavar="RESULTS")
+    parser.add_argument("--suite-run", metavar="CONFIG",
+            help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    Gst.init(None)
+    codec = gst_codecs.get_codec(args.codec)
+    if args.receive:
+        return receive(codec, args.receive)
+    if args.suite_run:
+        print(json.dumps(run_config(json.loads(args.suite_run), args.frames)))
+        return 0
+    if args.suite:
+        failed = run_suite(args.suite, args.frames)
+        print("results in %s, %d failed" % (args.suite, failed))
+        return 1 if failed else 0
+    print("codec %s, cpus %s" % (codec.name, allowed_cpus()))
+
+    if args.multicast:
+        results = run_multicast(codec, args.multicast, args.receivers,
+                args.seconds)
+        base_cpu, base_kbps = results[0][1:]
+        flat = True
+        for count, cpu, kbps in results:
+            print("receivers %d: %.1f%% cpu, %.0f kbit/s sent" %
+                    (count, cpu * 100, kbps))
+            if cpu > base_cpu * (1 + FLAT_MARGIN) or \
+                    kbps > base_kbps * (1 + FLAT_MARGIN):
+                flat = False
+        print("sender %s" % ("flat" if flat else "NOT flat"))
+        return 0 if flat else 1
+
+    if args.latency:
+        proxy = None
+        if args.impair or args.trace:
+            if args.trace:
+                schedule = impairment.load_trace(args.trace)
+            else:
+                schedule = [(0, impairment.parse_profile(args.impair))]
+            proxy = ImpairmentProxy(schedule, args.seed,
+                    ports=[transport.VIDEO_RTP_PORT])
+            proxy.start()
+        try:
+            stats, unreadable = run_latency(codec, args.latency, proxy)
+        finally:
+            if proxy is not None:
+                proxy.stop()
+        if proxy is not None:
+            counts = proxy.stats()[transport.VIDEO_RTP_PORT]
+            print("impaired: %d packets, %d lost, %d queue drops, "
+                    "%d reordered" % (counts["packets"], counts["lost"],
+                    counts["queue_drops"], counts["reordered"]))
+        for stage, samples, percentiles in stats.report():
+            print("%-10s %4d frames  %s" % (stage, samples,
+                    "  ".join("p%d %6.1f ms" % (percent, percentiles[percent])
+                    for percent in sorted(percentiles))))
+        print("unreadable stamps: %d" % unreadable)
+        glass = stats.percentile("glass", 50)
+        if glass is None:
+            print("latency NOT measured")
+            return 1
+        if args.max_latency is not None and glass * 1000 > args.max_latency:
+            print("latency over %.0f ms" % args.max_latency)
+            return 1
+        return 0
+
+    if args.roi:
+        if codec.roi_param is None or not video_analysis.available():
+            print("region of interest encoding needs NumPy and a codec "
+                    "that takes it, e.g. --codec vp8")
+            return 1
+        psnr = {}
+        for roi in (False, True):
+            pipeline, references, decoded = build_roi_pipeline(codec, roi,
+                    args.roi)
+            run(pipeline, ROI_FRAMES)
+            psnr[roi] = hand_psnr(references, decoded)
+            print("%s at %d kbit/s: hands %.2f dB PSNR" %
+                    ("roi" if roi else "plain", args.roi, psnr[roi] or 0))
+        better = psnr[True] is not None and psnr[False] is not None and \
+                psnr[True] > psnr[False]
+        print("roi %s" % ("better" if better else "NOT better"))
+        return 0 if better else 1
+
+    if args.bandwidth is not None:
+        if args.trace:
+            schedule = impairment.load_trace(args.trace)
+        else:
+            schedule = rate_steps(args.bandwidth or [600, 150, 400])
+        estimates = run_bandwidth(codec, schedule, schedule_seconds(schedule),
+                args.seed)
+        print("estimates %s" % " ".join(str(e) for e in estimates))
+        converged = True
+        for kbps, settled in settled_rates(schedule, estimates):
+            errors = [abs(estimate - kbps) / float(kbps)
+                    for estimate in settled]
+            if not errors or max(errors) > CONVERGE_MARGIN:
+                converged = False
+            print("capped %d kbit/s: %s" % (kbps, "%.0f%% off once settled" %
+                    (max(errors) * 100) if errors else "too short to settle"))
+        print("estimate %s" % ("converged" if converged else "NOT converged"))
+        return 0 if converged else 1
+
+    if args.protection:
+        if args.trace:
+            schedule = impairment.load_trace(args.trace)
+        else:
+            schedule = [(0, impairment.parse_profile(args.protection))]
+
+        # Every mode meets the same seeded impairments
+        residual = {}
+        for name, fec, rtx in PROTECTION_MODES:
+            encoded, decoded = run_protection(codec, schedule,
+                    PROTECTION_SECONDS, args.seed, fec, rtx)
+            residual[name] = 1 - decoded / float(max(encoded, 1))
+            print("%-5s %4d frames encoded, %4d decoded, %.1f%% lost" %
+                    (name, encoded, decoded, residual[name] * 100))
+        helped = all(residual[name] <= residual["off"]
+                for name, fec, rtx in PROTECTION_MODES)
+        print("protection %s" % ("helped" if helped else "did NOT help"))
+        return 0 if helped else 1
+
+    if args.rate_control is not None:
+        if args.trace:
+            schedule = impairment.load_trace(args.trace)
+        else:
+            schedule = rate_steps(args.rate_control or [300, 100, 250],
+                    RATE_STEP_SECONDS)
+        bitrates = run_rate_control(codec, schedule,
+                schedule_seconds(schedule), args.seed)
+        print("encoder kbit/s %s" % " ".join(str(b) for b in bitrates))
+
+        # The controller saws under the cap, so its average must follow
+        followed = True
+        for kbps, settled in settled_rates(schedule, bitrates,
+                RATE_SETTLE_SECONDS):
+            if not settled:
+                print("capped %d kbit/s: too short to settle" % kbps)
+                followed = False
+                continue
+            average = sum(settled) / float(len(settled))
+            error = abs(average - kbps) / float(kbps)
+            print("capped %d kbit/s: encoder at %.0f on average, %.0f%% off" %
+                    (kbps, average, error * 100))
+            if error > RATE_MARGIN:
+                followed = False
+        print("bitrate %s the cap" % ("followed" if followed else
+                "did NOT follow"))
+        return 0 if followed else 1
+
+    for threads in args.threads:
+        fps, cpu = run(build_video_pipeline(codec, threads,
+                frames=args.frames)[0], args.frames)
+        print("threads %d: %.1f fps, %.1f ms cpu/frame" %
+                (threads, fps, cpu * 1000))
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
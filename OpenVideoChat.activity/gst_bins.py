@@ -22,141 +22,447 @@
 
 
 # External Imports
-import logger
+import time
+import logging
 import gi
 gi.require_version('Gst', '1.0')
+gi.require_version('GstVideo', '1.0')
 from gi.repository import Gst
+from gi.repository import GstVideo
 
 
 # Define Logger for Logging
 logger = logging.getLogger('ovc-activity')
 
 
+# Local Imports
+import video_analysis
+from latency import Stamper
+
+
+def caps_formats(caps):
+    """
+    caps with only the media type and format of each structure kept, so
+    that sizes and rates do not get in the way of comparing formats.
+    """
+    formats = Gst.Caps.new_empty()
+    for i in range(caps.get_size()):
+        structure = caps.get_structure(i).copy()
+        for name in ("width", "height", "framerate", "pixel-aspect-ratio"):
+            structure.remove_field(name)
+        formats.append_structure(structure)
+    return formats.simplify()
+
+
+def element_caps(element, pad_name):
+    """
+    What a pad can really take or give, or None if the element cannot be
+    used here.  Sources and sinks only know once they have opened their
+    device, so the element is brought to READY.
+    """
+    if element.set_state(Gst.State.READY) == Gst.StateChangeReturn.FAILURE:
+        element.set_state(Gst.State.NULL)
+        return None
+    return element.get_static_pad(pad_name).query_caps(None)
+
+
+def conversion_needed(src_caps, sink_caps):
+    """
+    True unless every format src_caps may produce is one sink_caps takes.
+    """
+    if sink_caps.is_any():
+        return False
+    return not caps_formats(src_caps).is_subset(caps_formats(sink_caps))
+
+
+def describe_formats(caps):
+    formats = []
+    for i in range(caps.get_size()):
+        structure = caps.get_structure(i)
+        value = structure.get_value("format")
+        if isinstance(value, str):
+            formats.append(value)
+        elif value is not None:
+            formats.extend(value)
+        else:
+            formats.append(structure.get_name())
+    return ",".join(formats)
+
+
+def choose_format(src_caps, sink_caps):
+    """
+    The first format the source offers that the sink takes as it is, or
+    None if there is none.
+    """
+    src_formats = caps_formats(src_caps)
+    sink_formats = caps_formats(sink_caps)
+    for i in range(src_formats.get_size()):
+        structure = src_formats.get_structure(i)
+        value = structure.get_value("format")
+        candidates = [value] if isinstance(value, str) else list(value or [])
+        for candidate in candidates:
+            caps = Gst.Caps.from_string("%s,format=%s" %
+                    (structure.get_name(), candidate))
+            if caps.is_subset(sink_formats):
+                return candidate
+    return None
+
+
+# Shortest time between two keyframes forced by receivers, in seconds
+KEYFRAME_MIN_INTERVAL = 0.5
+
+
+###############
+# BranchPolicy
+###############
+class BranchPolicy(object):
+    """
+    How the queue at the head of a tee branch behaves when the branch
+    falls behind.  A leaky branch drops its oldest buffers instead of
+    blocking the tee, and so every other branch.  0 means no limit.
+    """
+
+    def __init__(self, leaky=True, max_buffers=0, max_bytes=0, max_time=0):
+        self.leaky = leaky
+        self.max_buffers = max_buffers
+        self.max_bytes = max_bytes
+        self.max_time = max_time
+
+    def apply(self, queue):
+        queue.set_property("leaky", 2 if self.leaky else 0)
+        queue.set_property("max-size-buffers", self.max_buffers)
+        queue.set_property("max-size-bytes", self.max_bytes)
+        queue.set_property("max-size-time", self.max_time)
+
+
+# The local display only ever needs the newest frame; the sender may fall a
+# few frames behind before it drops any
+PREVIEW_POLICY = BranchPolicy(leaky=True, max_buffers=1)
+SEND_POLICY = BranchPolicy(leaky=True, max_buffers=3,
+        max_time=200 * Gst.MSECOND)
+
+
+############
+# TeeBranch
+############
+class TeeBranch(object):
+    """
+    A queue hanging off a tee under a BranchPolicy, counting the buffers
+    it drops.
+    """
+
+    def __init__(self, pipeline, tee, policy):
+        self.drops = 0
+        self.queue = Gst.ElementFactory.make("queue", None)
+        self.set_policy(policy)
+        self.queue.connect("overrun", self._on_overrun)
+        pipeline.add(self.queue)
+        tee.link(self.queue)
+
+    def set_policy(self, policy):
+        self.policy = policy
+        policy.apply(self.queue)
+
+    def link(self, element):
+        return self.queue.link(element)
+
+    def _on_overrun(self, queue):
+        # Leaky queues drop right after signalling
+        if self.policy.leaky:
+            self.drops += 1
+
+
+def link_threaded(bin, upstream, downstream, threads=1):
+    """
+    Link two elements, through a queue when running multi-threaded so
+    that each side gets a streaming thread of its own.
+    """
+    if threads <= 1:
+        return upstream.link(downstream)
+
+    queue = Gst.ElementFactory.make("queue", None)
+    queue.set_property("max-size-buffers", 3)
+    queue.set_property("max-size-bytes", 0)
+    queue.set_property("max-size-time", 0)
+    bin.add(queue)
+    return upstream.link(queue) and queue.link(downstream)
+
+
 ##############
 # VideoOutBin
 ##############
 class VideoOutBin(Gst.Bin):
-    def __init__(self):
-        super(VideoOutBin, self).__init__(ip)
-
-		# Set IP
-        self.ip = ip
-
-        # Add theora Encoder
-        video_enc = Gst.ElementFactory.make("theoraenc", None)
-        video_enc.set_property("bitrate", 50)
-        video_enc.set_property("speed-level", 2)
+    def __init__(self, codec, threads=1, convert=False, roi=False,
+            stamp=False):
+        super(VideoOutBin, self).__init__()
+        self.codec = codec
+        self.analyzer = None
+
+        self.muted = False
+        self.unmute_latency = None
+        self._unmute_time = None
+        self.keyframes_forced = 0
+        self.keyframes_refused = 0
+        self._last_keyframe = 0
+
+        # Mute drops frames here so the encoder stays warm
+        video_valve = Gst.ElementFactory.make("valve", None)
+        self.add(video_valve)
+        self.video_valve = video_valve
+
+        # Add Encoder
+        video_enc = codec.make_encoder(threads)
         self.add(video_enc)
-
-        # Add rtptheorapay
-        video_rtp_theora_pay = Gst.ElementFactory.make("rtptheorapay", None)
-        self.add(video_rtp_theora_pay)
-
-        # Add udpsink
-        udp_sink = Gst.ElementFactory.make("udpsink", None)
-        udp_sink.set_property("host", self.ip)
-        udp_sink.set_property("port", 5004)
-        self.add(udp_sink)
-
-        # Link Elements
-        video_tee.link(video_enc)
-        video_enc.link(video_rtp_theora_pay)
-        video_rtp_theora_pay.link(udp_sink)
+        self.video_enc = video_enc
+
+        # Mark hands and face for encoders that take regions of interest
+        encoder_input = video_enc
+        if roi and codec.roi_param is not None and video_analysis.available():
+            self.analyzer = video_analysis.RegionAnalyzer(codec)
+            self.add(self.analyzer)
+            self.analyzer.link(video_enc)
+            encoder_input = self.analyzer
+
+        # Latency instrumentation, the capture time drawn into each frame
+        self.stamper = None
+        if stamp:
+            self.stamper = Stamper()
+            self.add(self.stamper)
+            self.stamper.link(encoder_input)
+            encoder_input = self.stamper
+        self.encoder_input = encoder_input
+
+        # Only when the tee carries a format this encoder does not take
+        if convert:
+            video_convert = Gst.ElementFactory.make("videoconvert", None)
+            self.add(video_convert)
+            video_valve.link(video_convert)
+            video_convert.link(encoder_input)
+        else:
+            video_valve.link(encoder_input)
+
+        # Add Payloader
+        video_pay = codec.make_payloader()
+        self.add(video_pay)
+        self.video_pay = video_pay
+
+        # Link Elements, with a thread boundary between encode and send
+        link_threaded(self, video_enc, video_pay, threads)
+
+        # PLI/FIR from receivers arrive here as force-key-unit events
+        video_enc.get_static_pad("src").add_probe(
+                Gst.PadProbeType.EVENT_UPSTREAM, self._on_upstream_event)
+
+        # Raw video in from the tee, RTP out to the rtpbin
+        self.add_pad(Gst.GhostPad.new("sink",
+                video_valve.get_static_pad("sink")))
+        self.add_pad(Gst.GhostPad.new("src", video_pay.get_static_pad("src")))
+
+    def set_muted(self, muted):
+        if muted == self.muted:
+            return
+        self.muted = muted
+
+        if not muted:
+            # Time to the first keyframe out, the first frame the far end
+            # can show
+            self._unmute_time = time.time()
+            self.video_enc.get_static_pad("src").add_probe(
+                    Gst.PadProbeType.BUFFER, self._on_unmuted_frame)
+        self.video_valve.set_property("drop", muted)
+
+        if not muted:
+            # Resume on a keyframe rather than wait for the next one
+            self.request_keyframe()
+
+    def request_keyframe(self):
+        # Our own requests are never refused
+        self._last_keyframe = 0
+        self.video_enc.get_static_pad("src").send_event(
+                GstVideo.video_event_new_upstream_force_key_unit(
+                Gst.CLOCK_TIME_NONE, True, 0))
+
+    def _on_upstream_event(self, pad, info):
+        if not GstVideo.video_event_is_force_key_unit(info.get_event()):
+            return Gst.PadProbeReturn.OK
+
+        # A lossy receiver could otherwise have us send nothing but
+        # keyframes
+        now = time.time()
+        if now - self._last_keyframe < KEYFRAME_MIN_INTERVAL:
+            self.keyframes_refused += 1
+            return Gst.PadProbeReturn.DROP
+        self._last_keyframe = now
+        self.keyframes_forced += 1
+        return Gst.PadProbeReturn.OK
+
+    def _on_unmuted_frame(self, pad, info):
+        if info.get_buffer().has_flags(Gst.BufferFlags.DELTA_UNIT):
+            return Gst.PadProbeReturn.OK
+
+        self.unmute_latency = time.time() - self._unmute_time
+        logger.info("Video unmute to first keyframe: %d ms" %
+                (self.unmute_latency * 1000))
+        return Gst.PadProbeReturn.REMOVE
 
 
 ##############
 # AudioOutBin
 ##############
 class AudioOutBin(Gst.Bin):
-    def __init__(self):
+    def __init__(self, codec, src=None):
         super(AudioOutBin, self).__init__()
+        self.codec = codec
 
-        self.ip = None
-
-        # Audio Source
-        audio_src = Gst.ElementFactory.make("autoaudiosrc", None)
+        # Audio Source, the microphone unless given one
+        audio_src = src
+        if audio_src is None:
+            audio_src = Gst.ElementFactory.make("autoaudiosrc", None)
         self.add(audio_src)
 
-        # Opus Audio Encoding
-        audio_enc = Gst.ElementFactory.make("speexenc", None)
+        # Convert to the format the encoder wants
+        audio_convert = Gst.ElementFactory.make("audioconvert", None)
+        self.add(audio_convert)
+        audio_resample = Gst.ElementFactory.make("audioresample", None)
+        self.add(audio_resample)
+        audio_caps = Gst.ElementFactory.make("capsfilter", None)
+        audio_caps.set_property("caps", Gst.caps_from_string(codec.raw_caps))
+        self.add(audio_caps)
+
+        # Mute drops samples here so the encoder stays warm
+        audio_valve = Gst.ElementFactory.make("valve", None)
+        self.add(audio_valve)
+        self.audio_valve = audio_valve
+
+        # Audio Encoding
+        audio_enc = codec.make_encoder()
         self.add(audio_enc)
+        self.audio_enc = audio_enc
 
-        # RTP Opus Pay
-        audio_rtp = Gst.ElementFactory.make("rtpspeexpay", None)
+        # RTP Pay
+        audio_rtp = codec.make_payloader()
         self.add(audio_rtp)
 
-        # Audio UDP Sink
-        udp_sink = Gst.ElementFactory.make("udpsink", None)
-        udp_sink.set_property("host", self.ip)
-        udp_sink.set_property("port", 5005)
-        self.add(udp_sink)
-
         # Link Elements
-        audio_src.link(audio_enc)
+        audio_src.link(audio_convert)
+        audio_convert.link(audio_resample)
+        audio_resample.link(audio_caps)
+        audio_caps.link(audio_valve)
+        audio_valve.link(audio_enc)
         audio_enc.link(audio_rtp)
-        audio_rtp.link(udp_sink)
+
+        # RTP out to the rtpbin
+        self.add_pad(Gst.GhostPad.new("src", audio_rtp.get_static_pad("src")))
+
+    def set_muted(self, muted):
+        self.audio_valve.set_property("drop", muted)
 
 
 #############
 # VideoInBin
 #############
 class VideoInBin(Gst.Bin):
-    def __init__(self):
+    def __init__(self, codec, threads=1, sink=None, mixed=False):
         super(VideoInBin, self).__init__()
+        self.codec = codec
 
-        # Video Source
-        video_src = Gst.ElementFactory.make("udpsrc", None)
-        video_src.set_property("port", 5004)
-        self.add(video_src)
-
-        # RTP Theora Depay
-        video_rtp_theora_depay = Gst.ElementFactory.make("rtptheoradepay", None)
-        self.add(video_rtp_theora_depay)
+        # RTP Depay
+        video_depay = codec.make_depayloader()
+        self.add(video_depay)
 
         # Video decode
-        video_decode = Gst.ElementFactory.make("theoradec", None)
+        video_decode = codec.make_decoder(threads)
         self.add(video_decode)
-        video_rtp_theora_depay.link(video_decode)
-
-        # Change colorspace for xvimagesink
-        video_convert = Gst.ElementFactory.make("videoconvert", None)
-        self.add(video_convert)
-
-        # Send video to xviamgesink
-        xvimage_sink = Gst.ElementFactory.make("autovideosink", None)
-        self.add(xvimage_sink)
-
-        # Link Elements
-        video_src.link(video_rtp_theora_depay)
-        video_decode.link(video_convert)
-        video_convert.link(xvimage_sink)
+        video_depay.link(video_decode)
+        self.video_decode = video_decode
+
+        # Send video to xviamgesink, or (mixed) through a queue to a src
+        # pad for the compositor, which scales and converts on its own
+        if mixed:
+            sink = Gst.ElementFactory.make("queue", None)
+        elif sink is None:
+            sink = Gst.ElementFactory.make("autovideosink", None)
+        self.add(sink)
+        self.sink = sink
+
+        # Change colorspace only if the sink cannot show what the decoder
+        # gives, link with a thread boundary between decode and display
+        decoder_caps = video_decode.get_static_pad("src").query_caps(None)
+        sink_caps = element_caps(sink, "sink") or Gst.Caps.new_any()
+        self.converts = conversion_needed(decoder_caps, sink_caps)
+        self.decoder_caps = decoder_caps
+        self.sink_caps = sink_caps
+        if self.converts:
+            logger.info("Incoming video converts %s -> %s" % (
+                    describe_formats(decoder_caps),
+                    describe_formats(sink_caps)))
+            video_convert = Gst.ElementFactory.make("videoconvert", None)
+            self.add(video_convert)
+            link_threaded(self, video_decode, video_convert, threads)
+            video_convert.link(sink)
+        else:
+            link_threaded(self, video_decode, sink, threads)
+
+        # Ask the sender for a keyframe whenever the jitter buffer gives
+        # up on a packet, rather than decode garbage until the next one
+        self.keyframes_requested = 0
+        video_depay.get_static_pad("sink").add_probe(
+                Gst.PadProbeType.EVENT_DOWNSTREAM, self._on_downstream_event)
+
+        # RTP in from the rtpbin jitter buffer
+        self.add_pad(Gst.GhostPad.new("sink",
+                video_depay.get_static_pad("sink")))
+        if mixed:
+            self.add_pad(Gst.GhostPad.new("src", sink.get_static_pad("src")))
+
+    def _on_downstream_event(self, pad, info):
+        event = info.get_event()
+        if event.type == Gst.EventType.CUSTOM_DOWNSTREAM and \
+                event.has_name("GstRTPPacketLost"):
+            # rtpsession turns this into a PLI, or a FIR for all-headers
+            self.keyframes_requested += 1
+            pad.push_event(GstVideo.video_event_new_upstream_force_key_unit(
+                    Gst.CLOCK_TIME_NONE, False, self.keyframes_requested))
+        return Gst.PadProbeReturn.OK
 
 
 #############
 # AudioInBin
 #############
 class AudioInBin(Gst.Bin):
-    def __init__(self):
+    def __init__(self, codec, mixed=False, sink=None):
         super(AudioInBin, self).__init__()
+        self.codec = codec
 
-        # Audio Source
-        audio_src = Gst.ElementFactory.make("udpsrc", None)
-        audio_src.set_property("port", 5005)
-        self.add(audio_src)
-
-        # RTP Opus Depay
-        audio_rtp = Gst.ElementFactory.make("rtpspeexdepay", None)
+        # RTP Depay
+        audio_rtp = codec.make_depayloader()
         self.add(audio_rtp)
 
-        # Opus Audio Decoding
-        audio_dec = Gst.ElementFactory.make("speexdec", None)
+        # Audio Decoding
+        audio_dec = codec.make_decoder()
         self.add(audio_dec)
 
-        # Audio Sink
-        audio_sink = Gst.ElementFactory.make("autoaudiosink", None)
-        self.add(audio_sink)
+        # Resample for whatever the sink takes
+        audio_convert = Gst.ElementFactory.make("audioconvert", None)
+        self.add(audio_convert)
+        audio_resample = Gst.ElementFactory.make("audioresample", None)
+        self.add(audio_resample)
 
         # Link Elements
-        audio_src.link(audio_rtp)
         audio_rtp.link(audio_dec)
-        audio_dec.link(audio_sink)
\ No newline at end of file
+        audio_dec.link(audio_convert)
+        audio_convert.link(audio_resample)
+
+        # RTP in from the rtpbin jitter buffer
+        self.add_pad(Gst.GhostPad.new("sink", audio_rtp.get_static_pad("sink")))
+
+        # Audio Sink, or out to the mixer
+        if mixed:
+            self.add_pad(Gst.GhostPad.new("src",
+                    audio_resample.get_static_pad("src")))
+            return
+        audio_sink = sink
+        if audio_sink is None:
+            audio_sink = Gst.ElementFactory.make("autoaudiosink", None)
+        self.add(audio_sink)
+        audio_resample.link(audio_sink)
@@ -0,0 +1,272 @@
+#    This file is part of OpenVideoChat.
+#
+#    OpenVideoChat is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    OpenVideoChat is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with OpenVideoChat.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod: `OpenVideoChat/OpenVideoChat.activity/gst_codecs` --
+        Open Video Chat Codec Registry
+=======================================================================
+
+Each codec is described once here; gst_bins builds the encode and decode
+chains from the descriptor, so adding a codec does not touch the bins.
+"""
+
+
+# External Imports
+import logging
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+
+# Define Logger for Logging
+logger = logging.getLogger('ovc-activity')
+
+
+########
+# Codec
+########
+class Codec(object):
+    """
+    Describes the elements and tuning knobs of one RTP codec.
+
+    bitrate_property/bitrate_scale map kbit/s onto the encoder, and
+    speed_property takes speed_values[0] when squeezed for CPU or bits and
+    speed_values[1] when there is room for quality.  options maps the
+    names used by GSTStack.set_audio_option onto encoder properties.
+    encoder_threads/decoder_threads name the thread count properties, if
+    the codec can split work, and threaded_properties are set on the
+    encoder along with it.  roi_param, for encoders that take
+    GstVideoRegionOfInterestMeta, is the parameter structure of a region,
+    with a %d for its quality offset (see video_analysis.py).
+    """
+
+    def __init__(self, name, media, encoding_name, clock_rate, payload,
+            encoder, payloader, depayloader, decoder,
+            encoder_properties=None, payloader_properties=None,
+            decoder_properties=None, raw_caps=None,
+            bitrate_property="bitrate", bitrate_scale=1,
+            speed_property=None, speed_values=None, options=None,
+            encoder_threads=None, decoder_threads=None,
+            threaded_properties=None, roi_param=None):
+        self.name = name
+        self.media = media
+        self.encoding_name = encoding_name
+        self.clock_rate = clock_rate
+        self.payload = payload
+        self.encoder = encoder
+        self.payloader = payloader
+        self.depayloader = depayloader
+        self.decoder = decoder
+        self.encoder_properties = encoder_properties or {}
+        self.payloader_properties = payloader_properties or {}
+        self.decoder_properties = decoder_properties or {}
+        self.raw_caps = raw_caps
+        self.bitrate_property = bitrate_property
+        self.bitrate_scale = bitrate_scale
+        self.speed_property = speed_property
+        self.speed_values = speed_values
+        self.options = options or {}
+        self.encoder_threads = encoder_threads
+        self.decoder_threads = decoder_threads
+        self.threaded_properties = threaded_properties or {}
+        self.roi_param = roi_param
+
+    def available(self):
+        for factory in (self.encoder, self.payloader, self.depayloader,
+                self.decoder):
+            if Gst.ElementFactory.find(factory) is None:
+                return False
+        return True
+
+    def rtp_caps(self):
+        caps = ("application/x-rtp,media=(string)%s,clock-rate=(int)%d,"
+                "encoding-name=(string)%s,payload=(int)%d" % (self.media,
+                self.clock_rate, self.encoding_name, self.payload))
+        if self.media == "video":
+            # Lets rtpsession send picture loss and full intra requests,
+            # and NACKs for retransmission
+            caps += (",rtcp-fb-nack-pli=(boolean)true,"
+                    "rtcp-fb-ccm-fir=(boolean)true,rtcp-fb-nack=(boolean)true")
+        return caps
+
+    def make_encoder(self, threads=1):
+        encoder = make_element(self.encoder, self.encoder_properties)
+        if threads > 1 and self.encoder_threads is not None:
+            encoder.set_property(self.encoder_threads, threads)
+            for name, value in self.threaded_properties.items():
+                set_element_property(encoder, name, value)
+        return encoder
+
+    def encoder_sink_caps(self):
+        return make_element(self.encoder).get_static_pad("sink").query_caps(None)
+
+    def make_payloader(self):
+        payloader = make_element(self.payloader, self.payloader_properties)
+        payloader.set_property("pt", self.payload)
+        return payloader
+
+    def make_depayloader(self):
+        return make_element(self.depayloader)
+
+    def make_decoder(self, threads=1):
+        decoder = make_element(self.decoder, self.decoder_properties)
+        if threads > 1 and self.decoder_threads is not None:
+            decoder.set_property(self.decoder_threads, threads)
+        return decoder
+
+    def get_bitrate(self, encoder):
+        return encoder.get_property(self.bitrate_property) / self.bitrate_scale
+
+    def set_bitrate(self, encoder, bitrate):
+        encoder.set_property(self.bitrate_property,
+                int(bitrate * self.bitrate_scale))
+
+    def set_option(self, encoder, name, value):
+        if name == "bitrate":
+            self.set_bitrate(encoder, value)
+        elif name in self.options:
+            set_element_property(encoder, self.options[name], value)
+        else:
+            logger.warning("%s has no option %s" % (self.name, name))
+
+    def set_speed(self, encoder, fast=True):
+        if self.speed_property is None:
+            return
+        set_element_property(encoder, self.speed_property,
+                self.speed_values[0 if fast else 1])
+
+
+def set_element_property(element, name, value):
+    # Enum and flag values are given by nick, e.g. speed-preset=ultrafast
+    if isinstance(value, str):
+        Gst.util_set_object_arg(element, name, value)
+    else:
+        element.set_property(name, value)
+
+
+def make_element(factory, properties=None):
+    element = Gst.ElementFactory.make(factory, None)
+    for name, value in (properties or {}).items():
+        set_element_property(element, name, value)
+    return element
+
+
+###########
+# Registry
+###########
+# In order of preference.  vp8enc's token-partitions is an enum, the log2
+# of the partition count: 1 gives 2 partitions, one per decoder thread on
+# a dual core XO
+VIDEO_CODECS = [
+    Codec("vp8", "video", "VP8", 90000, 97,
+            "vp8enc", "rtpvp8pay", "rtpvp8depay", "vp8dec",
+            encoder_properties={
+                "deadline": 1,
+                "cpu-used": 8,
+                "end-usage": "cbr",
+                "lag-in-frames": 0,
+                "keyframe-max-dist": 60,
+                "target-bitrate": 256000},
+            bitrate_property="target-bitrate", bitrate_scale=1000,
+            speed_property="cpu-used", speed_values=(16, 4),
+            encoder_threads="threads", decoder_threads="threads",
+            threaded_properties={"token-partitions": 1},
+            roi_param="roi/vpx,delta-q=(int)%d"),
+    Codec("h264", "video", "H264", 90000, 98,
+            "x264enc", "rtph264pay", "rtph264depay", "avdec_h264",
+            encoder_properties={
+                "speed-preset": "ultrafast",
+                "tune": "zerolatency",
+                "key-int-max": 60,
+                "bitrate": 256},
+            payloader_properties={"config-interval": 1},
+            speed_property="speed-preset",
+            speed_values=("ultrafast", "superfast"),
+            encoder_threads="threads", decoder_threads="max-threads",
+            threaded_properties={"sliced-threads": True}),
+    Codec("theora", "video", "THEORA", 90000, 96,
+            "theoraenc", "rtptheorapay", "rtptheoradepay", "theoradec",
+            encoder_properties={"bitrate": 50, "speed-level": 2},
+            payloader_properties={"config-interval": 1},
+            speed_property="speed-level", speed_values=(2, 1)),
+]
+
+AUDIO_CODECS = [
+    # In-band FEC lets the receiver rebuild a lost frame from the next one,
+    # DTX drops to a packet every 400 ms while nobody speaks
+    Codec("opus", "audio", "OPUS", 48000, 111,
+            "opusenc", "rtpopuspay", "rtpopusdepay", "opusdec",
+            encoder_properties={
+                "bitrate": 24000,
+                "audio-type": "voice",
+                "frame-size": "20",
+                "inband-fec": True,
+                "packet-loss-percentage": 10,
+                "dtx": True},
+            payloader_properties={"dtx": True},
+            decoder_properties={"use-inband-fec": True, "plc": True},
+            raw_caps="audio/x-raw,rate=48000,channels=1",
+            bitrate_scale=1000,
+            options={
+                "frame_size": "frame-size",
+                "fec": "inband-fec",
+                "loss": "packet-loss-percentage",
+                "dtx": "dtx"}),
+    Codec("speex", "audio", "SPEEX", 16000, 110,
+            "speexenc", "rtpspeexpay", "rtpspeexdepay", "speexdec",
+            raw_caps="audio/x-raw,rate=16000,channels=1",
+            bitrate_scale=1000),
+]
+
+CODECS = dict((codec.name, codec) for codec in VIDEO_CODECS + AUDIO_CODECS)
+
+DEFAULT_VIDEO_CODEC = "theora"
+DEFAULT_AUDIO_CODEC = "opus"
+
+
+def get_codec(name):
+    return CODECS[name]
+
+
+def codec_for_caps(caps):
+    """
+    The codec whose decoder takes caps (e.g. video/x-vp8 from a demuxer),
+    or None.
+    """
+    for codec in VIDEO_CODECS + AUDIO_CODECS:
+        factory = Gst.ElementFactory.find(codec.decoder)
+        if factory is not None and factory.can_sink_any_caps(caps):
+            return codec
+    return None
+
+
+def available_codecs(media):
+    """
+    Names of the codecs of one media type that this machine can both send
+    and receive, most preferred first.
+    """
+    codecs = VIDEO_CODECS if media == "video" else AUDIO_CODECS
+    return [codec.name for codec in codecs if codec.available()]
+
+
+def negotiate(local, remote):
+    """
+    Pick the codec both ends will use: the first of the offerer's list
+    (local) that the answerer (remote) also supports.  Both sides call this
+    with the offerer's list first so they reach the same answer.
+    """
+    for name in local:
+        if name in remote:
+            return name
+    return None
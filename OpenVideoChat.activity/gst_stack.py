@@ -27,7 +27,10 @@
 """
 
 # External Imports
-import logger
+import os
+import math
+import time
+import logging
 import gi
 gi.require_version('Gst', '1.0')
 from gi.repository import Gst
@@ -35,6 +38,27 @@ from gst_bins import VideoOutBin
 from gst_bins import AudioOutBin
 from gst_bins import VideoInBin
 from gst_bins import AudioInBin
+from gst_bins import TeeBranch
+from gst_bins import link_threaded
+from gst_bins import element_caps
+from gst_bins import choose_format
+from gst_bins import conversion_needed
+from gst_bins import describe_formats
+from gst_bins import PREVIEW_POLICY
+from gst_bins import SEND_POLICY
+import gst_codecs
+from rate_control import RateController
+from rate_control import MotionPriority
+from rate_control import FrameGate
+from bandwidth import BandwidthEstimator
+import video_analysis
+from video_analysis import StillGate
+from latency import LatencyStats
+from latency import StampReader
+import transport
+from transport import RtpTransport
+from transport import SIMULCAST_LAYERS
+from recorder import Recorder
 
 
 # Define Logger for Logging
@@ -46,44 +70,185 @@ logger = logging.getLogger('ovc-activity')
 #Define the limitations of the device
 CAPS = "video/x-raw,width=320,height=240,framerate=15/1"
 
+#Size of the grid N-way calls are composited into
+GRID_WIDTH = 640
+GRID_HEIGHT = 480
+
+
+##############
+# Participant
+##############
+class Participant(object):
+    """
+    The receive chain of one peer in an N-way call: an rtpbin of its own on
+    the peer's slot of ports, decoding into a compositor and an audio mixer
+    pad.  Counts what the peer costs, see stats.
+    """
+
+    def __init__(self, pipeline, ip, slot, video_codec, audio_codec,
+            video_mixer, audio_mixer, threads=1, latency=transport.LATENCY,
+            fec=True, rtx=True, rtcp_ports=(transport.VIDEO_RTCP_RR_PORT,
+            transport.AUDIO_RTCP_RR_PORT)):
+        self.pipeline = pipeline
+        self.ip = ip
+        self.slot = slot
+
+        # Decode into the mixers
+        self.video_in_bin = VideoInBin(video_codec, threads, mixed=True)
+        self.audio_in_bin = AudioInBin(audio_codec, mixed=True)
+        pipeline.add(self.video_in_bin)
+        pipeline.add(self.audio_in_bin)
+        self.video_pad = video_mixer.get_request_pad("sink_%u")
+        self.audio_pad = audio_mixer.get_request_pad("sink_%u")
+        self.video_in_bin.get_static_pad("src").link(self.video_pad)
+        self.audio_in_bin.get_static_pad("src").link(self.audio_pad)
+
+        # Receive through an rtpbin of its own, reports go back to the peer
+        self.transport = RtpTransport(pipeline, latency)
+        self.transport.protect_session(transport.VIDEO_SESSION,
+                video_codec.payload, fec, rtx)
+        self.transport.add_recv_session(transport.VIDEO_SESSION,
+                self.video_in_bin, video_codec.rtp_caps(),
+                transport.participant_port(transport.VIDEO_RTP_PORT, slot),
+                transport.participant_port(transport.VIDEO_RTCP_PORT, slot),
+                rtcp_ports[0], ip)
+        self.transport.add_recv_session(transport.AUDIO_SESSION,
+                self.audio_in_bin, audio_codec.rtp_caps(),
+                transport.participant_port(transport.AUDIO_RTP_PORT, slot),
+                transport.participant_port(transport.AUDIO_RTCP_PORT, slot),
+                rtcp_ports[1], ip)
+
+        # Count the bytes coming in and the frames decoded
+        self.bytes = 0
+        self.frames = 0
+        self._since = time.time()
+        for in_bin in (self.video_in_bin, self.audio_in_bin):
+            in_bin.get_static_pad("sink").add_probe(Gst.PadProbeType.BUFFER,
+                    self._on_packet)
+        self.video_in_bin.get_static_pad("src").add_probe(
+                Gst.PadProbeType.BUFFER, self._on_frame)
+
+        # The call may already be playing
+        self.video_in_bin.sync_state_with_parent()
+        self.audio_in_bin.sync_state_with_parent()
+        self.transport.sync_state()
+
+    def _on_packet(self, pad, info):
+        self.bytes += info.get_buffer().get_size()
+        return Gst.PadProbeReturn.OK
+
+    def _on_frame(self, pad, info):
+        self.frames += 1
+        return Gst.PadProbeReturn.OK
+
+    def stats(self):
+        """
+        kbit/s received and frames/s decoded since the last call, and the
+        A/V skew in ms.
+        """
+        now = time.time()
+        elapsed = max(now - self._since, 0.001)
+        stats = {"ip": self.ip,
+                "kbps": self.bytes * 8 / elapsed / 1000,
+                "fps": self.frames / elapsed,
+                "av_skew": self.transport.get_av_skew()}
+        self.bytes = 0
+        self.frames = 0
+        self._since = now
+        return stats
+
+    def remove(self, video_mixer, audio_mixer):
+        self.transport.remove()
+        for in_bin, mixer, pad in ((self.video_in_bin, video_mixer,
+                self.video_pad), (self.audio_in_bin, audio_mixer,
+                self.audio_pad)):
+            in_bin.get_static_pad("src").unlink(pad)
+            mixer.release_request_pad(pad)
+            in_bin.set_state(Gst.State.NULL)
+            self.pipeline.remove(in_bin)
+
 
 ###########
 # GSTStack
 ###########
 class GSTStack(object):
 
-    def __init__(self, render_preview, render_incoming):
+    def __init__(self, render_preview, render_incoming, threads=1,
+            max_participants=2):
         Gst.init(None)
         self.render_preview = render_preview
         self.render_incoming = render_incoming
+        self._threads = threads
+        self._max_participants = max_participants
+        self._participants = {}
+        self._relay = None
+        self._multicast = None
+        self._recorder = None
+        self._finishing_recorder = None
+        self._recording_done = None
+        self._video_mixer = None
+        self._audio_mixer = None
+        self._cpu_times = None
         self._out_pipeline = None
         self._in_pipeline = None
         self._audio_out_bin = None
         self._video_out_bin = None
-        self._audio_in_bin = AudioInBin()
-        self._video_in_bin = VideoInBin()
+        self._audio_in_bin = None
+        self._video_in_bin = None
+        self._video_codec = gst_codecs.get_codec(gst_codecs.DEFAULT_VIDEO_CODEC)
+        self._audio_codec = gst_codecs.get_codec(gst_codecs.DEFAULT_AUDIO_CODEC)
         self._video_local_tee = Gst.ElementFactory.make("tee", None)
+        self._video_rate = None
+        self._rate_controller = None
+        self._bandwidth = None
+        self._frame_gate = None
+        self._video_caps = None
+        self._motion_priority = None
+        self._motion_priority_enabled = True
+        self._roi = True
+        self._still_gate = None
+        self._still_skipping_enabled = True
+        self._latency_stamps = False
+        self._latency_stats = LatencyStats()
+        self._stamp_reader = None
+        self._branches = {}
+        self._simulcast = False
+        self._layer_bins = []
+        self._conversions = []
+        self._branch_policies = {"preview": PREVIEW_POLICY, "send": SEND_POLICY}
+        self._out_transport = None
+        self._in_transport = None
+        self._remote_ip = None
+        self._audio_options = {}
+        self._rate_limits = {}
+        self._video_muted = False
+        self._audio_muted = False
+        self._latency = transport.LATENCY
+        self._fec = True
+        self._rtx = True
+        self._fec_percentage = transport.FEC_PERCENTAGE
+        self._fec_auto = True
 
-    #Toggle Video State (args are on or off)
+    #Toggle Video State (args are on or off), the encoders keep running
+    #so turning it back on is close to instant; the state is kept for the
+    #bins built later, when the call starts
     def toggle_video_state(self, start=True):
-        if self._out_pipeline != None:
-            if start:
-                print "Setting video bin state: STATE_PLAYING"
-                self._video_out_bin.set_state(Gst.State.PLAYING)
-            else:
-                print "Setting video bin state: STATE_NULL"
-                self._video_out_bin.set_state(Gst.State.NULL)
-
+        print "Setting video muted: %s" % (not start)
+        self._video_muted = not start
+        for video_out_bin in self._layer_bins:
+            video_out_bin.set_muted(self._video_muted)
 
-    #Toggle Audio State
+    #Toggle Audio State, kept for when the call starts
     def toggle_audio_state(self, start=True):
-        if self._out_pipeline != None:
-            if start:
-                print "Setting audio bin state: STATE_PLAYING"
-                self._audio_out_bin.set_state(Gst.State.PLAYING)
-            else:
-                print "Setting audio bin state: STATE_NULL"
-                self._audio_out_bin.set_state(Gst.State.NULL)
+        print "Setting audio muted: %s" % (not start)
+        self._audio_muted = not start
+        if self._audio_out_bin != None:
+            self._audio_out_bin.set_muted(self._audio_muted)
+
+    #Seconds from the last video unmute to the first keyframe sent
+    def get_unmute_latency(self):
+        if self._video_out_bin != None:
+            return self._video_out_bin.unmute_latency
 
     #Build Preview
     def build_preview(self):
@@ -105,56 +270,162 @@ class GSTStack(object):
         # Video Rate element to allow setting max framerate
         video_rate = Gst.ElementFactory.make("videorate", None)
         self._out_pipeline.add(video_rate)
+        self._video_rate = video_rate
+
+        # Pick a camera format the encoder takes as it is; only convert,
+        # once for every tee branch, when there is none
+        camera_caps = element_caps(video_src, "src") or Gst.Caps.new_any()
+        encoder_caps = self._video_codec.encoder_sink_caps()
+        video_format = choose_format(camera_caps, encoder_caps)
+        video_convert = None
+        if video_format is None:
+            video_format = choose_format(encoder_caps, encoder_caps)
+            self._add_conversion("capture", camera_caps, video_format)
+            video_convert = Gst.ElementFactory.make("videoconvert", None)
+            self._out_pipeline.add(video_convert)
+
+        # Video Scale element so the size can change while playing
+        video_scale = Gst.ElementFactory.make("videoscale", None)
+        self._out_pipeline.add(video_scale)
 
         # Add caps to limit rate and size
         video_caps = Gst.ElementFactory.make("capsfilter", None)
-        video_caps.set_property("caps", Gst.caps_from_string(CAPS))
+        caps = Gst.caps_from_string(CAPS)
+        caps.set_value("format", video_format)
+        video_caps.set_property("caps", caps)
         self._out_pipeline.add(video_caps)
+        self._video_caps = video_caps
 
         # Add tee element
         self._out_pipeline.add(self._video_local_tee)
 
-        # Link Elements
-        video_src.link(video_rate)
-        video_rate.link(video_caps)
+        # Link Elements, scaling off the capture thread when threaded
+        link_threaded(self._out_pipeline, video_src, video_rate, self._threads)
+        if video_convert != None:
+            video_rate.link(video_convert)
+            video_convert.link(video_scale)
+        else:
+            video_rate.link(video_scale)
+        video_scale.link(video_caps)
         video_caps.link(self._video_local_tee)
 
 
         # Preview the Video
-        # Queue element to receive video from tee
-        video_queue = Gst.ElementFactory.make("queue", None)
-        self._out_pipeline.add(video_queue)
-
-        # Change colorspace for ximagesink
-        video_convert = Gst.ElementFactory.make("videoconvert", None)
-        self._out_pipeline.add(video_convert)
+        # Queue element to receive video from tee, leaky so a slow X
+        # server can never hold up the sender
+        video_queue = self._add_branch("preview")
 
-        # Send to ximagesink
-        ximage_sink = Gst.ElementFactory.make("ximagesink", None)
-        self._out_pipeline.add(ximage_sink)
+        # Send to xvimagesink, which shows YUV as it is, or ximagesink
+        preview_sink = None
+        sink_caps = None
+        if Gst.ElementFactory.find("xvimagesink") != None:
+            preview_sink = Gst.ElementFactory.make("xvimagesink", None)
+            sink_caps = element_caps(preview_sink, "sink")
+        if sink_caps == None:
+            preview_sink = Gst.ElementFactory.make("ximagesink", None)
+            sink_caps = element_caps(preview_sink, "sink") or Gst.Caps.new_any()
+        self._out_pipeline.add(preview_sink)
 
-        # Link Elements Again
-        self._video_local_tee.link(video_queue)
-        video_queue.link(video_convert)
-        video_convert.link(ximage_sink)
+        # Change colorspace only if the sink needs it
+        if conversion_needed(caps, sink_caps):
+            self._add_conversion("preview", caps, describe_formats(sink_caps))
+            video_convert = Gst.ElementFactory.make("videoconvert", None)
+            self._out_pipeline.add(video_convert)
+            video_queue.link(video_convert)
+            video_convert.link(preview_sink)
+        else:
+            video_queue.link(preview_sink)
 
 
 
     #Outgoing Pipeline
     def build_outgoing_pipeline(self, ip):
 
-        print "Building outgoing pipeline UDP to %s" % self.ip
+        print "Building outgoing pipeline UDP to %s" % ip
 
-        # Set Bin IPs
-        self._video_out_bin = VideoOutBin(ip)
-        self._audio_out_bin = AudioOutBin(ip)
+        # Build Video/Audio Out Bins, converting only if the codec was
+        # changed to one that does not take the camera format
+        convert = conversion_needed(self._video_caps.get_property("caps"),
+                self._video_codec.encoder_sink_caps())
+        if convert:
+            self._add_conversion("send", self._video_caps.get_property("caps"),
+                    self._video_codec.encoder)
+        self._video_out_bin = VideoOutBin(self._video_codec, self._threads,
+                convert, self._roi, self._latency_stamps)
+        self._audio_out_bin = AudioOutBin(self._audio_codec)
+
+        # Muted before the call, muted from its start
+        self._video_out_bin.set_muted(self._video_muted)
+        self._audio_out_bin.set_muted(self._audio_muted)
 
         # Add Video/Audio Out Bin to Pipeline
         self._out_pipeline.add(self._video_out_bin)
         self._out_pipeline.add(self._audio_out_bin)
 
-        # Link Video Bin to Tee Element
-        self._video_local_tee.link(self._video_out_bin)
+        # Link Video Bin to Tee Element through its own queue
+        self._add_branch("send").link(self._video_out_bin)
+
+        # Send both bins through the rtpbin, video with FEC/RTX repair; an
+        # N-way call sends to every peer, see add_peer
+        nway = self._max_participants > 2
+        self._out_transport = RtpTransport(self._out_pipeline)
+        if self._multicast != None:
+            self._out_transport.set_multicast(*self._multicast)
+        self._out_transport.protect_session(transport.VIDEO_SESSION,
+                self._video_codec.payload, self._fec, self._rtx)
+        self._out_transport.add_twcc(self._video_out_bin.video_pay)
+        self._out_transport.add_send_session(transport.VIDEO_SESSION,
+                self._video_out_bin, ip, transport.VIDEO_RTP_PORT,
+                transport.VIDEO_RTCP_PORT, transport.VIDEO_RTCP_RR_PORT,
+                self._simulcast or nway)
+        self._out_transport.add_send_session(transport.AUDIO_SESSION,
+                self._audio_out_bin, ip, transport.AUDIO_RTP_PORT,
+                transport.AUDIO_RTCP_PORT, transport.AUDIO_RTCP_RR_PORT, nway)
+
+        # Encode the smaller layers off the same tee, a multicast group
+        # only gets the full size stream
+        self._layer_bins = [self._video_out_bin]
+        if self._simulcast and self._multicast == None:
+            for width, height, bitrate in SIMULCAST_LAYERS:
+                self._add_simulcast_layer(width, height, bitrate, convert)
+
+        # Our receiver reports now know where to go
+        self._remote_ip = ip
+        if self._in_transport != None:
+            self._in_transport.set_rtcp_host(ip)
+
+        # Apply audio options set before the call
+        for name, value in self._audio_options.items():
+            self._audio_codec.set_option(self._audio_out_bin.audio_enc,
+                    name, value)
+        self._out_transport.connect_reports(transport.AUDIO_SESSION,
+                self._on_audio_report)
+
+        # Retune the encoder from the receiver's RTCP reports, within the
+        # limits set before the call
+        self._rate_controller = RateController(self._video_out_bin.video_enc,
+                self._video_codec, self._video_rate,
+                capsfilter=self._video_caps, **self._rate_limits)
+        self._out_transport.connect_reports(transport.VIDEO_SESSION,
+                self._on_video_report)
+
+        # Keep the encoder under what the path to the peer carries
+        self._bandwidth = BandwidthEstimator(self._out_transport,
+                transport.VIDEO_SESSION)
+        self._bandwidth.subscribe(self._rate_controller.available_bitrate)
+
+        # Drop whole frames before the encoder, not packets after it
+        self._frame_gate = FrameGate(self._video_out_bin.video_enc,
+                self._video_out_bin.video_pay)
+        self._bandwidth.subscribe(self._frame_gate.available_bitrate)
+        if not self._fec_auto:
+            self._out_transport.set_fec_percentage(transport.VIDEO_SESSION,
+                    self._fec_percentage)
+
+        # Skip the frames of a still picture, then keep the framerate up
+        # for signing at the cost of resolution
+        self.set_still_skipping(self._still_skipping_enabled)
+        self.set_motion_priority(self._motion_priority_enabled)
 
         # # Connect to pipeline bus for signals.
         # bus = self._out_pipeline.get_bus()
@@ -197,11 +468,38 @@ class GSTStack(object):
         print "Building Incoming Video Pipeline"
 
         # Pipeline:
-        # udpsrc -> rtptheoradepay -> theoradec -> ffmpegcolorspace -> xvimagesink
+        # udpsrc -> rtpbin -> rtptheoradepay -> theoradec -> videoconvert -> autovideosink
         self._in_pipeline = Gst.Pipeline()
 
+        # N-way calls mix every participant into one grid and one audio
+        # sink, participants come and go with add_participant
+        if self._max_participants > 2:
+            self._build_mixers()
+            return
+
+        self._video_in_bin = VideoInBin(self._video_codec, self._threads)
+        self._audio_in_bin = AudioInBin(self._audio_codec)
         self._in_pipeline.add(self._video_in_bin)
         self._in_pipeline.add(self._audio_in_bin)
+        if self._latency_stamps:
+            self._stamp_reader = StampReader(
+                    self._video_in_bin.sink.get_static_pad("sink"),
+                    self._latency_stats)
+
+        # Receive both bins through the rtpbin jitter buffers
+        self._in_transport = RtpTransport(self._in_pipeline, self._latency)
+        if self._multicast != None:
+            self._in_transport.set_multicast(*self._multicast)
+        self._in_transport.protect_session(transport.VIDEO_SESSION,
+                self._video_codec.payload, self._fec, self._rtx)
+        self._in_transport.add_recv_session(transport.VIDEO_SESSION,
+                self._video_in_bin, self._video_codec.rtp_caps(),
+                transport.VIDEO_RTP_PORT, transport.VIDEO_RTCP_PORT,
+                transport.VIDEO_RTCP_RR_PORT, self._remote_ip)
+        self._in_transport.add_recv_session(transport.AUDIO_SESSION,
+                self._audio_in_bin, self._audio_codec.rtp_caps(),
+                transport.AUDIO_RTP_PORT, transport.AUDIO_RTCP_PORT,
+                transport.AUDIO_RTCP_RR_PORT, self._remote_ip)
 
         # # Connect to pipeline bus for signals.
         # bus = self._in_pipeline.get_bus()
@@ -232,6 +530,492 @@ class GSTStack(object):
         # bus.connect("message", on_message)
         # bus.connect("sync-message::element", on_sync_message)
 
+    #Video grid and audio mix for N-way calls
+    def _build_mixers(self):
+        # Video: compositor -> capsfilter -> videoconvert -> autovideosink
+        self._video_mixer = Gst.ElementFactory.make("compositor", None)
+        Gst.util_set_object_arg(self._video_mixer, "background", "black")
+        self._in_pipeline.add(self._video_mixer)
+        grid_caps = Gst.ElementFactory.make("capsfilter", None)
+        grid_caps.set_property("caps", Gst.caps_from_string(
+                "video/x-raw,width=%d,height=%d" % (GRID_WIDTH, GRID_HEIGHT)))
+        self._in_pipeline.add(grid_caps)
+        video_convert = Gst.ElementFactory.make("videoconvert", None)
+        self._in_pipeline.add(video_convert)
+        video_sink = Gst.ElementFactory.make("autovideosink", None)
+        self._in_pipeline.add(video_sink)
+        self._video_mixer.link(grid_caps)
+        grid_caps.link(video_convert)
+        video_convert.link(video_sink)
+
+        # Audio: audiomixer (liveadder in 0.10) -> audioconvert -> sink
+        self._audio_mixer = Gst.ElementFactory.make("audiomixer", None)
+        self._in_pipeline.add(self._audio_mixer)
+        audio_convert = Gst.ElementFactory.make("audioconvert", None)
+        self._in_pipeline.add(audio_convert)
+        audio_sink = Gst.ElementFactory.make("autoaudiosink", None)
+        self._in_pipeline.add(audio_sink)
+        self._audio_mixer.link(audio_convert)
+        audio_convert.link(audio_sink)
+
+    #N-way: receive a peer on a slot of ports (transport.participant_port),
+    #the peer sends there with add_peer; returns the slot or None.  Through
+    #a relay every participant has the relay's ip and the slot it gave them
+    def add_participant(self, ip, slot=None):
+        if self._video_mixer == None:
+            print "WARNING: not an N-way pipeline"
+            return None
+        if slot in self._participants:
+            return slot
+        for participant in self._participants.values():
+            if participant.ip == ip and self._relay == None:
+                return participant.slot
+        if len(self._participants) >= self._max_participants - 1:
+            logger.warning("Call is full, not adding %s" % ip)
+            return None
+
+        if slot == None:
+            used = list(self._participants.keys())
+            if self._relay != None:
+                used.append(self._relay[2])
+            slot = min(k for k in range(self._max_participants)
+                    if k not in used)
+
+        # Our reports on the peer go to the relay when there is one
+        rtcp_ports = (transport.VIDEO_RTCP_RR_PORT,
+                transport.AUDIO_RTCP_RR_PORT)
+        if self._relay != None:
+            relay_ip, base, own_slot = self._relay
+            rtcp_ports = (
+                    transport.relay_port(base, transport.VIDEO_RTCP_RR_PORT,
+                    own_slot),
+                    transport.relay_port(base, transport.AUDIO_RTCP_RR_PORT,
+                    own_slot))
+
+        print "Adding participant %s on slot %d" % (ip, slot)
+        self._participants[slot] = Participant(self._in_pipeline, ip, slot,
+                self._video_codec, self._audio_codec, self._video_mixer,
+                self._audio_mixer, self._threads, self._latency, self._fec,
+                self._rtx, rtcp_ports)
+        self._layout_grid()
+        return slot
+
+    def remove_participant(self, slot):
+        participant = self._participants.pop(slot, None)
+        if participant != None:
+            print "Removing participant %s" % participant.ip
+            participant.remove(self._video_mixer, self._audio_mixer)
+            self._layout_grid()
+
+    #Tile the participants over the grid, in slot order
+    def _layout_grid(self):
+        participants = sorted(self._participants.values(),
+                key=lambda participant: participant.slot)
+        columns = int(math.ceil(math.sqrt(len(participants)))) or 1
+        rows = int(math.ceil(len(participants) / float(columns))) or 1
+        width = GRID_WIDTH // columns
+        height = GRID_HEIGHT // rows
+        for index, participant in enumerate(participants):
+            participant.video_pad.set_property("xpos",
+                    (index % columns) * width)
+            participant.video_pad.set_property("ypos",
+                    (index // columns) * height)
+            participant.video_pad.set_property("width", width)
+            participant.video_pad.set_property("height", height)
+
+    #N-way: send to a peer, on the slot it gave us with add_participant
+    def add_peer(self, ip, slot=0, layer=0):
+        self._out_transport.add_client(transport.layer_session(layer), ip,
+                transport.participant_port(transport.VIDEO_RTP_PORT, slot),
+                transport.participant_port(transport.VIDEO_RTCP_PORT, slot))
+        self._out_transport.add_client(transport.AUDIO_SESSION, ip,
+                transport.participant_port(transport.AUDIO_RTP_PORT, slot),
+                transport.participant_port(transport.AUDIO_RTCP_PORT, slot))
+
+    def remove_peer(self, ip, slot=0, layer=0):
+        self._out_transport.remove_client(transport.layer_session(layer), ip,
+                transport.participant_port(transport.VIDEO_RTP_PORT, slot),
+                transport.participant_port(transport.VIDEO_RTCP_PORT, slot))
+        self._out_transport.remove_client(transport.AUDIO_SESSION, ip,
+                transport.participant_port(transport.AUDIO_RTP_PORT, slot),
+                transport.participant_port(transport.AUDIO_RTCP_PORT, slot))
+
+    #Relay: send every layer up to a relay (relay.py) that forwards them,
+    #base and slot are the port block and slot it gave us for this call;
+    #then add_participant(ip, slot) for each of the others
+    def join_relay(self, ip, base, slot):
+        self._relay = (ip, base, slot)
+        for layer in range(len(self._layer_bins)):
+            self._out_transport.add_client(transport.layer_session(layer), ip,
+                    transport.relay_port(base, transport.VIDEO_RTP_PORT, slot,
+                    layer),
+                    transport.relay_port(base, transport.VIDEO_RTCP_PORT, slot,
+                    layer))
+        self._out_transport.add_client(transport.AUDIO_SESSION, ip,
+                transport.relay_port(base, transport.AUDIO_RTP_PORT, slot),
+                transport.relay_port(base, transport.AUDIO_RTCP_PORT, slot))
+
+    #Share of one CPU this process used since the last call
+    def get_cpu_load(self):
+        times = os.times()
+        cpu, wall = times[0] + times[1], times[4]
+        load = None
+        if self._cpu_times != None and wall > self._cpu_times[1]:
+            load = (cpu - self._cpu_times[0]) / (wall - self._cpu_times[1])
+        self._cpu_times = (cpu, wall)
+        return load
+
+    #Per participant stats since the last call (see Participant.stats),
+    #with the CPU load shared out by frames decoded
+    def get_participant_stats(self):
+        stats = dict((slot, participant.stats())
+                for slot, participant in self._participants.items())
+        load = self.get_cpu_load()
+        frames = sum(stat["fps"] for stat in stats.values())
+        for stat in stats.values():
+            stat["cpu"] = None
+            if load != None and frames > 0:
+                stat["cpu"] = load * stat["fps"] / frames
+        return stats
+
+    #Codecs this machine can use, most preferred first
+    def get_codecs(self):
+        return (gst_codecs.available_codecs("video"),
+                gst_codecs.available_codecs("audio"))
+
+    #Set the codecs agreed with the peer (see gst_codecs.negotiate)
+    def set_codecs(self, video, audio):
+        video_codec = gst_codecs.get_codec(video)
+        audio_codec = gst_codecs.get_codec(audio)
+        if (video_codec, audio_codec) == (self._video_codec, self._audio_codec):
+            return
+
+        print "Using codecs %s/%s" % (video, audio)
+        self._video_codec = video_codec
+        self._audio_codec = audio_codec
+
+        # The receive chain was built for the old codecs, rebuild it
+        if self._in_pipeline != None:
+            slots = [(participant.ip, slot)
+                    for slot, participant in self._participants.items()]
+            self.start_stop_incoming_pipeline(False)
+            self._in_pipeline = None
+            self._in_transport = None
+            self._participants = {}
+            self.build_incoming_pipeline()
+            for ip, slot in slots:
+                self.add_participant(ip, slot)
+            self.start_stop_incoming_pipeline(True)
+
+    #Set an audio encoder option: bitrate (kbit/s), frame_size (ms as a
+    #string, e.g. "20"), fec, dtx or loss (expected loss percentage)
+    def set_audio_option(self, name, value):
+        self._audio_options[name] = value
+        if self._audio_out_bin != None:
+            self._audio_codec.set_option(self._audio_out_bin.audio_enc,
+                    name, value)
+
+    #Video FEC/RTX, both ends must agree and set it before the call
+    def set_video_protection(self, fec=True, rtx=True):
+        self._fec = fec
+        self._rtx = rtx
+
+    #FEC overhead in percent; automatic switches it on at FEC_LOSS_ON
+    def set_fec_overhead(self, percentage, automatic=True):
+        self._fec_percentage = percentage
+        self._fec_auto = automatic
+        if self._out_transport != None and not automatic:
+            self._out_transport.set_fec_percentage(transport.VIDEO_SESSION,
+                    percentage)
+
+    def _on_video_report(self, stats):
+        self._rate_controller.rtcp_stats(stats)
+        if self._bandwidth != None:
+            self._bandwidth.rtcp_stats(stats)
+        if not self._fec_auto or not stats.get_value("have-rb"):
+            return
+
+        # Only pay the FEC overhead while the link is actually losing
+        fraction_lost = stats.get_value("rb-fractionlost") / 256.0
+        current = self._out_transport.get_fec_percentage(
+                transport.VIDEO_SESSION)
+        if fraction_lost >= transport.FEC_LOSS_ON:
+            current = self._fec_percentage
+        elif fraction_lost < transport.FEC_LOSS_OFF:
+            current = 0
+        self._out_transport.set_fec_percentage(transport.VIDEO_SESSION,
+                current)
+
+    def _on_audio_report(self, stats):
+        # Tell the encoder how much loss to protect against with FEC
+        if not stats.get_value("have-rb") or "loss" in self._audio_options:
+            return
+        loss = stats.get_value("rb-fractionlost") * 100 / 256
+        if "loss" in self._audio_codec.options:
+            self._audio_codec.set_option(self._audio_out_bin.audio_enc,
+                    "loss", min(100, max(loss, 1)))
+
+    #Set Jitter Buffer Latency (ms), can be changed while playing
+    def set_latency(self, latency):
+        self._latency = latency
+        if self._in_transport != None:
+            self._in_transport.set_latency(latency)
+        for participant in self._participants.values():
+            participant.transport.set_latency(latency)
+
+    def get_latency(self):
+        return self._latency
+
+    #A/V skew of incoming playout in ms, positive when video lags audio
+    def get_av_skew(self):
+        if self._in_transport == None:
+            return None
+        return self._in_transport.get_av_skew()
+
+    #Note a colorspace conversion that had to go into the graph
+    def _add_conversion(self, where, src_caps, to):
+        if not isinstance(to, str):
+            to = describe_formats(to)
+        conversion = "%s: %s -> %s" % (where, describe_formats(src_caps), to)
+        logger.info("Colorspace conversion in %s" % conversion)
+        self._conversions.append(conversion)
+
+    #Colorspace conversions in the graph, e.g. "preview: I420 -> BGRx"
+    def get_conversions(self):
+        conversions = list(self._conversions)
+        if self._video_in_bin != None and self._video_in_bin.converts:
+            conversions.append("incoming: %s -> %s" % (
+                    describe_formats(self._video_in_bin.decoder_caps),
+                    describe_formats(self._video_in_bin.sink_caps)))
+        return conversions
+
+    #Classroom broadcast: send to / receive from a multicast group rather
+    #than one peer, set before building the pipelines; None turns it off
+    def set_multicast(self, group, ttl=transport.MULTICAST_TTL, iface=None):
+        if group == None:
+            self._multicast = None
+        else:
+            self._multicast = (group, ttl, iface)
+
+    #Simulcast encodes SIMULCAST_LAYERS too, set before the call
+    def set_simulcast(self, enabled=True):
+        self._simulcast = enabled
+
+    def _add_simulcast_layer(self, width, height, bitrate, convert=False):
+        layer = len(self._layer_bins)
+
+        # Scale down from the shared capture and conversion
+        video_scale = Gst.ElementFactory.make("videoscale", None)
+        self._out_pipeline.add(video_scale)
+        video_caps = Gst.ElementFactory.make("capsfilter", None)
+        video_caps.set_property("caps", Gst.caps_from_string(
+                "video/x-raw,width=%d,height=%d" % (width, height)))
+        self._out_pipeline.add(video_caps)
+
+        # Encoder for this layer
+        video_out_bin = VideoOutBin(self._video_codec, self._threads, convert,
+                self._roi)
+        self._video_codec.set_bitrate(video_out_bin.video_enc, bitrate)
+        video_out_bin.set_muted(self._video_muted)
+        self._out_pipeline.add(video_out_bin)
+        self._layer_bins.append(video_out_bin)
+
+        # Link Elements
+        self._add_branch("layer%d" % layer).link(video_scale)
+        video_scale.link(video_caps)
+        video_caps.link(video_out_bin)
+
+        # Receivers are added per layer with select_layer
+        self._out_transport.protect_session(transport.layer_session(layer),
+                self._video_codec.payload, self._fec, self._rtx)
+        self._out_transport.add_send_session(transport.layer_session(layer),
+                video_out_bin, None, transport.VIDEO_RTP_PORT,
+                transport.VIDEO_RTCP_PORT, transport.layer_rr_port(layer),
+                True)
+
+    #Send one simulcast layer (0 is full size) to a receiver
+    def select_layer(self, ip, layer):
+        for other in range(len(self._layer_bins)):
+            if other != layer:
+                self.remove_layer_client(ip, other)
+        self.add_layer_client(ip, layer)
+
+    #A relay takes several layers at once
+    def add_layer_client(self, ip, layer, rtp_port=None, rtcp_port=None):
+        self._out_transport.add_client(transport.layer_session(layer), ip,
+                rtp_port, rtcp_port)
+
+    def remove_layer_client(self, ip, layer, rtp_port=None, rtcp_port=None):
+        self._out_transport.remove_client(transport.layer_session(layer), ip,
+                rtp_port, rtcp_port)
+
+    #Receiver side: tell our RTCP which layer the sender gives us
+    def request_layer(self, layer):
+        if self._in_transport != None:
+            self._in_transport.set_rtcp_port(transport.VIDEO_SESSION,
+                    transport.layer_rr_port(layer))
+
+    #Add a queue to the local tee under the named branch policy
+    def _add_branch(self, name):
+        branch = TeeBranch(self._out_pipeline, self._video_local_tee,
+                self._branch_policies.get(name, SEND_POLICY))
+        self._branches[name] = branch
+        return branch
+
+    #Change a tee branch policy, applies while playing
+    def set_branch_policy(self, name, policy):
+        self._branch_policies[name] = policy
+        if name in self._branches:
+            self._branches[name].set_policy(policy)
+
+    #Buffers each tee branch has dropped
+    def get_branch_drops(self):
+        return dict((name, branch.drops)
+                for name, branch in self._branches.items())
+
+    #Spend the video bits on hands and face (on by default), before the
+    #call; needs NumPy and an encoder that takes regions of interest
+    def set_roi_encoding(self, enabled=True):
+        self._roi = enabled
+
+    #Motion Priority trades resolution for framerate (on by default)
+    def set_motion_priority(self, enabled=True):
+        self._motion_priority_enabled = enabled
+        if self._motion_priority != None:
+            self._motion_priority.stop()
+            self._motion_priority.set_level(0)
+            self._motion_priority = None
+        if enabled and self._video_out_bin != None:
+            self._motion_priority = MotionPriority(self._video_caps,
+                    self._video_out_bin.video_enc, self._rate_controller,
+                    self._rate_controller.min_framerate,
+                    still_gate=self._still_gate,
+                    video_out=self._video_out_bin)
+
+    #Skip frames while the picture holds still, sending at least
+    #min_refresh fps (on by default, needs NumPy)
+    def set_still_skipping(self, enabled=True,
+            min_refresh=video_analysis.MIN_REFRESH):
+        self._still_skipping_enabled = enabled
+        if self._still_gate != None:
+            self._still_gate.stop()
+            self._still_gate = None
+        if enabled and self._video_out_bin != None and \
+                video_analysis.available():
+            self._still_gate = StillGate(self._video_out_bin.encoder_input
+                    .get_static_pad("sink"), min_refresh)
+        if self._motion_priority != None:
+            self._motion_priority.still_gate = self._still_gate
+
+    #Frames skipped while the picture was still
+    def get_still_skipped(self):
+        if self._still_gate == None:
+            return 0
+        return self._still_gate.skipped
+
+    #Latency instrumentation: stamp outgoing frames with their capture
+    #time and read the stamps at the incoming video sink; set on both
+    #ends before building the pipelines
+    def set_latency_stamps(self, enabled=True):
+        self._latency_stamps = enabled
+
+    #Glass-to-glass latency so far, [(stage, samples, {percent: ms})]
+    def get_latency_report(self):
+        return self._latency_stats.report()
+
+    #Estimated kbit/s the path to the peer carries, None before the call
+    def get_bandwidth_estimate(self):
+        if self._bandwidth == None:
+            return None
+        return self._bandwidth.get_estimate()
+
+    #Call callback(kbit/s) with every new bandwidth estimate
+    def subscribe_bandwidth(self, callback):
+        if self._bandwidth != None:
+            self._bandwidth.subscribe(callback)
+
+    #Frames dropped before the encoder while the link was congested
+    def get_frame_gate_drops(self):
+        if self._frame_gate == None:
+            return 0
+        return self._frame_gate.drops
+
+    #Set Bitrate/Framerate Floor and Ceiling, kept for the next call when
+    #set before one
+    def set_rate_limits(self, min_bitrate=None, max_bitrate=None,
+            min_framerate=None, max_framerate=None):
+        limits = {"min_bitrate": min_bitrate, "max_bitrate": max_bitrate,
+                "min_framerate": min_framerate, "max_framerate": max_framerate}
+        for name, value in limits.items():
+            if value != None:
+                self._rate_limits[name] = value
+        if self._rate_controller != None:
+            self._rate_controller.set_limits(min_bitrate, max_bitrate,
+                    min_framerate, max_framerate)
+        if self._motion_priority != None and min_framerate != None:
+            self._motion_priority.min_framerate = min_framerate
+
+    #Record the call to a Matroska file as it is encoded, no second encode
+    def start_recording(self, path):
+        if self._recorder != None:
+            print "WARNING: already recording"
+            return
+        if self._finishing_recorder != None:
+            print "WARNING: still finishing the last recording"
+            return
+
+        # (pad, codec) of every stream, sent and received
+        streams = []
+        if self._video_out_bin != None:
+            streams.append((self._video_out_bin.get_static_pad("src"),
+                    self._video_codec))
+            streams.append((self._audio_out_bin.get_static_pad("src"),
+                    self._audio_codec))
+        in_bins = [(self._video_in_bin, self._video_codec),
+                (self._audio_in_bin, self._audio_codec)]
+        for participant in self._participants.values():
+            in_bins.append((participant.video_in_bin, self._video_codec))
+            in_bins.append((participant.audio_in_bin, self._audio_codec))
+        for in_bin, codec in in_bins:
+            if in_bin != None:
+                streams.append((in_bin.get_static_pad("sink"), codec))
+
+        # The muxer waits for every stream, leave out those not flowing
+        self._recorder = Recorder(path)
+        for pad, codec in streams:
+            if pad.has_current_caps():
+                self._recorder.add_stream(pad, codec)
+        self._recorder.start()
+
+    #Finish the recording file without blocking, on_done(finalised) is
+    #called once it is written
+    def stop_recording(self, on_done=None):
+        if self._recorder == None:
+            return
+        self._finishing_recorder = self._recorder
+        self._recorder = None
+        self._recording_done = on_done
+        self._finishing_recorder.stop(self._on_recording_finished)
+
+    def _on_recording_finished(self, finalised):
+        self._finishing_recorder = None
+        on_done = self._recording_done
+        self._recording_done = None
+        if on_done != None:
+            on_done(finalised)
+
+    def is_recording(self):
+        return self._recorder != None
+
+    #Whether a stopped recording is still being written
+    def is_finishing_recording(self):
+        return self._finishing_recorder != None
+
+    #Add a chat message to the recording, timed with the call
+    def record_chat(self, message):
+        if self._recorder != None:
+            self._recorder.add_chat(message)
+
     def start_stop_outgoing_pipeline(self, start=True):
         if self._out_pipeline != None:
             if start:
@@ -239,8 +1023,25 @@ class GSTStack(object):
                 self._out_pipeline.set_state(Gst.State.PLAYING)
             else:
                 print "Setting Outgoing Pipeline state: STATE_NULL"
+                self._stop_call_timers()
                 self._out_pipeline.set_state(Gst.State.NULL)
 
+    #Stop the timers and probes that follow the outgoing call, so none
+    #keeps polling its transport once the pipeline is torn down
+    def _stop_call_timers(self):
+        if self._bandwidth != None:
+            self._bandwidth.stop()
+            self._bandwidth = None
+        if self._frame_gate != None:
+            self._frame_gate.stop()
+            self._frame_gate = None
+        if self._motion_priority != None:
+            self._motion_priority.stop()
+            self._motion_priority = None
+        if self._still_gate != None:
+            self._still_gate.stop()
+            self._still_gate = None
+
     def start_stop_incoming_pipeline(self, start=True):
         if self._in_pipeline != None:
             if start:
@@ -26,9 +26,10 @@
 
 
 # External Imports
-import logger
+import logging
 from gi.repository import Gtk
 from gi.repository import Gdk
+from gi.repository import GLib
 from gettext import gettext as _
 from sugar3.activity.widgets import StopButton
 from sugar3.graphics.toolbutton import ToolButton
@@ -54,6 +55,9 @@ class Gui(Gtk.Grid):
         # Set Activity
         self.activity = activity
 
+        # Recording being played back, see show_playback
+        self.player = None
+
         # Set Activity Title
         self.activity.set_title(_("OpenVideoChat"))
 
@@ -152,6 +156,12 @@ class Gui(Gtk.Grid):
         self.settings_buttons["toggle_audio"].connect("clicked", self.toggle_audio)
         toolbar_box.toolbar.insert(self.settings_buttons["toggle_audio"], -1)
 
+        # Record the call
+        self.settings_buttons["record"] = ToolButton("media-record")
+        self.settings_buttons["record"].set_tooltip_text(_("Record Call"))
+        self.settings_buttons["record"].connect("clicked", self.toggle_record)
+        toolbar_box.toolbar.insert(self.settings_buttons["record"], -1)
+
         # Forced Refresh
         reload_video = ToolButton("view-refresh")
         reload_video.set_tooltip_text(_("Reload Video"))
@@ -215,6 +225,14 @@ class Gui(Gtk.Grid):
             self.settings_buttons["toggle_audio"].set_icon_name("speaker-100")
             self.settings_buttons["toggle_audio"].set_tooltip_text("Turn on Sound")
 
+    def toggle_record(self, trigger):
+        if self.activity.toggle_recording():
+            self.settings_buttons["record"].set_icon_name("media-playback-stop")
+            self.settings_buttons["record"].set_tooltip_text(_("Stop Recording"))
+        else:
+            self.settings_buttons["record"].set_icon_name("media-record")
+            self.settings_buttons["record"].set_tooltip_text(_("Record Call"))
+
     def get_history(self):
         return self.chat_text.get_text(
                 self.chat_text.get_start_iter(),
@@ -224,6 +242,63 @@ class Gui(Gtk.Grid):
     def receive_message(self, message):
         self.chat_text.insert(self.chat_text.get_end_iter(), "%s\n" % message, -1)
         self.text_view.scroll_to_iter(self.chat_text.get_end_iter(), 0.1, False, 0.0, 0.0)
+        self.activity.record_chat(message)
+
+    def show_playback(self, player):
+        # Play/pause and a seek bar under the video; the chat pane follows
+        # the recording
+        self.player = player
+        self.chat_text.set_text("")
+
+        self.playback_button = Gtk.Button(_("Pause"))
+        self.playback_button.connect("clicked", self.toggle_playback)
+        self.playback_scale = Gtk.Scale.new_with_range(
+                Gtk.Orientation.HORIZONTAL, 0, 1, 1)
+        self.playback_scale.set_draw_value(False)
+        self.playback_scale.set_hexpand(True)
+        self.playback_scale.connect("change-value", self.seek_playback)
+
+        playback_grid = Gtk.Grid()
+        playback_grid.attach(self.playback_button, 0, 0, 1, 1)
+        playback_grid.attach(self.playback_scale, 1, 0, 1, 1)
+        playback_grid.show_all()
+        self.attach(playback_grid, 0, 2, 1, 1)
+
+        self.movie_window.show()
+        GLib.timeout_add(500, self.update_playback)
+
+    def toggle_playback(self, trigger):
+        if self.playback_button.get_label() == _("Pause"):
+            self.player.pause()
+            self.playback_button.set_label(_("Play"))
+        else:
+            self.player.play()
+            self.playback_button.set_label(_("Pause"))
+
+    def seek_playback(self, scale, scroll, value):
+        position = self.player.seek(value)
+
+        # Redraw the chat as it stood where the seek landed
+        self.chat_text.set_text("")
+        for seconds, message in self.player.chat_until(position):
+            self.show_chat(seconds, message)
+        return False
+
+    def show_chat(self, seconds, message):
+        self.chat_text.insert(self.chat_text.get_end_iter(),
+                "[%d:%02d] %s\n" % (seconds // 60, seconds % 60, message), -1)
+        self.text_view.scroll_to_iter(self.chat_text.get_end_iter(), 0.1, False, 0.0, 0.0)
+
+    def update_playback(self):
+        if self.player == None:
+            return False
+        duration = self.player.get_duration()
+        position = self.player.get_position()
+        if duration:
+            self.playback_scale.set_range(0, duration)
+        if position != None:
+            self.playback_scale.set_value(position)
+        return True
 
     def send_message(self, trigger):
         if (self.chat_entry.get_text() != ""):
@@ -250,10 +325,10 @@ class Gui(Gtk.Grid):
             self.movie_window_preview.set_size_request(
                     self.movie_window_preview_width,
                     self.movie_window_preview_height)
-        source.set_xwindow_id(self.movie_window_preview.get_property('window').get_xid())
+        source.set_window_handle(self.movie_window_preview.get_property('window').get_xid())
 
     def render_incoming(self, source):
         self.movie_window.set_size_request(
                 self.movie_window.get_parent().get_parent().get_allocation().width,
                 self.movie_window.get_parent().get_parent().get_allocation().height)
-        source.set_xwindow_id(self.movie_window.get_property('window').get_xid())
+        source.set_window_handle(self.movie_window.get_property('window').get_xid())
@@ -0,0 +1,458 @@
+#    This file is part of OpenVideoChat.
+#
+#    OpenVideoChat is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    OpenVideoChat is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with OpenVideoChat.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod: `OpenVideoChat/OpenVideoChat.activity/impairment` --
+        Open Video Chat Network Impairment Proxy
+=======================================================================
+
+UDP proxy that makes loopback look like a bad network: loss (random or
+in bursts), delay, jitter, reordering and a bandwidth cap.  The sender
+sends to the proxy, PROXY_PORT_STEP above the plain ports, and the
+proxy passes each packet on to the plain port, late or not at all.
+
+    python impairment.py --profile mesh --seed 7
+    python impairment.py --profile "loss=0.05,burst=3,delay=80" --port 5004
+    python impairment.py --trace walk.trace --to 10.0.0.3
+
+Every decision is drawn from a random generator seeded with the seed
+and the port, in packet order.  The capped link and the trace run on
+the media clock of each RTP source, its timestamps, rather than the wall
+clock, so the same stream sent twice is lost, queued and delayed the
+same way however the machine is loaded.  Packets that are not RTP, or
+on a port with no known clock rate, go by the wall clock and their
+queue drops are not reproducible.  A trace changes the profile over
+time, one line per change, each keeping what it does not set:
+
+    # seconds  profile and/or key=value
+    0   mesh
+    20  kbps=150 loss=0.1
+    40  clean
+
+Keys: loss (0.0 - 1.0), burst (mean packets per loss burst), delay and
+jitter (ms), reorder (0.0 - 1.0, held back REORDER_MS), kbps (0 for no
+cap) and queue (ms of packets the capped link holds before dropping).
+"""
+
+
+# External Imports
+import sys
+import time
+import heapq
+import random
+import select
+import socket
+import argparse
+import logging
+import threading
+
+
+# Define Logger for Logging
+logger = logging.getLogger('ovc-activity')
+
+
+# Local Imports
+from transport import VIDEO_RTP_PORT
+from transport import AUDIO_RTP_PORT
+
+
+# The proxy listens this far above each port it passes on
+PROXY_PORT_STEP = 20000
+
+# Ports passed on unless told otherwise, the media, and the RTP clock
+# rate of each with the default codecs (every video codec is 90 kHz,
+# Opus 48 kHz)
+PROXY_PORTS = [VIDEO_RTP_PORT, AUDIO_RTP_PORT]
+CLOCK_RATES = {VIDEO_RTP_PORT: 90000, AUDIO_RTP_PORT: 48000}
+
+# Extra delay (ms) of a reordered packet, enough for the next few to
+# overtake it
+REORDER_MS = 30
+
+# Ms of packets a capped link holds by default; more are dropped
+QUEUE_MS = 300
+
+# Largest datagram passed on
+MAX_DATAGRAM = 65536
+
+# Named profiles: measured OLPC mesh figures, roughly, and worse
+PROFILES = {
+    "clean": {},
+    "mesh": {"loss": 0.02, "burst": 2, "delay": 40, "jitter": 15,
+            "reorder": 0.01, "kbps": 600},
+    "mesh-busy": {"loss": 0.05, "burst": 3, "delay": 80, "jitter": 40,
+            "reorder": 0.03, "kbps": 250},
+    "lossy": {"loss": 0.10, "burst": 1},
+    "bursty": {"loss": 0.05, "burst": 8},
+    "slow": {"delay": 150, "jitter": 30, "kbps": 150},
+}
+
+
+##########
+# Profile
+##########
+class Profile(object):
+    """
+    One set of impairments; see the module docstring for the keys.
+    """
+
+    KEYS = ["loss", "burst", "delay", "jitter", "reorder", "kbps", "queue"]
+
+    def __init__(self, loss=0.0, burst=1, delay=0, jitter=0, reorder=0.0,
+            kbps=0, queue=QUEUE_MS):
+        self.loss = loss
+        self.burst = burst
+        self.delay = delay
+        self.jitter = jitter
+        self.reorder = reorder
+        self.kbps = kbps
+        self.queue = queue
+
+    def changed(self, settings):
+        # A copy with settings, {key: value}, applied
+        values = dict((key, getattr(self, key)) for key in self.KEYS)
+        for key, value in settings.items():
+            if key not in values:
+                raise ValueError("Unknown impairment %s" % key)
+            values[key] = float(value)
+        return Profile(**values)
+
+    def __repr__(self):
+        return " ".join("%s=%g" % (key, getattr(self, key))
+                for key in self.KEYS)
+
+
+def parse_profile(text, base=None):
+    """
+    Profile from words: profile names and key=value pairs, separated by
+    commas or spaces, applied in order over base.
+    """
+    profile = base or Profile()
+    for word in text.replace(",", " ").split():
+        if "=" in word:
+            key, value = word.split("=", 1)
+            profile = profile.changed({key: value})
+        elif word in PROFILES:
+            profile = Profile().changed(PROFILES[word])
+        else:
+            raise ValueError("Unknown profile %s" % word)
+    return profile
+
+
+def load_trace(path):
+    """
+    [(seconds, Profile)] from a trace file, in time order.
+    """
+    schedule = []
+    profile = Profile()
+    trace = open(path)
+    for number, line in enumerate(trace):
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        words = line.split(None, 1)
+        start, rest = words[0], words[1] if len(words) > 1 else ""
+        try:
+            profile = parse_profile(rest, profile)
+            schedule.append((float(start), profile))
+        except ValueError as error:
+            raise ValueError("%s line %d: %s" % (path, number + 1, error))
+    trace.close()
+    schedule.sort(key=lambda step: step[0])
+    return schedule
+
+
+def rtp_header(data):
+    """
+    (timestamp, ssrc) of an RTP packet, or None if data is not RTP.
+    """
+    data = bytearray(data[:12])
+    if len(data) < 12 or data[0] >> 6 != 2 or 72 <= data[1] & 0x7f <= 76:
+        return None
+    timestamp = (data[4] << 24) | (data[5] << 16) | (data[6] << 8) | data[7]
+    ssrc = (data[8] << 24) | (data[9] << 16) | (data[10] << 8) | data[11]
+    return timestamp, ssrc
+
+
+###########
+# RtpClock
+###########
+class RtpClock(object):
+    """
+    Media time of one RTP source, seconds from start at its first packet,
+    from its timestamps.  It never goes back: retransmissions and
+    reordered packets carry old timestamps but arrive now.
+    """
+
+    def __init__(self, clock_rate, start=0.0):
+        self.clock_rate = clock_rate
+        self.start = start
+        self._last = None
+        self._ticks = 0
+        self._elapsed = start
+
+    def elapsed(self, timestamp):
+        """
+        Media time of a packet with the given RTP timestamp.
+        """
+        if self._last is not None:
+            # Across the 32 bit wrap, by the shorter way round
+            step = (timestamp - self._last) & 0xffffffff
+            if step >= 0x80000000:
+                step -= 0x100000000
+            self._ticks += step
+        self._last = timestamp
+        self._elapsed = max(self._elapsed,
+                self.start + self._ticks / float(self.clock_rate))
+        return self._elapsed
+
+
+#############
+# Impairment
+#############
+class Impairment(object):
+    """
+    The fate of each packet of one flow: drawn from a generator seeded
+    with seed, under the profile of schedule, [(seconds, Profile)], in
+    force at the time it arrives.
+    """
+
+    def __init__(self, schedule, seed=0):
+        self.schedule = schedule
+        self.random = random.Random(seed)
+        self.packets = 0
+        self.lost = 0
+        self.queue_drops = 0
+        self.reordered = 0
+        self._losing = False
+        self._link_free = 0.0
+
+    def profile_at(self, elapsed):
+        profile = Profile()
+        for start, step in self.schedule:
+            if start > elapsed:
+                break
+            profile = step
+        return profile
+
+    def _lose(self, profile):
+        # Gilbert model: a loss starts a burst that goes on with the
+        # chance that gives burst packets on average
+        if self._losing and profile.burst > 1:
+            self._losing = self.random.random() < 1 - 1.0 / profile.burst
+        else:
+            start = profile.loss
+            if profile.burst > 1 and profile.loss < 1:
+                start = profile.loss / (profile.burst * (1 - profile.loss))
+            self._losing = self.random.random() < start
+        return self._losing
+
+    def plan(self, elapsed, size):
+        """
+        Seconds after elapsed to pass on a packet of size bytes, or None
+        to drop it.
+        """
+        profile = self.profile_at(elapsed)
+        self.packets += 1
+
+        # Draw every number each time, so one change of profile does not
+        # shift the fate of every packet after it
+        lose = self._lose(profile)
+        jitter = self.random.uniform(-1, 1) * profile.jitter
+        reorder = self.random.random() < profile.reorder
+        if lose:
+            self.lost += 1
+            return None
+
+        # The capped link sends one packet after another, and drops what
+        # would wait longer than its queue
+        departure = elapsed
+        if profile.kbps > 0:
+            start = max(elapsed, self._link_free)
+            if start - elapsed > profile.queue / 1000.0:
+                self.queue_drops += 1
+                return None
+            self._link_free = start + size * 8 / (profile.kbps * 1000.0)
+            departure = self._link_free
+
+        delay = max(0.0, profile.delay + jitter) / 1000.0
+        if reorder:
+            self.reordered += 1
+            delay += REORDER_MS / 1000.0
+        return departure - elapsed + delay
+
+
+##################
+# ImpairmentProxy
+##################
+class ImpairmentProxy(object):
+    """
+    Passes on every port of ports, received PROXY_PORT_STEP above it,
+    to host, impaired as schedule says.  Each port is a link of its own
+    with its own generator, so one flow never changes the fate of
+    another, timed by the RTP clock rate clock_rates gives for it.  Each
+    RTP source (SSRC) on a port has a clock of its own, since simulcast
+    layers and a restarted peer each start from a random timestamp; a
+    new one takes up the media time the port has reached.  Runs on a
+    thread of its own between start and stop.
+    """
+
+    def __init__(self, schedule, seed=0, host="127.0.0.1", ports=None,
+            step=PROXY_PORT_STEP, clock_rates=None):
+        self.host = host
+        self.ports = ports or PROXY_PORTS
+        self.step = step
+        self.impairments = {}
+        self._clocks = {}
+        self._media = {}
+        self._sockets = {}
+        if clock_rates is None:
+            clock_rates = CLOCK_RATES
+        self.clock_rates = clock_rates
+        for port in self.ports:
+            self.impairments[port] = Impairment(schedule,
+                    seed * 65536 + port)
+            udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            udp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            udp.bind(("", port + step))
+            self._sockets[udp] = port
+        self._out = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._pending = []
+        self._order = 0
+        self._start = None
+        self._running = False
+        self._thread = None
+
+    def listen_port(self, port):
+        return port + self.step
+
+    def start(self):
+        self._start = time.time()
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        logger.info("Impairment proxy on ports %s" %
+                [self.listen_port(port) for port in self.ports])
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for udp in list(self._sockets) + [self._out]:
+            udp.close()
+        self._sockets = {}
+
+    def stats(self):
+        """
+        {port: {"packets", "lost", "queue_drops", "reordered"}}
+        """
+        return dict((port, {"packets": impairment.packets,
+                "lost": impairment.lost,
+                "queue_drops": impairment.queue_drops,
+                "reordered": impairment.reordered})
+                for port, impairment in self.impairments.items())
+
+    def _media_time(self, port, data):
+        # Media time of a packet on its source's clock, None for packets
+        # that are not RTP or ports with no clock rate
+        header = rtp_header(data)
+        if header is None or port not in self.clock_rates:
+            return None
+        timestamp, ssrc = header
+        clock = self._clocks.get((port, ssrc))
+        if clock is None:
+            clock = RtpClock(self.clock_rates[port],
+                    self._media.get(port, 0.0))
+            self._clocks[(port, ssrc)] = clock
+        media = clock.elapsed(timestamp)
+        self._media[port] = max(self._media.get(port, 0.0), media)
+        return media
+
+    def _run(self):
+        while self._running:
+            # Wake for the next packet due, or to check for stop
+            wait = 0.1
+            if self._pending:
+                wait = max(0.0, min(wait,
+                        self._pending[0][0] - (time.time() - self._start)))
+            readable = select.select(list(self._sockets), [], [], wait)[0]
+
+            for udp in readable:
+                data = udp.recv(MAX_DATAGRAM)
+                port = self._sockets[udp]
+                elapsed = time.time() - self._start
+
+                # Planned on the flow's media clock where it has one, the
+                # delay then counts from now
+                media = self._media_time(port, data)
+                delay = self.impairments[port].plan(
+                        elapsed if media is None else media, len(data))
+                if delay is not None:
+                    self._order += 1
+                    heapq.heappush(self._pending,
+                            (elapsed + delay, self._order, port, data))
+
+            elapsed = time.time() - self._start
+            while self._pending and self._pending[0][0] <= elapsed:
+                due, order, port, data = heapq.heappop(self._pending)
+                try:
+                    self._out.sendto(data, (self.host, port))
+                except socket.error as error:
+                    logger.debug("Impairment proxy send failed: %s" % error)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--profile", default="clean",
+            help="profile name and/or key=value pairs")
+    parser.add_argument("--trace", default=None, metavar="FILE",
+            help="profile changes over time, instead of --profile")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--to", default="127.0.0.1", metavar="HOST",
+            help="where the packets are passed on to")
+    parser.add_argument("--port", type=int, nargs="+", default=PROXY_PORTS,
+            help="plain ports to pass on")
+    parser.add_argument("--stats", type=int, default=0, metavar="SECONDS",
+            help="print the counts this often")
+    args = parser.parse_args(argv)
+
+    if args.trace:
+        schedule = load_trace(args.trace)
+    else:
+        schedule = [(0, parse_profile(args.profile))]
+    proxy = ImpairmentProxy(schedule, args.seed, args.to, args.port)
+    for port in args.port:
+        print("%d -> %s:%d" % (proxy.listen_port(port), args.to, port))
+    for start, profile in schedule:
+        print("from %gs: %s" % (start, profile))
+
+    proxy.start()
+    try:
+        while True:
+            time.sleep(args.stats or 1)
+            if args.stats:
+                for port, counts in sorted(proxy.stats().items()):
+                    print("%d: %d packets, %d lost, %d queue drops, "
+                            "%d reordered" % (port, counts["packets"],
+                            counts["lost"], counts["queue_drops"],
+                            counts["reordered"]))
+    except KeyboardInterrupt:
+        pass
+    proxy.stop()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
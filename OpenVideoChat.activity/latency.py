@@ -0,0 +1,318 @@
+#    This file is part of OpenVideoChat.
+#
+#    OpenVideoChat is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    OpenVideoChat is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with OpenVideoChat.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod: `OpenVideoChat/OpenVideoChat.activity/latency` --
+        Open Video Chat Latency Instrumentation
+=======================================================================
+
+Glass-to-glass latency: the sender stamps the capture time into the
+top of each outgoing frame as a row of black and white blocks, large
+enough to come through the encoder, and the receiver reads it back at
+its video sink.
+
+    [white] [bit 31] ... [bit 0] [black]     STAMP_BLOCK pixels each
+
+The stamp is the wall clock in ms, modulo 2^32; between two machines
+their clocks must agree (NTP), over loopback they are the same clock.
+"""
+
+
+# External Imports
+import time
+import logging
+import gi
+gi.require_version('Gst', '1.0')
+gi.require_version('GstBase', '1.0')
+gi.require_version('GstVideo', '1.0')
+from gi.repository import Gst
+from gi.repository import GstBase
+from gi.repository import GstVideo
+
+
+# The pad templates of Stamper are made as the module loads
+Gst.init(None)
+
+
+# Define Logger for Logging
+logger = logging.getLogger('ovc-activity')
+
+
+# Stamp layout: bits of the time, block size in pixels, and the luma of
+# a 0 and a 1; the frame must be at least (STAMP_BITS + 2) blocks wide
+STAMP_BITS = 32
+STAMP_BLOCK = 8
+STAMP_BLACK = 16
+STAMP_WHITE = 235
+
+# Formats the stamp is written to and read from, by their first plane
+STAMP_CAPS = "video/x-raw,format={I420,YV12,NV12,NV21,Y42B,Y444,GRAY8}"
+STAMP_FORMATS = ["I420", "YV12", "NV12", "NV21", "Y42B", "Y444", "GRAY8"]
+
+# Percentiles reported for each stage
+PERCENTILES = [50, 90, 99]
+
+# Frames a Timeline keeps track of at once
+TIMELINE_FRAMES = 300
+
+
+def stamp_now():
+    return int(time.time() * 1000) & 0xffffffff
+
+
+def stamp_age(stamp):
+    # Seconds since the stamp was taken, across the 32 bit wrap
+    return ((stamp_now() - stamp) & 0xffffffff) / 1000.0
+
+
+def stamp_row(stamp):
+    levels = [STAMP_WHITE]
+    for bit in reversed(range(STAMP_BITS)):
+        levels.append(STAMP_WHITE if (stamp >> bit) & 1 else STAMP_BLACK)
+    levels.append(STAMP_BLACK)
+
+    row = bytearray()
+    for level in levels:
+        row.extend(bytearray([level]) * STAMP_BLOCK)
+    return bytes(row)
+
+
+def read_stamp(row):
+    """
+    The stamp in one row of luma through the middle of the blocks, or
+    None if the guard blocks are not there.
+    """
+    row = bytearray(row)
+    if len(row) < (STAMP_BITS + 2) * STAMP_BLOCK:
+        return None
+
+    # Judge each block by its middle, the edges bleed in encoding
+    bits = []
+    for block in range(STAMP_BITS + 2):
+        middle = block * STAMP_BLOCK + STAMP_BLOCK // 2
+        level = (row[middle - 1] + row[middle]) // 2
+        bits.append(level > (STAMP_BLACK + STAMP_WHITE) // 2)
+    if not bits[0] or bits[-1]:
+        return None
+
+    stamp = 0
+    for bit in bits[1:-1]:
+        stamp = (stamp << 1) | bit
+    return stamp
+
+
+def luma_info(caps):
+    # VideoInfo for caps whose first plane is the luma, else None
+    info = GstVideo.VideoInfo()
+    if caps is None or not info.from_caps(caps) or \
+            info.finfo.name not in STAMP_FORMATS:
+        return None
+    return info
+
+
+###############
+# LatencyStats
+###############
+class LatencyStats(object):
+    """
+    Latency samples (seconds) for each stage, in the order the stages
+    were first seen.
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.samples = {}
+
+    def add(self, stage, seconds):
+        if stage not in self.samples:
+            self.stages.append(stage)
+            self.samples[stage] = []
+        self.samples[stage].append(seconds)
+
+    def percentile(self, stage, percent):
+        samples = sorted(self.samples.get(stage, []))
+        if not samples:
+            return None
+        index = min(len(samples) - 1, len(samples) * percent // 100)
+        return samples[index]
+
+    def report(self):
+        """
+        [(stage, samples, {percent: ms})] for every stage.
+        """
+        return [(stage, len(self.samples[stage]),
+                dict((percent, self.percentile(stage, percent) * 1000)
+                for percent in PERCENTILES)) for stage in self.stages]
+
+
+###########
+# Timeline
+###########
+class Timeline(object):
+    """
+    When each frame, known by its stamp, passes a list of checkpoints.
+    The time from one checkpoint to the next is added to stats as the
+    stage named after the later one; only the first pass counts (the
+    first packet of a frame, say).
+    """
+
+    def __init__(self, checkpoints, stats=None):
+        self.checkpoints = checkpoints
+        self.stats = stats or LatencyStats()
+        self._frames = {}
+        self._order = []
+
+    def mark(self, stamp, checkpoint, now=None):
+        if now is None:
+            now = time.time()
+        frame = self._frames.get(stamp)
+        if frame is None:
+            frame = self._frames[stamp] = {}
+            self._order.append(stamp)
+            if len(self._order) > TIMELINE_FRAMES:
+                del self._frames[self._order.pop(0)]
+        if checkpoint in frame:
+            return
+        frame[checkpoint] = now
+
+        index = self.checkpoints.index(checkpoint)
+        if index > 0 and self.checkpoints[index - 1] in frame:
+            self.stats.add(checkpoint,
+                    now - frame[self.checkpoints[index - 1]])
+
+
+##########
+# Stamper
+##########
+class Stamper(GstBase.BaseTransform):
+    """
+    In-place filter that writes the capture time into the top
+    STAMP_BLOCK rows of each frame: now, less how far the frame's running
+    time is behind the clock, which for a live source is the time since
+    capture.  on_stamp(pts, stamp), if given, is called for each frame
+    stamped.
+    """
+
+    __gtype_name__ = "OvcStamper"
+    __gstmetadata__ = ("Latency stamper", "Filter/Video",
+            "Stamps the capture time into video frames", "OpenVideoChat")
+    __gsttemplates__ = (
+            Gst.PadTemplate.new("src", Gst.PadDirection.SRC,
+                    Gst.PadPresence.ALWAYS, Gst.caps_from_string(STAMP_CAPS)),
+            Gst.PadTemplate.new("sink", Gst.PadDirection.SINK,
+                    Gst.PadPresence.ALWAYS, Gst.caps_from_string(STAMP_CAPS)))
+
+    def __init__(self, on_stamp=None):
+        super(Stamper, self).__init__()
+        self.set_in_place(True)
+        self.set_passthrough(False)
+        self.on_stamp = on_stamp
+        self._info = None
+
+    def do_set_caps(self, incaps, outcaps):
+        self._info = luma_info(incaps)
+        if self._info is not None and \
+                self._info.width < (STAMP_BITS + 2) * STAMP_BLOCK:
+            logger.warning("Frames too narrow to stamp")
+            self._info = None
+        return True
+
+    def do_transform_ip(self, buffer):
+        if self._info is None:
+            return Gst.FlowReturn.OK
+        stamp = stamp_now()
+        clock = self.get_clock()
+        if clock is not None and buffer.pts != Gst.CLOCK_TIME_NONE:
+            behind = clock.get_time() - self.get_base_time() - buffer.pts
+            if behind > 0:
+                stamp = (stamp - behind // Gst.MSECOND) & 0xffffffff
+        row = stamp_row(stamp)
+
+        mapped, info = buffer.map(Gst.MapFlags.WRITE)
+        if not mapped:
+            return Gst.FlowReturn.OK
+        for line in range(STAMP_BLOCK):
+            start = self._info.offset[0] + line * self._info.stride[0]
+            info.data[start:start + len(row)] = row
+        buffer.unmap(info)
+
+        if self.on_stamp is not None:
+            self.on_stamp(buffer.pts, stamp)
+        return Gst.FlowReturn.OK
+
+
+##############
+# StampReader
+##############
+class StampReader(object):
+    """
+    Reads the stamp of each frame reaching pad, a video sink's, and adds
+    its age at display to stats as the "glass" stage.  on_read(stamp,
+    displayed), if given, is called with the wall clock time each frame
+    read is displayed.
+    """
+
+    def __init__(self, pad, stats=None, on_read=None):
+        self.pad = pad
+        self.stats = stats or LatencyStats()
+        self.on_read = on_read
+        self.unreadable = 0
+        self._caps = None
+        self._info = None
+        self._probe_id = pad.add_probe(Gst.PadProbeType.BUFFER, self._on_frame)
+
+    def stop(self):
+        if self._probe_id is not None:
+            self.pad.remove_probe(self._probe_id)
+            self._probe_id = None
+
+    def _on_frame(self, pad, info):
+        caps = pad.get_current_caps()
+        if caps is not None and (self._caps is None or
+                not caps.is_equal(self._caps)):
+            self._caps = caps
+            self._info = luma_info(caps)
+        if self._info is None:
+            return Gst.PadProbeReturn.OK
+
+        # The middle line of the blocks
+        buffer = info.get_buffer()
+        mapped, data = buffer.map(Gst.MapFlags.READ)
+        if not mapped:
+            return Gst.PadProbeReturn.OK
+        start = self._info.offset[0] + \
+                (STAMP_BLOCK // 2) * self._info.stride[0]
+        stamp = read_stamp(data.data[start:start + self._info.width])
+        buffer.unmap(data)
+
+        if stamp is None:
+            self.unreadable += 1
+            return Gst.PadProbeReturn.OK
+        wait = self._render_wait(buffer)
+        self.stats.add("glass", stamp_age(stamp) + wait)
+        if self.on_read is not None:
+            self.on_read(stamp, time.time() + wait)
+        return Gst.PadProbeReturn.OK
+
+    def _render_wait(self, buffer):
+        # A syncing sink holds the frame until its running time plus the
+        # pipeline latency comes round on the clock
+        sink = self.pad.get_parent_element()
+        if not isinstance(sink, GstBase.BaseSink) or not sink.get_sync():
+            return 0.0
+        clock = sink.get_clock()
+        if clock is None or buffer.pts == Gst.CLOCK_TIME_NONE:
+            return 0.0
+        render = sink.get_base_time() + buffer.pts + sink.get_latency()
+        return max(0, render - clock.get_time()) / float(Gst.SECOND)
@@ -26,7 +26,9 @@
 
 
 #External Imports
-import logger
+import os
+import shutil
+import logging
 import fcntl
 import array
 import socket
@@ -45,12 +47,23 @@ logger = logging.getLogger('ovc-activity')
 #Local Imports
 from gui import Gui
 from gst_stack import GSTStack
+from playback import Player
+from playback import is_recording
 from network_stack import NetworkStack
 
 
 # Temporary Constants
 RECEIVING_STREAM = False
 
+# Participants in a call, including us; above 2 the call is N-way
+MAX_PARTICIPANTS = 2
+
+# Call recordings are made in the instance directory, named after the
+# activity id so each session has its own, and moved to the Journal by
+# write_file
+RECORDING_FILE = "recording-%s.mkv"
+RECORDING_MIME_TYPE = "video/x-matroska"
+
 
 class OpenVideoChatActivity(Activity):
 
@@ -58,7 +71,18 @@ class OpenVideoChatActivity(Activity):
         Activity.__init__(self, handle)
 
         # Self-Enforced max_participants
-        self.max_participants = 2
+        self.max_participants = MAX_PARTICIPANTS
+
+        # Recording opened from the Journal, see read_file
+        self.player = None
+
+        # Whether this session recorded since the last save, and whether
+        # the Journal entry holds a recording
+        self.recorded = False
+        self.saved_recording = False
+
+        # Close once the recording is written, see can_close
+        self._closing = False
 
         # Revise logical checks to shared_activity flags and remove these:
         if self.shared_activity:
@@ -84,13 +108,26 @@ class OpenVideoChatActivity(Activity):
         # Setup Pipeline
         #################
         print "Setting up GStreamer"
-        self.gststack = GSTStack(self.get_canvas().render_preview, self.get_canvas().render_incoming)
+        self.gststack = GSTStack(self.get_canvas().render_preview, self.get_canvas().render_incoming,
+                max_participants=self.max_participants)
         self.gststack.build_preview()
         self.gststack.build_incoming_pipeline()
         GObject.idle_add(self.gststack.start_stop_incoming_pipeline, True)
 
     def can_close(self):
+        # The recording is written in the background; close again once
+        # it is, so write_file saves the finished file
+        if self.gststack.is_recording():
+            self._closing = True
+            self.gststack.stop_recording(self._recording_stopped)
+            return False
+        if self.gststack.is_finishing_recording():
+            self._closing = True
+            return False
+
         print "Closing, stopping pipelines"
+        if self.player != None:
+            self.player.stop()
         self.gststack.start_stop_incoming_pipeline(False)
         self.gststack.start_stop_outgoing_pipeline(False)
         return True
@@ -200,14 +237,72 @@ class OpenVideoChatActivity(Activity):
     def send_stream(self):
         self.get_canvas().run_toggles()
 
-    # Save Chat Log to History
+    def get_recording_path(self):
+        return os.path.join(self.get_activity_root(), "instance",
+                RECORDING_FILE % self.get_id())
+
+    # Start or stop recording the call, returns whether it is recording
+    def toggle_recording(self):
+        if self.gststack.is_recording():
+            self.gststack.stop_recording(self._recording_stopped)
+        else:
+            self.gststack.start_recording(self.get_recording_path())
+            self.recorded = True
+        return self.gststack.is_recording()
+
+    def _recording_stopped(self, finalised):
+        if self._closing:
+            self.close()
+
+    # Save the call recording, if this session made one, or the Chat Log
+    # to History
     def write_file(self, file_path):
+        # A recording opened from the Journal is the entry already, and
+        # the chat shown in playback must not be written over it
+        if self.player != None:
+            raise NotImplementedError
+
+        # A save while recording, Sugar's autosave too, must not end the
+        # recording: it is saved once the user stops it or on close
+        if self.gststack.is_recording() or \
+                self.gststack.is_finishing_recording():
+            raise NotImplementedError
+
+        if self.recorded:
+            self.recorded = False
+            recording_path = self.get_recording_path()
+            if os.path.exists(recording_path):
+                shutil.copyfile(recording_path, file_path)
+                os.remove(recording_path)
+                self.metadata['mime_type'] = RECORDING_MIME_TYPE
+                self.saved_recording = True
+                return
+
+        # Keep a saved recording rather than the chat log over it
+        if self.saved_recording:
+            raise NotImplementedError
+
         file = open(file_path, 'w')
         file.write(self.get_canvas().get_history())
         file.close()
 
-    # Load Chat Log from History
+    def record_chat(self, message):
+        self.gststack.record_chat(message)
+
+    # Open a recorded call in place of the call
+    def play_recording(self, file_path):
+        self.gststack.start_stop_incoming_pipeline(False)
+        self.player = Player(file_path, self.get_canvas().show_chat,
+                self.get_canvas().render_incoming)
+        self.get_canvas().show_playback(self.player)
+        self.player.play()
+
+    # Load a Recording or the Chat Log from History
     def read_file(self, file_path):
+        if is_recording(file_path):
+            self.play_recording(file_path)
+            return
+
         file = open(file_path, 'r')
         self.get_canvas().receive_message(file.read())
         file.close()
@@ -0,0 +1,297 @@
+#    This file is part of OpenVideoChat.
+#
+#    OpenVideoChat is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    OpenVideoChat is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with OpenVideoChat.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod: `OpenVideoChat/OpenVideoChat.activity/playback` --
+        Open Video Chat Call Playback
+=======================================================================
+
+Plays back a call recorded by recorder.py:
+
+    filesrc ! matroskademux -> queue ! decoder -> compositor -> sink
+                            -> queue ! decoder -> audiomixer -> sink
+                            -> queue ! appsink (chat)
+
+matroskademux seeks with the cues (the keyframe index) the recorder
+writes when it finishes, and searches the clusters in a recording that
+was never finished.  Seeks land on the keyframe before the position, so
+nothing is decoded from the start.
+
+The chat track is also read through once as the file opens, without
+decoding anything, so after a seek the chat pane can be redrawn as it
+stood wherever the seek landed.
+"""
+
+
+# External Imports
+import logging
+import gi
+gi.require_version('Gst', '1.0')
+gi.require_version('GstVideo', '1.0')
+from gi.repository import Gst
+from gi.repository import GstVideo
+from gi.repository import GLib
+
+
+# Define Logger for Logging
+logger = logging.getLogger('ovc-activity')
+
+
+# Local Imports
+import gst_codecs
+
+
+# Every Matroska/WebM file starts with the EBML header id
+EBML_MAGIC = b"\x1a\x45\xdf\xa3"
+
+# Seconds a seek may take to settle before the position is read
+SEEK_WAIT = 1
+
+# Size of each video stream's tile, sent and received side by side
+TILE_WIDTH = 320
+TILE_HEIGHT = 240
+
+
+def is_recording(path):
+    recording = open(path, "rb")
+    magic = recording.read(len(EBML_MAGIC))
+    recording.close()
+    return magic == EBML_MAGIC
+
+
+#########
+# Player
+#########
+class Player(object):
+    """
+    on_chat(seconds, message) is called, in the main loop, as each chat
+    message plays; render(sink) gives the video sink its window.
+    """
+
+    def __init__(self, path, on_chat=None, render=None):
+        self.path = path
+        self.on_chat = on_chat
+        self.render = render
+
+        # Every chat message of the file, (seconds, message), read by
+        # _read_chat; messages before _shown_from are not handed out as
+        # they play, the pane already has them, and any still queued for
+        # the main loop from before the last seek are dropped
+        self.chat = []
+        self._shown_from = 0
+        self._generation = 0
+        self._index_pipeline = None
+        self._read_chat()
+
+        self.pipeline = Gst.Pipeline()
+        file_src = Gst.ElementFactory.make("filesrc", None)
+        file_src.set_property("location", path)
+        self.pipeline.add(file_src)
+        demux = Gst.ElementFactory.make("matroskademux", None)
+        self.pipeline.add(demux)
+        file_src.link(demux)
+        demux.connect("pad-added", self._on_pad_added)
+
+        # Mixers are made with the first stream that needs them, one
+        # without inputs would never preroll
+        self._video_mixer = None
+        self._audio_mixer = None
+        self._videos = 0
+
+        bus = self.pipeline.get_bus()
+        bus.enable_sync_message_emission()
+        bus.connect("sync-message::element", self._on_sync_message)
+
+    def _add(self, factory):
+        element = Gst.ElementFactory.make(factory, None)
+        self.pipeline.add(element)
+        return element
+
+    def _chain(self, *elements):
+        for upstream, downstream in zip(elements, elements[1:]):
+            upstream.link(downstream)
+        for element in reversed(elements):
+            element.sync_state_with_parent()
+
+    def _mixer(self, media):
+        if media == "video":
+            if self._video_mixer is None:
+                self._video_mixer = self._add("compositor")
+                self._chain(self._video_mixer, self._add("videoconvert"),
+                        self._add("autovideosink"))
+            return self._video_mixer
+        if self._audio_mixer is None:
+            self._audio_mixer = self._add("audiomixer")
+            self._chain(self._audio_mixer, self._add("audioconvert"),
+                    self._add("autoaudiosink"))
+        return self._audio_mixer
+
+    def _on_pad_added(self, demux, pad):
+        caps = pad.get_current_caps() or pad.query_caps(None)
+        name = caps.get_structure(0).get_name()
+
+        # Chat, handed out as it plays
+        if name.startswith("text/"):
+            chat_sink = self._add("appsink")
+            chat_sink.set_property("emit-signals", True)
+            chat_sink.set_property("sync", True)
+            chat_sink.set_property("async", False)
+            chat_sink.connect("new-sample", self._on_chat_sample)
+            queue = self._add("queue")
+            self._chain(queue, chat_sink)
+            pad.link(queue.get_static_pad("sink"))
+            return
+
+        codec = gst_codecs.codec_for_caps(caps)
+        if codec is None:
+            logger.warning("Cannot play back %s" % name)
+            return
+
+        # Decode into the mixer, each video in a tile of its own
+        queue = self._add("queue")
+        decoder = codec.make_decoder()
+        self.pipeline.add(decoder)
+        elements = [queue, decoder]
+        if codec.media == "audio":
+            elements += [self._add("audioconvert"), self._add("audioresample")]
+        mixer = self._mixer(codec.media)
+        mixer_pad = mixer.get_request_pad("sink_%u")
+        if codec.media == "video":
+            mixer_pad.set_property("xpos", self._videos * TILE_WIDTH)
+            mixer_pad.set_property("width", TILE_WIDTH)
+            mixer_pad.set_property("height", TILE_HEIGHT)
+            self._videos += 1
+        self._chain(*elements)
+        elements[-1].get_static_pad("src").link(mixer_pad)
+        pad.link(queue.get_static_pad("sink"))
+
+    def _read_chat(self):
+        # filesrc ! matroskademux -> appsink for the chat, fakesink for the
+        # rest, as fast as the file reads
+        pipeline = Gst.Pipeline()
+        file_src = Gst.ElementFactory.make("filesrc", None)
+        file_src.set_property("location", self.path)
+        demux = Gst.ElementFactory.make("matroskademux", None)
+        pipeline.add(file_src)
+        pipeline.add(demux)
+        file_src.link(demux)
+
+        def on_pad_added(demux, pad):
+            caps = pad.get_current_caps() or pad.query_caps(None)
+            if caps.get_structure(0).get_name().startswith("text/"):
+                sink = Gst.ElementFactory.make("appsink", None)
+                sink.set_property("emit-signals", True)
+                sink.connect("new-sample", self._on_index_sample)
+            else:
+                sink = Gst.ElementFactory.make("fakesink", None)
+            sink.set_property("sync", False)
+            pipeline.add(sink)
+            sink.sync_state_with_parent()
+            pad.link(sink.get_static_pad("sink"))
+        demux.connect("pad-added", on_pad_added)
+
+        bus = pipeline.get_bus()
+        bus.add_signal_watch()
+        bus.connect("message::eos", self._on_index_done)
+        bus.connect("message::error", self._on_index_done)
+        self._index_pipeline = pipeline
+        pipeline.set_state(Gst.State.PLAYING)
+
+    def _on_index_sample(self, chat_sink):
+        seconds, message = self._pull_chat(chat_sink)
+        if message:
+            self.chat.append((seconds, message))
+        return Gst.FlowReturn.OK
+
+    def _on_index_done(self, bus, message):
+        if message.type == Gst.MessageType.ERROR:
+            logger.warning("Could not read the chat of %s" % self.path)
+        self._stop_index()
+
+    def _stop_index(self):
+        if self._index_pipeline is not None:
+            self._index_pipeline.get_bus().remove_signal_watch()
+            self._index_pipeline.set_state(Gst.State.NULL)
+            self._index_pipeline = None
+
+    def _pull_chat(self, chat_sink):
+        # (seconds, message) of the next chat sample
+        buffer = chat_sink.emit("pull-sample").get_buffer()
+        mapped, info = buffer.map(Gst.MapFlags.READ)
+        if not mapped:
+            return None, ""
+        message = bytes(info.data).decode("utf-8")
+        buffer.unmap(info)
+        return buffer.pts / float(Gst.SECOND), message
+
+    def _on_chat_sample(self, chat_sink):
+        seconds, message = self._pull_chat(chat_sink)
+        if message and seconds >= self._shown_from and \
+                self.on_chat is not None:
+            GLib.idle_add(self._show_chat, self._generation, seconds,
+                    message)
+        return Gst.FlowReturn.OK
+
+    def _show_chat(self, generation, seconds, message):
+        if generation == self._generation:
+            self.on_chat(seconds, message)
+        return False
+
+    def _on_sync_message(self, bus, message):
+        if self.render is not None and \
+                GstVideo.is_video_overlay_prepare_window_handle_message(message):
+            self.render(message.src)
+
+    def chat_until(self, seconds):
+        # Messages before seconds, those after play as they come
+        return sorted((time, message) for time, message in self.chat
+                if time < seconds)
+
+    def play(self):
+        self.pipeline.set_state(Gst.State.PLAYING)
+
+    def pause(self):
+        self.pipeline.set_state(Gst.State.PAUSED)
+
+    def seek(self, seconds):
+        """
+        Seek to the keyframe before seconds, from the cues, and return the
+        position it landed on; chat from there on plays as it comes.
+        """
+        self.pipeline.seek_simple(Gst.Format.TIME,
+                Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT,
+                int(seconds * Gst.SECOND))
+        self.pipeline.get_state(SEEK_WAIT * Gst.SECOND)
+        position = self.get_position()
+        if position is None:
+            position = seconds
+        self._generation += 1
+        self._shown_from = position
+        return position
+
+    def get_position(self):
+        found, position = self.pipeline.query_position(Gst.Format.TIME)
+        if not found:
+            return None
+        return position / float(Gst.SECOND)
+
+    def get_duration(self):
+        found, duration = self.pipeline.query_duration(Gst.Format.TIME)
+        if not found:
+            return None
+        return duration / float(Gst.SECOND)
+
+    def stop(self):
+        self._stop_index()
+        self.pipeline.set_state(Gst.State.NULL)
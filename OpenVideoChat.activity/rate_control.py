@@ -0,0 +1,409 @@
+#    This file is part of OpenVideoChat.
+#
+#    OpenVideoChat is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    OpenVideoChat is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with OpenVideoChat.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod: `OpenVideoChat/OpenVideoChat.activity/rate_control` --
+        Open Video Chat Sender Rate Control
+=======================================================================
+"""
+
+
+# External Imports
+import time
+import logging
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+from gi.repository import GLib
+
+
+# Define Logger for Logging
+logger = logging.getLogger('ovc-activity')
+
+
+# Bitrate limits in kbit/s
+MIN_BITRATE = 32
+MAX_BITRATE = 400
+
+# Framerate limits, the floor is the ASL minimum from doc/design.rst
+MIN_FRAMERATE = 12
+MAX_FRAMERATE = 15
+
+# Loss fractions (0.0 - 1.0) that switch between increase, hold and decrease
+LOSS_LOW = 0.02
+LOSS_HIGH = 0.10
+
+# Rate of change per receiver report
+INCREASE_FACTOR = 1.08
+DECREASE_FACTOR = 0.5
+
+# Queueing delay growth (seconds) that is treated as congestion
+RTT_GROWTH = 0.1
+
+# Motion priority: resolutions to step through, largest first
+RESOLUTIONS = [(320, 240), (240, 180), (160, 120)]
+
+# Step down when the delivered framerate falls this far short of the
+# framerate asked for, step up after this many seconds at it
+FRAMERATE_MARGIN = 1.5
+STEP_UP_SECONDS = 5
+
+# Frame gate: seconds of the available bitrate the encoder may run ahead
+# by (room for a keyframe), encoded frames waiting to be sent that count
+# as backed up, and the longest (seconds) the gate may hold the picture
+GATE_BURST_SECONDS = 0.5
+GATE_QUEUE_FRAMES = 2
+GATE_MAX_GAP = 0.5
+
+
+#################
+# RateController
+#################
+class RateController(object):
+    """
+    Retunes the outgoing video encoder from RTCP receiver reports.
+
+    Loss below LOSS_LOW grows the bitrate, loss above LOSS_HIGH cuts it in
+    proportion to the loss, and anything in between holds.  A growing round
+    trip time is treated as queueing and also holds.  Once the bitrate sits
+    on the floor and the link is still losing packets the framerate is
+    stepped down towards min_framerate, and back up when it recovers.
+
+    A bandwidth estimate (bandwidth.py), when subscribed, caps the bitrate
+    below max_bitrate.
+
+    The framerate is set on capsfilter, the one after video_rate that
+    fixes the outgoing caps, so videorate drops frames to meet it rather
+    than duplicating them back up to a framerate the caps still pin.
+    """
+
+    def __init__(self, encoder, codec, video_rate=None,
+            min_bitrate=MIN_BITRATE, max_bitrate=MAX_BITRATE,
+            min_framerate=MIN_FRAMERATE, max_framerate=MAX_FRAMERATE,
+            capsfilter=None):
+        self.encoder = encoder
+        self.codec = codec
+        self.video_rate = video_rate
+        self.capsfilter = capsfilter
+        self.min_bitrate = min_bitrate
+        self.max_bitrate = max_bitrate
+        self.min_framerate = min_framerate
+        self.max_framerate = max_framerate
+        self.min_rtt = None
+        self.fraction_lost = 0.0
+        self.available = None
+
+        self.bitrate = None
+        self.framerate = None
+        self.fast = None
+        self.set_bitrate(codec.get_bitrate(encoder))
+        self.set_framerate(max_framerate)
+
+    def set_limits(self, min_bitrate=None, max_bitrate=None,
+            min_framerate=None, max_framerate=None):
+        if min_bitrate is not None:
+            self.min_bitrate = min_bitrate
+        if max_bitrate is not None:
+            self.max_bitrate = max_bitrate
+        if min_framerate is not None:
+            self.min_framerate = min_framerate
+        if max_framerate is not None:
+            self.max_framerate = max_framerate
+
+        # Re-apply so the current values respect the new limits
+        self.set_bitrate(self.bitrate)
+        self.set_framerate(self.framerate)
+
+    def set_bitrate(self, bitrate):
+        ceiling = self.max_bitrate
+        if self.available is not None:
+            ceiling = min(ceiling, self.available)
+        bitrate = int(max(self.min_bitrate, min(ceiling, bitrate)))
+        if bitrate == self.bitrate:
+            return
+
+        self.bitrate = bitrate
+        self.codec.set_bitrate(self.encoder, bitrate)
+
+        # Favour encode speed while squeezed, spend the CPU on quality when
+        # there is room
+        fast = bitrate < (self.min_bitrate + self.max_bitrate) / 2.0
+        if fast != self.fast:
+            self.fast = fast
+            self.codec.set_speed(self.encoder, fast)
+
+        logger.debug("Video bitrate %d kbit/s, %s preset" %
+                (bitrate, "fast" if fast else "quality"))
+
+    def set_framerate(self, framerate):
+        framerate = int(max(self.min_framerate,
+                min(self.max_framerate, framerate)))
+        if framerate == self.framerate:
+            return
+
+        self.framerate = framerate
+        if self.video_rate is not None:
+            self.video_rate.set_property("max-rate", framerate)
+        if self.capsfilter is not None:
+            caps = self.capsfilter.get_property("caps").copy()
+            caps.set_value("framerate", Gst.Fraction(framerate, 1))
+            self.capsfilter.set_property("caps", caps)
+
+        logger.debug("Video framerate capped at %d fps" % framerate)
+
+    def available_bitrate(self, bitrate):
+        # Subscriber of a BandwidthEstimator, kbit/s
+        self.available = bitrate
+        self.set_bitrate(min(self.bitrate, bitrate))
+
+    def receiver_report(self, fraction_lost, jitter, rtt):
+        """
+        Feed one receiver report in.  fraction_lost is 0.0 - 1.0, jitter
+        and rtt are in seconds.
+        """
+        self.fraction_lost = fraction_lost
+        if self.min_rtt is None or rtt < self.min_rtt:
+            self.min_rtt = rtt
+        queueing = rtt - self.min_rtt > max(RTT_GROWTH, jitter)
+
+        if fraction_lost > LOSS_HIGH:
+            if self.bitrate <= self.min_bitrate:
+                self.set_framerate(self.framerate - 1)
+            self.set_bitrate(self.bitrate * (1 - DECREASE_FACTOR * fraction_lost))
+        elif fraction_lost < LOSS_LOW and not queueing:
+            if self.framerate < self.max_framerate:
+                self.set_framerate(self.framerate + 1)
+            else:
+                self.set_bitrate(self.bitrate * INCREASE_FACTOR)
+
+    def rtcp_stats(self, stats):
+        """
+        Feed the stats structure of an RTPSource that carries a report
+        block about us (rb-* fields, as set by rtpsession).
+        """
+        if not stats.get_value("have-rb"):
+            return
+
+        # rtpsession reports the fraction in 1/256ths, jitter in clock-rate
+        # units and the round trip in NTP short format (1/65536 s)
+        clock_rate = stats.get_value("clock-rate")
+        if not clock_rate or clock_rate < 0:
+            clock_rate = 90000
+        self.receiver_report(
+                stats.get_value("rb-fractionlost") / 256.0,
+                stats.get_value("rb-jitter") / float(clock_rate),
+                stats.get_value("rb-round-trip") / 65536.0)
+
+
+################
+# MotionPriority
+################
+class MotionPriority(object):
+    """
+    Trades resolution for framerate.  For signing the framerate matters
+    more than the pixels, so when the framerate delivered to the peer falls
+    short of the framerate asked for, the capsfilter's or the lower one
+    the rate_controller picked (never below min_framerate), the capsfilter
+    in front of the tee is stepped down a resolution; videoscale and the
+    encoder renegotiate in place.  Once the framerate asked for has held
+    for STEP_UP_SECONDS it steps back up.
+
+    The delivered framerate is what leaves the encoder, less the share the
+    peer reports as lost.  Frames a still_gate (video_analysis.py) skips
+    while the picture holds still are not counted against it, nor are
+    the seconds video_out, the VideoOutBin, is muted.
+    """
+
+    def __init__(self, capsfilter, encoder, rate_controller=None,
+            min_framerate=MIN_FRAMERATE, resolutions=RESOLUTIONS,
+            still_gate=None, video_out=None):
+        self.capsfilter = capsfilter
+        self.rate_controller = rate_controller
+        self.still_gate = still_gate
+        self.video_out = video_out
+        self._muted = False
+        self.min_framerate = min_framerate
+        self.resolutions = resolutions
+
+        structure = capsfilter.get_property("caps").get_structure(0)
+        self.framerate = structure.get_fraction("framerate")[1:]
+        self.level = self._closest_level(structure.get_int("width")[1])
+
+        self.frames = 0
+        self.good_seconds = 0
+        self.delivered_framerate = None
+        self._probe_pad = encoder.get_static_pad("src")
+        self._probe_id = self._probe_pad.add_probe(Gst.PadProbeType.BUFFER,
+                self._on_frame)
+        self._timeout_id = GLib.timeout_add_seconds(1, self._on_tick)
+
+    def _closest_level(self, width):
+        widths = [abs(w - width) for w, h in self.resolutions]
+        return widths.index(min(widths))
+
+    def stop(self):
+        if self._timeout_id is not None:
+            GLib.source_remove(self._timeout_id)
+            self._timeout_id = None
+        if self._probe_id is not None:
+            self._probe_pad.remove_probe(self._probe_id)
+            self._probe_id = None
+
+    def _on_frame(self, pad, info):
+        # Codec headers are not frames
+        if not info.get_buffer().has_flags(Gst.BufferFlags.HEADER):
+            self.frames += 1
+        return Gst.PadProbeReturn.OK
+
+    def _on_tick(self):
+        fraction_lost = 0.0
+        if self.rate_controller is not None:
+            fraction_lost = self.rate_controller.fraction_lost
+        self.delivered_framerate = self.frames * (1 - fraction_lost)
+        self.frames = 0
+
+        # A still picture sends few frames on purpose, a muted one none;
+        # the second it was unmuted in is only partly counted
+        muted = self.video_out is not None and self.video_out.muted
+        was_muted = self._muted
+        self._muted = muted
+        if muted or was_muted:
+            self.good_seconds = 0
+            return True
+        if self.still_gate is not None and self.still_gate.idle:
+            self.good_seconds = 0
+            return True
+
+        # The RateController cutting the framerate under loss is not a
+        # shortfall, only falling behind what it asks for is
+        target = self.framerate[0] / float(self.framerate[1])
+        if self.rate_controller is not None:
+            target = min(target, self.rate_controller.framerate)
+        target = max(target, self.min_framerate)
+
+        if self.delivered_framerate < target - FRAMERATE_MARGIN:
+            self.good_seconds = 0
+            self.set_level(self.level + 1)
+        elif self.delivered_framerate >= target - 0.5:
+            self.good_seconds += 1
+            if self.good_seconds >= STEP_UP_SECONDS:
+                self.good_seconds = 0
+                self.set_level(self.level - 1)
+        else:
+            self.good_seconds = 0
+        return True
+
+    def set_level(self, level):
+        level = max(0, min(len(self.resolutions) - 1, level))
+        if level == self.level:
+            return
+
+        self.level = level
+        width, height = self.resolutions[level]
+        logger.debug("Motion priority: %dx%d at %.1f fps delivered" %
+                (width, height, self.delivered_framerate or 0))
+        caps = self.capsfilter.get_property("caps").copy()
+        caps.set_value("width", width)
+        caps.set_value("height", height)
+        self.capsfilter.set_property("caps", caps)
+
+
+###########
+# FrameGate
+###########
+class FrameGate(object):
+    """
+    Drops whole raw frames in front of the encoder while the link is
+    congested, rather than encoding them and losing packets further on.
+    Every frame that is encoded then goes out, so the stream stays
+    decodable, and the encoder gets the time off.
+
+    The link is congested when the encoder has run ahead of the
+    available bitrate (a bucket refilled at the bandwidth estimate, see
+    available_bitrate) or when encoded frames back up in front of the
+    payloader.  The gate never holds the picture for over GATE_MAX_GAP.
+    """
+
+    def __init__(self, encoder, payloader):
+        self.bitrate = None
+        self.drops = 0
+        self.active = False
+        self._credit = 0.0
+        self._last_refill = None
+        self._last_frame = None
+
+        # Encoded frames waiting to be sent, only when the encoder runs
+        # in a thread of its own (see link_threaded)
+        self.queue = None
+        upstream = payloader.get_static_pad("sink").get_peer()
+        if upstream is not None:
+            element = upstream.get_parent_element()
+            if element.get_factory().get_name() == "queue":
+                self.queue = element
+
+        self._sink_pad = encoder.get_static_pad("sink")
+        self._src_pad = encoder.get_static_pad("src")
+        self._sink_probe_id = self._sink_pad.add_probe(
+                Gst.PadProbeType.BUFFER, self._on_raw_frame)
+        self._src_probe_id = self._src_pad.add_probe(
+                Gst.PadProbeType.BUFFER, self._on_encoded)
+
+    def stop(self):
+        if self._sink_probe_id is not None:
+            self._sink_pad.remove_probe(self._sink_probe_id)
+            self._sink_probe_id = None
+        if self._src_probe_id is not None:
+            self._src_pad.remove_probe(self._src_probe_id)
+            self._src_probe_id = None
+
+    def available_bitrate(self, bitrate):
+        # Subscriber of a BandwidthEstimator, kbit/s
+        self.bitrate = bitrate
+
+    def _refill(self, now):
+        if self._last_refill is not None and self.bitrate is not None:
+            rate = self.bitrate * 1000 / 8.0
+            self._credit = min(self._credit +
+                    rate * (now - self._last_refill),
+                    rate * GATE_BURST_SECONDS)
+        self._last_refill = now
+
+    def _on_encoded(self, pad, info):
+        self._credit -= info.get_buffer().get_size()
+        return Gst.PadProbeReturn.OK
+
+    def _on_raw_frame(self, pad, info):
+        now = time.time()
+        self._refill(now)
+
+        backed_up = self.queue is not None and \
+                self.queue.get_property("current-level-buffers") >= \
+                GATE_QUEUE_FRAMES
+        congested = backed_up or \
+                (self.bitrate is not None and self._credit < 0)
+        held_too_long = self._last_frame is not None and \
+                now - self._last_frame > GATE_MAX_GAP
+
+        if congested and not held_too_long:
+            if not self.active:
+                self.active = True
+                logger.debug("Frame gate closed, dropping before the encoder")
+            self.drops += 1
+            return Gst.PadProbeReturn.DROP
+
+        if self.active and not congested:
+            self.active = False
+            logger.debug("Frame gate open after %d drops" % self.drops)
+        self._last_frame = now
+        return Gst.PadProbeReturn.OK
@@ -0,0 +1,177 @@
+#    This file is part of OpenVideoChat.
+#
+#    OpenVideoChat is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    OpenVideoChat is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with OpenVideoChat.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod: `OpenVideoChat/OpenVideoChat.activity/recorder` --
+        Open Video Chat Call Recorder
+=======================================================================
+
+Records a call to Matroska without encoding anything a second time.  The
+RTP of each stream is copied off a pad of the call pipelines into an
+appsrc of a pipeline of its own:
+
+    appsrc ! depayloader ! matroskamux ! filesink
+
+so the recording costs a depayload and a mux, and a slow disk can only
+drop from the recording, never hold up the call.  Chat messages go in a
+subtitle track, timed with the call.
+"""
+
+
+# External Imports
+import logging
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+from gi.repository import GLib
+
+
+# Define Logger for Logging
+logger = logging.getLogger('ovc-activity')
+
+
+# Bytes of RTP each stream may have queued for the muxer before the
+# recording starts dropping
+TAP_BYTES = 1024 * 1024
+
+# A stream with nothing for this many seconds (muted, or the peer left)
+# is filled with a gap, so the muxer does not wait on it
+IDLE_SECONDS = 0.5
+
+# Seconds to wait for the file to be finalised before giving up on it
+EOS_TIMEOUT = 5
+
+# Chat track, and how long each message is shown for in playback
+CHAT_CAPS = "text/x-raw,format=utf8"
+CHAT_SECONDS = 5
+
+
+######
+# Tap
+######
+class Tap(object):
+    """
+    Copies RTP buffers off a pad into an appsrc, restamped to the
+    recorder's running time.
+    """
+
+    def __init__(self, recorder, pad, codec):
+        self.recorder = recorder
+        self.pad = pad
+        self.drops = 0
+        self._offset = None
+        self._last = None
+
+        self.appsrc = Gst.ElementFactory.make("appsrc", None)
+        self.appsrc.set_property("caps", Gst.caps_from_string(codec.rtp_caps()))
+        self.appsrc.set_property("format", Gst.Format.TIME)
+        self.appsrc.set_property("is-live", True)
+        self.appsrc.set_property("max-bytes", TAP_BYTES)
+        self.appsrc.set_property("block", False)
+        self.depayloader = codec.make_depayloader()
+
+        self._probe_id = pad.add_probe(Gst.PadProbeType.BUFFER, self._on_buffer)
+
+    def _on_buffer(self, pad, info):
+        buffer = info.get_buffer()
+        now = self.recorder.running_time()
+        if now is None or buffer.pts == Gst.CLOCK_TIME_NONE:
+            return Gst.PadProbeReturn.OK
+
+        # Bounded: drop rather than queue without end
+        if self.appsrc.get_current_level_bytes() >= TAP_BYTES:
+            self.drops += 1
+            return Gst.PadProbeReturn.OK
+
+        # Keep the stream's own spacing, starting from when it arrived
+        if self._offset is None:
+            self._offset = now - buffer.pts
+        copy = buffer.copy()
+        copy.pts = max(buffer.pts + self._offset, 0)
+        copy.dts = Gst.CLOCK_TIME_NONE
+        self._last = copy.pts
+        self.appsrc.emit("push-buffer", copy)
+        return Gst.PadProbeReturn.OK
+
+    def fill(self, now):
+        # Tell the muxer there is nothing to wait for up to now; only once
+        # the stream has started, a gap needs the segment of a first buffer
+        if self._last is None:
+            return
+        if now - self._last > IDLE_SECONDS * Gst.SECOND:
+            self.appsrc.send_event(Gst.Event.new_gap(self._last,
+                    now - self._last))
+            self._last = now
+
+    def stop(self, on_done=None):
+        """
+        Finish the file: end every stream and let the muxer write its
+        cues.  Returns at once; on_done(finalised) is called from the main
+        loop once the file is written, or with False if it could not be
+        finalised within EOS_TIMEOUT seconds.
+        """
+        if self._timeout_id is not None:
+            GLib.source_remove(self._timeout_id)
+            self._timeout_id = None
+        self._on_done = on_done
+
+        bus = self.pipeline.get_bus()
+        bus.add_signal_watch()
+        self._bus_ids = [bus.connect("message::eos", self._on_eos),
+                bus.connect("message::error", self._on_error)]
+        self._eos_timeout_id = GLib.timeout_add_seconds(EOS_TIMEOUT,
+                self._on_eos_timeout)
+
+        for tap in self.taps:
+            tap.stop()
+        self.chat.emit("end-of-stream")
+
+    def _on_eos(self, bus, message):
+        self._finish(True)
+
+    def _on_error(self, bus, message):
+        error, debug = message.parse_error()
+        logger.error("Recording %s failed: %s" % (self.path, error.message))
+        self._finish(False)
+
+    def _on_eos_timeout(self):
+        self._eos_timeout_id = None
+        logger.error("Recording %s timed out waiting for EOS" % self.path)
+        self._finish(False)
+        return False
+
+    def _finish(self, finalised):
+        # Once only, whichever of EOS, an error or the timeout comes first
+        if not self._bus_ids:
+            return
+        bus = self.pipeline.get_bus()
+        for bus_id in self._bus_ids:
+            bus.disconnect(bus_id)
+        self._bus_ids = []
+        bus.remove_signal_watch()
+        if self._eos_timeout_id is not None:
+            GLib.source_remove(self._eos_timeout_id)
+            self._eos_timeout_id = None
+        self.pipeline.set_state(Gst.State.NULL)
+
+        drops = self.get_drops()
+        if drops:
+            logger.warning("Recording dropped %d packets" % drops)
+        if not finalised:
+            logger.error("Recording %s was not finalised" % self.path)
+        if self._on_done is not None:
+            self._on_done(finalised)
+
+    def get_drops(self):
+        return sum(tap.drops for tap in self.taps)
@@ -0,0 +1,431 @@
+#    This file is part of OpenVideoChat.
+#
+#    OpenVideoChat is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    OpenVideoChat is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with OpenVideoChat.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod: `OpenVideoChat/OpenVideoChat.activity/relay` --
+        Open Video Chat Selective Forwarding Relay
+=======================================================================
+
+Headless relay for the school server.  Every participant sends its
+simulcast layers and audio up once, and the relay forwards each stream
+to the others as it is, without decoding, picking for every receiver the
+largest layer that fits its bandwidth.
+
+    python relay.py --call 10.0.0.2 10.0.0.3 10.0.0.4 --call 10.0.0.5 10.0.0.6
+
+Each call gets a pipeline and a block of ports of its own.  Participants
+call GSTStack.join_relay with the block and their slot, then
+add_participant(relay ip, slot) for each of the others.  Their receiver
+reports and keyframe requests go back up through the relay too, to the
+layer they get.
+"""
+
+
+# External Imports
+import sys
+import time
+import argparse
+import logging
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+from gi.repository import GLib
+
+
+# Define Logger for Logging
+logger = logging.getLogger('ovc-activity')
+
+
+# Local Imports
+import transport
+from transport import VIDEO_RTP_PORT
+from transport import VIDEO_RTCP_PORT
+from transport import AUDIO_RTP_PORT
+from transport import AUDIO_RTCP_PORT
+from transport import VIDEO_RTCP_RR_PORT
+from transport import AUDIO_RTCP_RR_PORT
+from transport import SIMULCAST_LAYERS
+
+
+# Call k gets the ports (k + 1) * CALL_PORT_STEP above the plain ones,
+# room for MAX_SLOTS participants each
+CALL_PORT_STEP = 1000
+MAX_SLOTS = 8
+
+# Highest UDP port; calls whose block would go past it are refused
+MAX_PORT = 65535
+
+# Layers every participant sends, full size first
+LAYERS = 1 + len(SIMULCAST_LAYERS)
+
+# kbit/s of a receiver's bandwidth kept for each audio stream and RTCP
+AUDIO_BANDWIDTH = 40
+
+# A receiver only moves up to a larger layer once it fits this share of
+# the bandwidth, so it does not flap between two
+LAYER_HEADROOM = 0.8
+
+# Seconds between bitrate measurements and layer choices
+UPDATE_SECONDS = 1
+
+
+def last_port(base):
+    # Highest port a call on the block at base listens on
+    ports = [transport.relay_port(base, port, MAX_SLOTS - 1, layer)
+            for port in (VIDEO_RTP_PORT, VIDEO_RTCP_PORT)
+            for layer in range(LAYERS)]
+    ports += [transport.relay_port(base, port, MAX_SLOTS - 1)
+            for port in (AUDIO_RTP_PORT, AUDIO_RTCP_PORT,
+            VIDEO_RTCP_RR_PORT, AUDIO_RTCP_RR_PORT)]
+    return max(ports)
+
+
+class RelayFull(ValueError):
+    """
+    A join the relay has no room for: the call has all MAX_SLOTS
+    participants, or the relay has no ports left for another call.
+    """
+
+
+##############
+# RelayStream
+##############
+class RelayStream(object):
+    """
+    One UDP flow forwarded as it is: udpsrc ! multiudpsink.  The bytes
+    multiudpsink took in are read on every update, so layers are chosen
+    by the bitrate they really have, with no Python on the packet path.
+    """
+
+    def __init__(self, pipeline, port):
+        self.pipeline = pipeline
+        self.port = port
+        self.clients = set()
+        self.kbps = 0.0
+        self._bytes = 0
+
+        self.src = Gst.ElementFactory.make("udpsrc", None)
+        self.src.set_property("port", port)
+        self.sink = Gst.ElementFactory.make("multiudpsink", None)
+        self.sink.set_property("sync", False)
+        self.sink.set_property("async", False)
+        pipeline.add(self.src)
+        pipeline.add(self.sink)
+        self.src.link(self.sink)
+
+        self.sink.sync_state_with_parent()
+        self.src.sync_state_with_parent()
+
+    def add(self, ip, port):
+        if (ip, port) not in self.clients:
+            self.clients.add((ip, port))
+            self.sink.emit("add", ip, port)
+
+    def remove(self, ip, port):
+        if (ip, port) in self.clients:
+            self.clients.remove((ip, port))
+            self.sink.emit("remove", ip, port)
+
+    def measure(self, elapsed):
+        total = self.sink.get_property("bytes-to-serve")
+        self.kbps = (total - self._bytes) * 8 / elapsed / 1000
+        self._bytes = total
+
+    def stop(self):
+        for element in (self.src, self.sink):
+            element.set_state(Gst.State.NULL)
+            self.pipeline.remove(element)
+
+
+############
+# RelayCall
+############
+class RelayCall(object):
+    """
+    Forwards between the participants of one call.  Streams are keyed by
+    (slot, port, layer), port being the plain transport port they stand
+    for; _layers holds the layer each receiver gets of each sender.
+    """
+
+    def __init__(self, base):
+        self.base = base
+        self.participants = {}
+        self._streams = {}
+        self._layers = {}
+        self._fixed = {}
+        self._bandwidth = {}
+
+        # Live, elements start as they are added
+        self.pipeline = Gst.Pipeline()
+        self.pipeline.set_state(Gst.State.PLAYING)
+
+    def _add_stream(self, slot, port, layer=0):
+        self._streams[(slot, port, layer)] = RelayStream(self.pipeline,
+                transport.relay_port(self.base, port, slot, layer))
+
+    def add_participant(self, ip, slot=None):
+        if slot is None:
+            free = [k for k in range(MAX_SLOTS) if k not in self.participants]
+            if not free:
+                raise RelayFull("Relay call %d is full, %d participants" %
+                        (self.base, MAX_SLOTS))
+            slot = free[0]
+        elif slot in self.participants or not 0 <= slot < MAX_SLOTS:
+            raise RelayFull("Relay call %d has no slot %d" % (self.base, slot))
+
+        # Media and sender reports up from the participant
+        for layer in range(LAYERS):
+            self._add_stream(slot, VIDEO_RTP_PORT, layer)
+            self._add_stream(slot, VIDEO_RTCP_PORT, layer)
+        self._add_stream(slot, AUDIO_RTP_PORT)
+        self._add_stream(slot, AUDIO_RTCP_PORT)
+
+        # Its receiver reports and feedback about everyone else
+        self._add_stream(slot, VIDEO_RTCP_RR_PORT)
+        self._add_stream(slot, AUDIO_RTCP_RR_PORT)
+
+        self.participants[slot] = ip
+        for other in self.participants:
+            if other != slot:
+                self._connect(other, slot)
+                self._connect(slot, other)
+        logger.info("Relay call %d: %s on slot %d" % (self.base, ip, slot))
+        return slot
+
+    def remove_participant(self, slot):
+        for other in self.participants:
+            if other != slot:
+                self._disconnect(other, slot)
+                self._disconnect(slot, other)
+        del self.participants[slot]
+        for key in [key for key in self._streams if key[0] == slot]:
+            self._streams.pop(key).stop()
+        for pair in [pair for pair in self._layers if slot in pair]:
+            del self._layers[pair]
+        self._fixed = dict((pair, layer) for pair, layer in
+                self._fixed.items() if slot not in pair)
+        self._bandwidth.pop(slot, None)
+
+    def _connect(self, sender, receiver):
+        # Audio down to the receiver's ports for the sender's slot, its
+        # reports back up
+        ip = self.participants[receiver]
+        self._streams[(sender, AUDIO_RTP_PORT, 0)].add(ip,
+                transport.participant_port(AUDIO_RTP_PORT, sender))
+        self._streams[(sender, AUDIO_RTCP_PORT, 0)].add(ip,
+                transport.participant_port(AUDIO_RTCP_PORT, sender))
+        self._streams[(receiver, AUDIO_RTCP_RR_PORT, 0)].add(
+                self.participants[sender], AUDIO_RTCP_RR_PORT)
+        self._forward(sender, receiver, self._pick_layer(receiver, sender))
+
+    def _disconnect(self, sender, receiver):
+        ip = self.participants[receiver]
+        self._streams[(sender, AUDIO_RTP_PORT, 0)].remove(ip,
+                transport.participant_port(AUDIO_RTP_PORT, sender))
+        self._streams[(sender, AUDIO_RTCP_PORT, 0)].remove(ip,
+                transport.participant_port(AUDIO_RTCP_PORT, sender))
+        self._streams[(receiver, AUDIO_RTCP_RR_PORT, 0)].remove(
+                self.participants[sender], AUDIO_RTCP_RR_PORT)
+        self._unforward(sender, receiver)
+
+    def _forward(self, sender, receiver, layer):
+        # One layer down, all on the plain video ports for the sender's
+        # slot; the receiver's feedback goes up to that layer's session
+        ip = self.participants[receiver]
+        self._layers[(receiver, sender)] = layer
+        self._streams[(sender, VIDEO_RTP_PORT, layer)].add(ip,
+                transport.participant_port(VIDEO_RTP_PORT, sender))
+        self._streams[(sender, VIDEO_RTCP_PORT, layer)].add(ip,
+                transport.participant_port(VIDEO_RTCP_PORT, sender))
+        self._streams[(receiver, VIDEO_RTCP_RR_PORT, 0)].add(
+                self.participants[sender], transport.layer_rr_port(layer))
+
+    def _unforward(self, sender, receiver):
+        ip = self.participants[receiver]
+        layer = self._layers.pop((receiver, sender))
+        self._streams[(sender, VIDEO_RTP_PORT, layer)].remove(ip,
+                transport.participant_port(VIDEO_RTP_PORT, sender))
+        self._streams[(sender, VIDEO_RTCP_PORT, layer)].remove(ip,
+                transport.participant_port(VIDEO_RTCP_PORT, sender))
+        self._streams[(receiver, VIDEO_RTCP_RR_PORT, 0)].remove(
+                self.participants[sender], transport.layer_rr_port(layer))
+
+    def _pick_layer(self, receiver, sender):
+        if (receiver, sender) in self._fixed:
+            return self._fixed[(receiver, sender)]
+        bandwidth = self._bandwidth.get(receiver)
+        if bandwidth is None:
+            return 0
+
+        # Share the receiver's bandwidth out evenly over the senders
+        senders = max(len(self.participants) - 1, 1)
+        share = bandwidth / float(senders) - AUDIO_BANDWIDTH
+        current = self._layers.get((receiver, sender), LAYERS - 1)
+        lowest = 0
+        for layer in range(LAYERS):
+            kbps = self._streams[(sender, VIDEO_RTP_PORT, layer)].kbps
+
+            # A sender without simulcast has nothing on the smaller layers
+            if kbps == 0:
+                continue
+            lowest = layer
+            if layer < current:
+                kbps /= LAYER_HEADROOM
+            if kbps <= share:
+                return layer
+
+        # None fits, the smallest layer that carries video
+        return lowest
+
+    def _switch(self, sender, receiver):
+        layer = self._pick_layer(receiver, sender)
+        if layer != self._layers[(receiver, sender)]:
+            logger.debug("Relay call %d: slot %d gets layer %d of slot %d" %
+                    (self.base, receiver, layer, sender))
+            self._unforward(sender, receiver)
+            self._forward(sender, receiver, layer)
+
+    def set_layer(self, receiver, sender, layer=None):
+        """
+        Fix the layer receiver gets of sender, None to choose it by
+        bandwidth again.
+        """
+        if layer is None:
+            self._fixed.pop((receiver, sender), None)
+        else:
+            self._fixed[(receiver, sender)] = layer
+        self._switch(sender, receiver)
+
+    def set_bandwidth(self, receiver, kbps=None):
+        """
+        Downlink bandwidth of a receiver in kbit/s, None for no limit.
+        """
+        self._bandwidth[receiver] = kbps
+        for sender in self.participants:
+            if sender != receiver:
+                self._switch(sender, receiver)
+
+    def update(self, elapsed):
+        for stream in self._streams.values():
+            stream.measure(elapsed)
+        for receiver, sender in list(self._layers.keys()):
+            self._switch(sender, receiver)
+
+    def stats(self):
+        """
+        kbit/s up and down per slot, and the layer it gets of each sender.
+        """
+        stats = {}
+        for slot, ip in self.participants.items():
+            up = sum(stream.kbps for key, stream in self._streams.items()
+                    if key[0] == slot and key[1] in (VIDEO_RTP_PORT,
+                    AUDIO_RTP_PORT))
+            layers = dict((sender, layer) for (receiver, sender), layer
+                    in self._layers.items() if receiver == slot)
+            down = sum(self._streams[(sender, VIDEO_RTP_PORT, layer)].kbps +
+                    self._streams[(sender, AUDIO_RTP_PORT, 0)].kbps
+                    for sender, layer in layers.items())
+            stats[slot] = {"ip": ip, "up": up, "down": down, "layers": layers}
+        return stats
+
+    def stop(self):
+        self.pipeline.set_state(Gst.State.NULL)
+
+
+########
+# Relay
+########
+class Relay(object):
+
+    def __init__(self):
+        self.calls = {}
+        self._since = time.time()
+        self._timeout_id = GLib.timeout_add_seconds(UPDATE_SECONDS,
+                self._on_tick)
+
+    def add_call(self):
+        index = min(k for k in range(len(self.calls) + 1)
+                if k not in self.calls)
+        base = (index + 1) * CALL_PORT_STEP
+        if last_port(base) > MAX_PORT:
+            raise RelayFull("No ports left for call %d, the relay takes "
+                    "%d calls" % (index, index))
+        self.calls[index] = RelayCall(base)
+        return index
+
+    def remove_call(self, index):
+        self.calls.pop(index).stop()
+
+    def _on_tick(self):
+        now = time.time()
+        elapsed = max(now - self._since, 0.001)
+        self._since = now
+        for call in self.calls.values():
+            call.update(elapsed)
+        return True
+
+    def stop(self):
+        GLib.source_remove(self._timeout_id)
+        for index in list(self.calls.keys()):
+            self.remove_call(index)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--call", nargs="+", action="append", default=[],
+            metavar="IP", help="participants of one call, in slot order")
+    parser.add_argument("--bandwidth", type=int, default=None,
+            help="downlink kbit/s of every receiver")
+    parser.add_argument("--stats", type=int, default=0, metavar="SECONDS",
+            help="print the bitrates this often")
+    args = parser.parse_args(argv)
+
+    Gst.init(None)
+    relay = Relay()
+    for ips in args.call:
+        try:
+            index = relay.add_call()
+        except RelayFull as error:
+            logger.error(str(error))
+            break
+        call = relay.calls[index]
+        for ip in ips:
+            try:
+                slot = call.add_participant(ip)
+            except RelayFull as error:
+                logger.error("%s, %s not joined" % (error, ip))
+                continue
+            call.set_bandwidth(slot, args.bandwidth)
+            print("call %d: %s join_relay(ip, %d, %d)" %
+                    (index, ip, call.base, slot))
+
+    def print_stats():
+        for index, call in relay.calls.items():
+            for slot, stats in call.stats().items():
+                print("call %d slot %d %s: up %.0f down %.0f kbit/s, "
+                        "layers %s" % (index, slot, stats["ip"], stats["up"],
+                        stats["down"], stats["layers"]))
+        return True
+    if args.stats:
+        GLib.timeout_add_seconds(args.stats, print_stats)
+
+    try:
+        GLib.MainLoop().run()
+    except KeyboardInterrupt:
+        pass
+    relay.stop()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,549 @@
+#    This file is part of OpenVideoChat.
+#
+#    OpenVideoChat is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    OpenVideoChat is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with OpenVideoChat.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod: `OpenVideoChat/OpenVideoChat.activity/transport` --
+        Open Video Chat RTP Transport
+=======================================================================
+
+Wraps an rtpbin inside a pipeline, following the topology of
+scratch_files/gst_shell/server.sh and client.sh:
+
+    send:    bin ! rtpbin.send_rtp_sink_N   rtpbin.send_rtp_src_N ! udpsink
+             rtpbin.send_rtcp_src_N ! udpsink    udpsrc ! rtpbin.recv_rtcp_sink_N
+    receive: udpsrc ! rtpbin.recv_rtp_sink_N   rtpbin.recv_rtp_src_N_* ! bin
+             udpsrc ! rtpbin.recv_rtcp_sink_N  rtpbin.send_rtcp_src_N ! udpsink
+"""
+
+
+# External Imports
+import logging
+import gi
+gi.require_version('Gst', '1.0')
+gi.require_version('GstRtp', '1.0')
+gi.require_version('GstVideo', '1.0')
+from gi.repository import Gst
+from gi.repository import GstRtp
+from gi.repository import GstVideo
+
+
+# Define Logger for Logging
+logger = logging.getLogger('ovc-activity')
+
+
+# Session ids
+VIDEO_SESSION = 0
+AUDIO_SESSION = 1
+
+# Ports: RTP to the receiver, sender reports to the receiver, receiver
+# reports back to the sender
+VIDEO_RTP_PORT = 5004
+AUDIO_RTP_PORT = 5005
+VIDEO_RTCP_PORT = 5006
+AUDIO_RTCP_PORT = 5007
+VIDEO_RTCP_RR_PORT = 5008
+AUDIO_RTCP_RR_PORT = 5009
+
+# Simulcast layers sent besides the full size stream: (width, height,
+# kbit/s), layer k + 1 being SIMULCAST_LAYERS[k]
+SIMULCAST_LAYERS = [(240, 180, 128), (160, 120, 64)]
+
+# Receiver reports for simulcast layer k come back on
+# VIDEO_RTCP_RR_PORT + k * LAYER_PORT_STEP
+LAYER_PORT_STEP = 10
+
+# Participant k of an N-way call sends to the RTP and sender report ports
+# plus k * PARTICIPANT_PORT_STEP; receiver reports all come back to the
+# plain ports
+PARTICIPANT_PORT_STEP = 100
+
+# Hops a multicast stream may take, 1 keeps it on the classroom network
+MULTICAST_TTL = 1
+
+# Jitter buffer latency target in ms
+LATENCY = 200
+
+# Payload types of the FEC and retransmission streams for a protected
+# session, and how long (ms) packets are kept around to repair with them
+FEC_PT = 122
+RTX_PT = 123
+REPAIR_TIME = 500
+
+# FEC overhead (percent of media packets) used once the loss fraction
+# reaches FEC_LOSS_ON, until it falls back under FEC_LOSS_OFF
+FEC_PERCENTAGE = 20
+FEC_LOSS_ON = 0.03
+FEC_LOSS_OFF = 0.01
+
+# Transport-wide congestion control: the sender numbers every packet of
+# a session in this header extension and the receiver feeds back when
+# each one arrived (see bandwidth.py)
+TWCC_URI = "http://www.ietf.org/id/draft-holmer-rmcat-transport-wide-cc-extensions-01"
+TWCC_EXT_ID = 3
+
+# Playout of each received session is compared with its sender reports
+# once every SKEW_SAMPLE packets
+SKEW_SAMPLE = 25
+
+
+def layer_session(layer):
+    # Layer 0 is the normal video session
+    if layer == 0:
+        return VIDEO_SESSION
+    return AUDIO_SESSION + layer
+
+
+def layer_port(port, layer):
+    return port + layer * LAYER_PORT_STEP
+
+
+def layer_rr_port(layer):
+    """
+    Receivers get every simulcast layer on the plain video ports, only
+    their receiver reports go back to a port of the layer's own.
+    """
+    return layer_port(VIDEO_RTCP_RR_PORT, layer)
+
+
+def participant_port(port, slot):
+    return port + slot * PARTICIPANT_PORT_STEP
+
+
+def relay_port(base, port, slot, layer=0):
+    """
+    Port on a relay (relay.py) for one stream of participant slot; base
+    is the port block of the call.
+    """
+    return base + participant_port(layer_port(port, layer), slot)
+
+
+###############
+# RtpTransport
+###############
+class RtpTransport(object):
+
+    def __init__(self, pipeline, latency=LATENCY):
+        self.pipeline = pipeline
+
+        # Sessions, jitter buffers and RTCP all live in the rtpbin
+        self.rtpbin = Gst.ElementFactory.make("rtpbin", None)
+        self.rtpbin.set_property("latency", latency)
+        self.rtpbin.set_property("drop-on-latency", True)
+        self.rtpbin.set_property("do-lost", True)
+
+        # Lip-sync: streams with the same CNAME are lined up from their
+        # sender reports by delaying the early one, never by more than the
+        # latency target
+        self.rtpbin.set_property("max-ts-offset", latency * Gst.MSECOND)
+
+        # AVPF sends feedback (keyframe requests) at once instead of
+        # waiting for the next regular RTCP interval
+        Gst.util_set_object_arg(self.rtpbin, "rtp-profile", "avpf")
+        self.pipeline.add(self.rtpbin)
+
+        self._elements = []
+        self._recv_bins = {}
+        self._rtp_sinks = {}
+        self._rtcp_sinks = {}
+        self._client_ports = {}
+        self._report_callbacks = {}
+        self.rtpbin.connect("pad-added", self._on_pad_added)
+        self.rtpbin.connect("on-ssrc-active", self._on_ssrc_active)
+
+        # FEC and retransmission, see protect_session
+        self._recv_caps = {}
+        self._protected = {}
+        self._fec_encoders = {}
+        self.rtpbin.connect("request-pt-map", self._on_request_pt_map)
+        self.rtpbin.connect("request-fec-encoder", self._on_request_fec_encoder)
+        self.rtpbin.connect("request-fec-decoder", self._on_request_fec_decoder)
+        self.rtpbin.connect("request-aux-sender", self._on_request_aux_sender)
+        self.rtpbin.connect("request-aux-receiver",
+                self._on_request_aux_receiver)
+
+        # A/V skew, see get_av_skew
+        self._sender_reports = {}
+        self._playout_offsets = {}
+        self._playout_packets = {}
+
+        # Multicast group, ttl and interface, see set_multicast
+        self._multicast = None
+
+    def _make(self, factory, **properties):
+        element = Gst.ElementFactory.make(factory, None)
+        for name, value in properties.items():
+            element.set_property(name.replace("_", "-"), value)
+        self.pipeline.add(element)
+        self._elements.append(element)
+        return element
+
+    def set_multicast(self, group, ttl=MULTICAST_TTL, iface=None):
+        """
+        Send and receive everything, RTCP included, on a multicast group
+        instead of unicast.  Call before adding sessions; iface is the
+        network interface to join on (None for the default route).
+        """
+        self._multicast = (group, ttl, iface)
+
+    def _udp_sink(self, ip, port, **properties):
+        element = self._make("udpsink", port=port, **properties)
+        if self._multicast is not None:
+            group, ttl, iface = self._multicast
+            ip = group
+            element.set_property("auto-multicast", True)
+            element.set_property("ttl-mc", ttl)
+            if iface is not None:
+                element.set_property("multicast-iface", iface)
+        if ip is not None:
+            element.set_property("host", ip)
+        return element
+
+    def _udp_src(self, port, **properties):
+        element = self._make("udpsrc", port=port, **properties)
+        if self._multicast is not None:
+            group, ttl, iface = self._multicast
+            element.set_property("address", group)
+            element.set_property("auto-multicast", True)
+            if iface is not None:
+                element.set_property("multicast-iface", iface)
+        return element
+
+    def sync_state(self):
+        # For a transport added to a pipeline that is already playing
+        self.rtpbin.sync_state_with_parent()
+        for element in self._elements:
+            element.sync_state_with_parent()
+
+    def remove(self):
+        """
+        Take the rtpbin and its UDP elements out of the pipeline, which may
+        keep playing.  The bins linked to it are left to the caller.
+        """
+        for element in self._elements + [self.rtpbin]:
+            element.set_state(Gst.State.NULL)
+            self.pipeline.remove(element)
+        self._elements = []
+
+    def add_send_session(self, session, src_bin, ip, rtp_port, rtcp_port,
+            rtcp_recv_port, multi=False):
+        """
+        Send src_bin's RTP to ip.  A multi session sends to any number of
+        receivers, added and removed with add_client/remove_client, and
+        ip is then the first of them (or None).  With multicast on, ip and
+        multi are ignored; the group gets it all.
+        """
+        multi = multi and self._multicast is None
+
+        # RTP out
+        src_bin.link_pads("src", self.rtpbin, "send_rtp_sink_%d" % session)
+        if multi:
+            rtp_sink = self._make("multiudpsink")
+        else:
+            rtp_sink = self._udp_sink(ip, rtp_port)
+        self.rtpbin.link_pads("send_rtp_src_%d" % session, rtp_sink, "sink")
+        self._rtp_sinks[session] = rtp_sink
+
+        # Sender reports out
+        if multi:
+            rtcp_sink = self._make("multiudpsink", sync=False)
+        else:
+            rtcp_sink = self._udp_sink(ip, rtcp_port, sync=False)
+        rtcp_sink.set_property("async", False)
+        self.rtpbin.link_pads("send_rtcp_src_%d" % session, rtcp_sink, "sink")
+        self._rtcp_sinks[session] = rtcp_sink
+
+        if multi:
+            self._client_ports[session] = (rtp_port, rtcp_port)
+            if ip is not None:
+                self.add_client(session, ip)
+
+        # Receiver reports in
+        rtcp_src = self._udp_src(rtcp_recv_port)
+        rtcp_src.link_pads("src", self.rtpbin, "recv_rtcp_sink_%d" % session)
+
+    def add_recv_session(self, session, sink_bin, caps, rtp_port, rtcp_port,
+            rtcp_send_port, ip=None):
+        # Video senders may number packets for TWCC, the session then
+        # feeds back their arrival times
+        if "video" in caps:
+            caps += ',extmap-%d=(string)"%s"' % (TWCC_EXT_ID, TWCC_URI)
+
+        # RTP in, the rtpbin adds a recv_rtp_src pad per SSRC
+        rtp_src = self._udp_src(rtp_port, caps=Gst.caps_from_string(caps))
+        self._recv_caps[session] = caps
+        rtp_src.link_pads("src", self.rtpbin, "recv_rtp_sink_%d" % session)
+        self._recv_bins[session] = sink_bin
+
+        # Sender reports in
+        rtcp_src = self._udp_src(rtcp_port)
+        rtcp_src.link_pads("src", self.rtpbin, "recv_rtcp_sink_%d" % session)
+
+        # Receiver reports out, the peer is filled in once known
+        rtcp_sink = self._udp_sink(ip, rtcp_send_port, sync=False)
+        rtcp_sink.set_property("async", False)
+        self.rtpbin.link_pads("send_rtcp_src_%d" % session, rtcp_sink, "sink")
+        self._rtcp_sinks[session] = rtcp_sink
+
+    def add_client(self, session, ip, rtp_port=None, rtcp_port=None):
+        default_rtp_port, default_rtcp_port = self._client_ports[session]
+        self._rtp_sinks[session].emit("add", ip, rtp_port or default_rtp_port)
+        self._rtcp_sinks[session].emit("add", ip,
+                rtcp_port or default_rtcp_port)
+
+    def remove_client(self, session, ip, rtp_port=None, rtcp_port=None):
+        default_rtp_port, default_rtcp_port = self._client_ports[session]
+        self._rtp_sinks[session].emit("remove", ip,
+                rtp_port or default_rtp_port)
+        self._rtcp_sinks[session].emit("remove", ip,
+                rtcp_port or default_rtcp_port)
+
+    def protect_session(self, session, payload, fec=True, rtx=True):
+        """
+        Add ULPFEC and/or NACK driven retransmission (RTX) for the given
+        payload type.  Call before add_send_session/add_recv_session, and
+        on both ends.  FEC starts with no overhead, see set_fec_percentage.
+        """
+        self._protected[session] = (payload, fec, rtx)
+        if rtx:
+            self.rtpbin.set_property("do-retransmission", True)
+
+    def add_twcc(self, payloader):
+        """
+        Number the packets out of payloader for transport-wide congestion
+        control.  Needs the header extensions of GStreamer 1.20; returns
+        False without them, estimates then come from RTCP alone.
+        """
+        if not hasattr(GstRtp, "RTPHeaderExtension"):
+            return False
+        extension = GstRtp.RTPHeaderExtension.create_from_uri(TWCC_URI)
+        if extension is None:
+            return False
+        extension.set_id(TWCC_EXT_ID)
+        payloader.emit("add-extension", extension)
+        return True
+
+    def get_twcc_stats(self, session):
+        # Summary of the last TWCC feedback, None before GStreamer 1.18;
+        # a property of the rtpsession element, not the internal session
+        rtp_session = self.rtpbin.emit("get-session", session)
+        if rtp_session is None or \
+                rtp_session.find_property("twcc-stats") is None:
+            return None
+        return rtp_session.get_property("twcc-stats")
+
+    def get_send_bitrate(self, session):
+        # Bits/s our own source sends on the session
+        rtp_session = self.rtpbin.emit("get-internal-session", session)
+        if rtp_session is None:
+            return 0
+        stats = rtp_session.get_property("internal-source") \
+                .get_property("stats")
+        return stats.get_value("bitrate") or 0
+
+    def set_fec_percentage(self, session, percentage):
+        """
+        FEC packets to send as a percentage of media packets, 0 for none.
+        """
+        encoder = self._fec_encoders.get(session)
+        if encoder is not None and \
+                encoder.get_property("percentage") != percentage:
+            logger.debug("FEC overhead on session %d: %d%%" %
+                    (session, percentage))
+            encoder.set_property("percentage", percentage)
+
+    def get_fec_percentage(self, session):
+        encoder = self._fec_encoders.get(session)
+        if encoder is None:
+            return 0
+        return encoder.get_property("percentage")
+
+    def _pt_map(self, session):
+        payload_type_map = Gst.Structure.new_empty("application/x-rtp-pt-map")
+        payload_type_map.set_value(str(self._protected[session][0]), RTX_PT)
+        return payload_type_map
+
+    def _on_request_pt_map(self, rtpbin, session, pt):
+        caps = self._recv_caps.get(session)
+        if caps is None:
+            return None
+        caps = Gst.caps_from_string(caps)
+        if session in self._protected and pt in (FEC_PT, RTX_PT):
+            structure = caps.get_structure(0)
+            payload = structure.get_int("payload")[1]
+            caps = Gst.caps_from_string(
+                    "application/x-rtp,media=(string)%s,clock-rate=(int)%d" %
+                    (structure.get_string("media"),
+                    structure.get_int("clock-rate")[1]))
+            if pt == FEC_PT:
+                caps.set_value("encoding-name", "ULPFEC")
+            else:
+                caps.set_value("encoding-name", "RTX")
+                caps.set_value("apt", payload)
+            caps.set_value("payload", pt)
+        return caps
+
+    def _on_request_fec_encoder(self, rtpbin, session):
+        if not self._protected.get(session, (None, False, False))[1]:
+            return None
+        encoder = Gst.ElementFactory.make("rtpulpfecenc", None)
+        encoder.set_property("pt", FEC_PT)
+        encoder.set_property("percentage", 0)
+        self._fec_encoders[session] = encoder
+        return encoder
+
+    def _on_request_fec_decoder(self, rtpbin, session):
+        if not self._protected.get(session, (None, False, False))[1]:
+            return None
+
+        # The decoder repairs from packets kept in the session's storage
+        storage = rtpbin.emit("get-storage", session)
+        storage.set_property("size-time", REPAIR_TIME * Gst.MSECOND)
+        decoder = Gst.ElementFactory.make("rtpulpfecdec", None)
+        decoder.set_property("pt", FEC_PT)
+        decoder.set_property("storage", storage)
+        return decoder
+
+    def _aux_bin(self, session, element):
+        aux = Gst.Bin()
+        aux.add(element)
+        aux.add_pad(Gst.GhostPad.new("sink_%d" % session,
+                element.get_static_pad("sink")))
+        aux.add_pad(Gst.GhostPad.new("src_%d" % session,
+                element.get_static_pad("src")))
+        return aux
+
+    def _on_request_aux_sender(self, rtpbin, session):
+        if not self._protected.get(session, (None, False, False))[2]:
+            return None
+        rtx = Gst.ElementFactory.make("rtprtxsend", None)
+        rtx.set_property("payload-type-map", self._pt_map(session))
+        rtx.set_property("max-size-time", REPAIR_TIME)
+        return self._aux_bin(session, rtx)
+
+    def _on_request_aux_receiver(self, rtpbin, session):
+        if not self._protected.get(session, (None, False, False))[2]:
+            return None
+        rtx = Gst.ElementFactory.make("rtprtxreceive", None)
+        rtx.set_property("payload-type-map", self._pt_map(session))
+        return self._aux_bin(session, rtx)
+
+    def set_rtcp_port(self, session, port):
+        self._rtcp_sinks[session].set_property("port", port)
+
+    def set_rtcp_host(self, ip):
+        # Multicast reports go to the group
+        if self._multicast is not None:
+            return
+        for rtcp_sink in self._rtcp_sinks.values():
+            rtcp_sink.set_property("host", ip)
+
+    def set_latency(self, latency):
+        # rtpbin passes this on to the jitter buffers it already made
+        logger.debug("Setting jitter buffer latency to %d ms" % latency)
+        self.rtpbin.set_property("latency", latency)
+        self.rtpbin.set_property("max-ts-offset", latency * Gst.MSECOND)
+
+    def get_latency(self):
+        return self.rtpbin.get_property("latency")
+
+    def connect_reports(self, session, callback):
+        """
+        Call callback with the RTPSource stats structure of every peer
+        that sends RTCP on this session.
+        """
+        self._report_callbacks[session] = callback
+
+    def _on_pad_added(self, rtpbin, pad):
+        name = pad.get_name()
+        if not name.startswith("recv_rtp_src_"):
+            return
+
+        session = int(name.split("_")[3])
+        sink_bin = self._recv_bins.get(session)
+        if sink_bin is None:
+            return
+
+        # A new SSRC replaces the old one (e.g. the peer restarted, or a
+        # relay switched layers); video then needs a keyframe to start on
+        sink_pad = sink_bin.get_static_pad("sink")
+        replaced = sink_pad.is_linked()
+        if replaced:
+            sink_pad.get_peer().unlink(sink_pad)
+        pad.link(sink_pad)
+        if replaced and "video" in self._recv_caps.get(session, ""):
+            pad.send_event(GstVideo.video_event_new_upstream_force_key_unit(
+                    Gst.CLOCK_TIME_NONE, False, 0))
+        pad.add_probe(Gst.PadProbeType.BUFFER, self._on_playout, session)
+
+    def _on_ssrc_active(self, rtpbin, session, ssrc):
+        rtp_session = rtpbin.emit("get-internal-session", session)
+        source = rtp_session.emit("get-source-by-ssrc", ssrc)
+        if source is None:
+            return
+        stats = source.get_property("stats")
+
+        # Keep the last NTP/RTP timestamp pair the peer sent for the skew
+        if stats.get_value("have-sr") and stats.get_value("clock-rate") > 0:
+            self._sender_reports[ssrc] = (stats.get_value("sr-ntptime"),
+                    stats.get_value("sr-rtptime"),
+                    stats.get_value("clock-rate"))
+
+        callback = self._report_callbacks.get(session)
+        if callback is not None:
+            callback(stats)
+
+    def _on_playout(self, pad, info, session):
+        packets = self._playout_packets.get(session, 0)
+        self._playout_packets[session] = packets + 1
+        if packets % SKEW_SAMPLE:
+            return Gst.PadProbeReturn.OK
+
+        buffer = info.get_buffer()
+        if buffer.pts == Gst.CLOCK_TIME_NONE:
+            return Gst.PadProbeReturn.OK
+        mapped, rtp = GstRtp.RTPBuffer.map(buffer, Gst.MapFlags.READ)
+        if not mapped:
+            return Gst.PadProbeReturn.OK
+        ssrc = rtp.get_ssrc()
+        timestamp = rtp.get_timestamp()
+        rtp.unmap()
+
+        report = self._sender_reports.get(ssrc)
+        if report is None:
+            return Gst.PadProbeReturn.OK
+        ntp_time, rtp_time, clock_rate = report
+
+        # Capture time on the sender's clock; RTP timestamps wrap at 32 bits
+        elapsed = (timestamp - rtp_time) & 0xffffffff
+        if elapsed >= 0x80000000:
+            elapsed -= 0x100000000
+        capture = ntp_time / 4294967296.0 + elapsed / float(clock_rate)
+
+        # The jitter buffer has applied the lip-sync offset to the pts
+        self._playout_offsets[session] = \
+                buffer.pts / float(Gst.SECOND) - capture
+        return Gst.PadProbeReturn.OK
+
+    def get_av_skew(self, video_session=VIDEO_SESSION,
+            audio_session=AUDIO_SESSION):
+        """
+        How much later (ms) video plays out than audio captured at the same
+        moment, negative when video is ahead.  None until both sessions
+        have had a sender report.
+        """
+        video = self._playout_offsets.get(video_session)
+        audio = self._playout_offsets.get(audio_session)
+        if video is None or audio is None:
+            return None
+        return (video - audio) * 1000
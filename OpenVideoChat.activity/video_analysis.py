@@ -0,0 +1,322 @@
+#    This file is part of OpenVideoChat.
+#
+#    OpenVideoChat is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    OpenVideoChat is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with OpenVideoChat.  If not, see <http://www.gnu.org/licenses/>.
+"""
+:mod: `OpenVideoChat/OpenVideoChat.activity/video_analysis` --
+        Open Video Chat Video Analysis
+=======================================================================
+
+Finds the hands and face in outgoing frames, so the encoder can spend
+its bits there rather than on a still background.  Each 16x16
+macroblock is scored for skin colour and recent motion, in NumPy over
+the mapped frame, and the marked macroblocks go to the encoder as
+GstVideoRegionOfInterestMeta rectangles.
+
+StillGate skips the frames of a picture that holds still, down to a
+minimum refresh rate.
+
+NumPy is optional; without it there is no analysis and the encoder
+spreads its bits as before (see available).
+"""
+
+
+# External Imports
+import time
+import logging
+import gi
+gi.require_version('Gst', '1.0')
+gi.require_version('GstBase', '1.0')
+gi.require_version('GstVideo', '1.0')
+from gi.repository import Gst
+from gi.repository import GstBase
+from gi.repository import GstVideo
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# The pad templates of RegionAnalyzer are made as the module loads
+Gst.init(None)
+
+
+# Define Logger for Logging
+logger = logging.getLogger('ovc-activity')
+
+
+# Planar formats the analysis reads, as the encoders take them
+ANALYSIS_CAPS = "video/x-raw,format={I420,YV12}"
+
+# Macroblock size in pixels
+MACROBLOCK = 16
+
+# Skin in YCbCr (Chai and Ngan): Cb and Cr ranges, and the share of a
+# macroblock's chroma samples that must fall in them
+SKIN_CB = (77, 127)
+SKIN_CR = (133, 173)
+SKIN_SHARE = 0.3
+
+# Mean luma change over a macroblock that counts as motion, and how much
+# of it is kept from frame to frame, so a face that holds still for a
+# moment stays marked
+MOTION_LEVEL = 3.0
+MOTION_DECAY = 0.9
+
+# Rectangles per frame (encoders keep a handful of segments) and the
+# quality offset for them, negative is better
+MAX_REGIONS = 4
+ROI_QUALITY = -15
+
+# Still picture: mean luma change (0 - 255) from the last frame sent
+# below which a frame may be skipped, frames sent per second however
+# still, and the step between the luma samples compared
+STILL_LEVEL = 1.5
+MIN_REFRESH = 2
+STILL_SAMPLE_STEP = 4
+
+# Formats whose first plane is the whole luma
+LUMA_PLANE_FORMATS = ["I420", "YV12", "NV12", "NV21", "Y42B", "Y444",
+        "GRAY8"]
+
+
+def available():
+    return numpy is not None
+
+
+def macroblock_means(plane, block):
+    """
+    Mean of each block x block tile of a 2-D array, the ragged edge
+    dropped.
+    """
+    rows = plane.shape[0] // block
+    columns = plane.shape[1] // block
+    tiles = plane[:rows * block, :columns * block].reshape(
+            rows, block, columns, block)
+    return tiles.mean(axis=(1, 3))
+
+
+def dilate(marked):
+    # Grow by one macroblock, edges of hands move out of the marked area
+    grown = marked.copy()
+    grown[1:, :] |= marked[:-1, :]
+    grown[:-1, :] |= marked[1:, :]
+    grown[:, 1:] |= marked[:, :-1]
+    grown[:, :-1] |= marked[:, 1:]
+    return grown
+
+
+def map_regions(marked, max_regions=MAX_REGIONS):
+    """
+    Rectangles (column, row, columns, rows), in macroblocks, that cover
+    the marked macroblocks: runs along each row, joined with the run
+    above where they overlap.  Past max_regions the smallest are bounded
+    together.
+    """
+    boxes = []
+    for row in range(marked.shape[0]):
+        columns = numpy.flatnonzero(marked[row])
+        if not len(columns):
+            continue
+        splits = numpy.flatnonzero(numpy.diff(columns) > 1) + 1
+        for run in numpy.split(columns, splits):
+            left, right = int(run[0]), int(run[-1]) + 1
+            for box in boxes:
+                if box[3] == row and box[0] < right and left < box[1]:
+                    box[0] = min(box[0], left)
+                    box[1] = max(box[1], right)
+                    box[3] = row + 1
+                    break
+            else:
+                boxes.append([left, right, row, row + 1])
+
+    boxes.sort(key=lambda box: (box[1] - box[0]) * (box[3] - box[2]),
+            reverse=True)
+    if len(boxes) > max_regions:
+        rest = boxes[max_regions - 1:]
+        boxes = boxes[:max_regions - 1] + [[min(box[0] for box in rest),
+                max(box[1] for box in rest), min(box[2] for box in rest),
+                max(box[3] for box in rest)]]
+    return [(left, top, right - left, bottom - top)
+            for left, right, top, bottom in boxes]
+
+
+#################
+# RegionAnalyzer
+#################
+class RegionAnalyzer(GstBase.BaseTransform):
+    """
+    In-place filter in front of the encoder.  Adds a region of interest
+    meta for each rectangle of hands and face, with codec.roi_param as
+    its encoder parameters, and keeps the last macroblock map in
+    region_map.
+    """
+
+    __gtype_name__ = "OvcRegionAnalyzer"
+    __gstmetadata__ = ("Region analyzer", "Filter/Analyzer/Video",
+            "Marks hands and face as regions of interest", "OpenVideoChat")
+    __gsttemplates__ = (
+            Gst.PadTemplate.new("src", Gst.PadDirection.SRC,
+                    Gst.PadPresence.ALWAYS,
+                    Gst.caps_from_string(ANALYSIS_CAPS)),
+            Gst.PadTemplate.new("sink", Gst.PadDirection.SINK,
+                    Gst.PadPresence.ALWAYS,
+                    Gst.caps_from_string(ANALYSIS_CAPS)))
+
+    def __init__(self, codec):
+        super(RegionAnalyzer, self).__init__()
+        self.set_in_place(True)
+        self.set_passthrough(False)
+        self.codec = codec
+        self.region_map = None
+        self.regions = []
+        self._info = None
+        self._previous = None
+        self._motion = None
+
+    def do_set_caps(self, incaps, outcaps):
+        self._info = GstVideo.VideoInfo()
+        if not self._info.from_caps(incaps):
+            return False
+        self._previous = None
+        self._motion = None
+        return True
+
+    def _plane(self, data, index, width, height):
+        stride = self._info.stride[index]
+        plane = numpy.frombuffer(data, numpy.uint8, count=stride * height,
+                offset=self._info.offset[index])
+        return plane.reshape(height, stride)[:, :width]
+
+    def do_transform_ip(self, buffer):
+        mapped, info = buffer.map(Gst.MapFlags.READ)
+        if not mapped:
+            return Gst.FlowReturn.OK
+        width = self._info.width
+        height = self._info.height
+        luma = self._plane(info.data, 0, width, height).astype(numpy.int16)
+        cb = self._plane(info.data, 1, width // 2, height // 2)
+        cr = self._plane(info.data, 2, width // 2, height // 2)
+        if self._info.finfo.format == GstVideo.VideoFormat.YV12:
+            cb, cr = cr, cb
+        buffer.unmap(info)
+
+        # Skin, on the half size chroma planes
+        skin = (cb >= SKIN_CB[0]) & (cb <= SKIN_CB[1]) & \
+                (cr >= SKIN_CR[0]) & (cr <= SKIN_CR[1])
+        skin = macroblock_means(skin, MACROBLOCK // 2) >= SKIN_SHARE
+
+        # Motion since the last frame, decayed so it lingers a while
+        if self._previous is None:
+            motion = numpy.zeros(skin.shape)
+        else:
+            motion = macroblock_means(numpy.abs(luma - self._previous),
+                    MACROBLOCK)
+        self._previous = luma
+        if self._motion is None or self._motion.shape != motion.shape:
+            self._motion = motion
+        else:
+            self._motion = numpy.maximum(self._motion * MOTION_DECAY, motion)
+
+        # Crop to the same macroblocks, chroma rounding can differ by one
+        rows = min(skin.shape[0], self._motion.shape[0])
+        columns = min(skin.shape[1], self._motion.shape[1])
+        self.region_map = dilate(skin[:rows, :columns] &
+                (self._motion[:rows, :columns] >= MOTION_LEVEL))
+        self.regions = map_regions(self.region_map)
+
+        for column, row, columns, rows in self.regions:
+            meta = GstVideo.buffer_add_video_region_of_interest_meta(buffer,
+                    "hands-face", column * MACROBLOCK, row * MACROBLOCK,
+                    columns * MACROBLOCK, rows * MACROBLOCK)
+            meta.add_param(Gst.Structure.new_from_string(
+                    self.codec.roi_param % ROI_QUALITY))
+        return Gst.FlowReturn.OK
+
+
+############
+# StillGate
+############
+class StillGate(object):
+    """
+    Drops frames at pad, the head of the encode chain, while the picture
+    holds still: the mean change over a grid of luma samples from the
+    last frame let through stays under STILL_LEVEL.  One frame still goes
+    through every 1 / min_refresh seconds, and the first frame that moves
+    goes through at once.  idle is True while the picture is still.
+    """
+
+    def __init__(self, pad, min_refresh=MIN_REFRESH):
+        self.pad = pad
+        self.min_refresh = min_refresh
+        self.skipped = 0
+        self.idle = False
+        self._caps = None
+        self._info = None
+        self._last = None
+        self._last_time = None
+        self._probe_id = pad.add_probe(Gst.PadProbeType.BUFFER, self._on_frame)
+
+    def stop(self):
+        if self._probe_id is not None:
+            self.pad.remove_probe(self._probe_id)
+            self._probe_id = None
+
+    def _luma(self, buffer):
+        caps = self.pad.get_current_caps()
+        if caps is None:
+            return None
+        if self._caps is None or not caps.is_equal(self._caps):
+            self._caps = caps
+            self._info = GstVideo.VideoInfo()
+            if not self._info.from_caps(caps) or \
+                    self._info.finfo.name not in LUMA_PLANE_FORMATS:
+                self._info = None
+            self._last = None
+        if self._info is None:
+            return None
+
+        mapped, info = buffer.map(Gst.MapFlags.READ)
+        if not mapped:
+            return None
+        stride = self._info.stride[0]
+        height = self._info.height
+        plane = numpy.frombuffer(info.data, numpy.uint8,
+                count=stride * height, offset=self._info.offset[0])
+        luma = plane.reshape(height, stride)[::STILL_SAMPLE_STEP,
+                :self._info.width:STILL_SAMPLE_STEP].astype(numpy.int16)
+        buffer.unmap(info)
+        return luma
+
+    def _on_frame(self, pad, info):
+        luma = self._luma(info.get_buffer())
+        if luma is None:
+            return Gst.PadProbeReturn.OK
+
+        now = time.time()
+        if self._last is not None:
+            still = numpy.abs(luma - self._last).mean() < STILL_LEVEL
+            if still and now - self._last_time < 1.0 / self.min_refresh:
+                if not self.idle:
+                    self.idle = True
+                    logger.debug("Picture still, down to %d fps" %
+                            self.min_refresh)
+                self.skipped += 1
+                return Gst.PadProbeReturn.DROP
+            if self.idle and not still:
+                self.idle = False
+                logger.debug("Picture moving, back to the full framerate")
+
+        self._last = luma
+        self._last_time = now
+        return Gst.PadProbeReturn.OK